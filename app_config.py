@@ -28,18 +28,95 @@ def get_config():
     # Optional variables with defaults
     # Optional variables with defaults
     config["INRIVER_IMAGE_FIELD"] = os.getenv("INRIVER_IMAGE_FIELD", "MainImage")
+    config["INRIVER_FETCH_MODE"] = os.getenv("INRIVER_FETCH_MODE", "bulk")  # "bulk" or "per_item"
+    config["INRIVER_MAX_CONCURRENCY"] = int(os.getenv("INRIVER_MAX_CONCURRENCY", "16"))
+    config["INRIVER_PREFETCH"] = int(os.getenv("INRIVER_PREFETCH", "32"))  # Items fetched ahead of image processing
+    config["INRIVER_RATE_LIMIT"] = float(os.getenv("INRIVER_RATE_LIMIT", "0"))  # requests/second, 0 = unlimited
     config["BATCH_SIZE"] = int(os.getenv("BATCH_SIZE", "500"))
     
+    # Sharding: Cloud Run Job tasks split the Item IDs (overridden by --shard i/n).
+    # Shards of one execution share RUN_GROUP (the execution name on Cloud Run).
+    config["SHARD_INDEX"] = int(os.getenv("CLOUD_RUN_TASK_INDEX", "0"))
+    config["SHARD_COUNT"] = int(os.getenv("CLOUD_RUN_TASK_COUNT", "1"))
+    config["RUN_GROUP"] = os.getenv("RUN_GROUP") or os.getenv("CLOUD_RUN_EXECUTION", "")
+    
     # GCP Config
     config["GOOGLE_CLOUD_PROJECT"] = os.getenv("GOOGLE_CLOUD_PROJECT") or "ecom-agents"
     config["VERTEX_LOCATION"] = os.getenv("VERTEX_LOCATION", "europe-west1")
+    config["VERTEX_HEDGE_LOCATION"] = os.getenv("VERTEX_HEDGE_LOCATION", "")  # second region for hedged search embeddings
+    config["VERTEX_REQUEST_TIMEOUT"] = float(os.getenv("VERTEX_REQUEST_TIMEOUT", "30"))  # seconds per embedding request
     config["FIRESTORE_DATABASE"] = os.getenv("FIRESTORE_DATABASE", "product")
     config["FIRESTORE_PRODUCTS_COLLECTION"] = os.getenv("FIRESTORE_PRODUCTS_COLLECTION", "products")
     config["FIRESTORE_PROGRESS_COLLECTION"] = os.getenv("FIRESTORE_PROGRESS_COLLECTION", "batchProgress")
     config["FIRESTORE_ERRORS_COLLECTION"] = os.getenv("FIRESTORE_ERRORS_COLLECTION", "processingErrors")
+    config["FIRESTORE_WRITE_BATCH_SIZE"] = int(os.getenv("FIRESTORE_WRITE_BATCH_SIZE", "200"))  # writes per commit (max 500)
+    config["FIRESTORE_MAX_IN_FLIGHT_COMMITS"] = int(os.getenv("FIRESTORE_MAX_IN_FLIGHT_COMMITS", "4"))
+    config["FIRESTORE_LEDGER_COLLECTION"] = os.getenv("FIRESTORE_LEDGER_COLLECTION", "ingestionLedger")
+    config["FIRESTORE_CONFIG_COLLECTION"] = os.getenv("FIRESTORE_CONFIG_COLLECTION", "searchConfig")
     
     # InRiver Filters
     config["INRIVER_FILTER_FORMULA"] = os.getenv("INRIVER_FILTER_FORMULA", "C")
     config["INRIVER_FILTER_MIN_YEAR"] = int(os.getenv("INRIVER_FILTER_MIN_YEAR", "2025"))
     
+    # Image downloads
+    config["DOWNLOAD_MAX_CONNECTIONS"] = int(os.getenv("DOWNLOAD_MAX_CONNECTIONS", "32"))
+    config["DOWNLOAD_PER_HOST_LIMIT"] = int(os.getenv("DOWNLOAD_PER_HOST_LIMIT", "8"))
+    config["DOWNLOAD_MAX_BYTES"] = int(os.getenv("DOWNLOAD_MAX_BYTES", str(30 * 1024 * 1024)))
+    
+    # Image preprocessing (0 = one worker process per CPU)
+    config["PREPROCESS_WORKERS"] = int(os.getenv("PREPROCESS_WORKERS", "0"))
+    config["EMBEDDING_IMAGE_MAX_EDGE"] = int(os.getenv("EMBEDDING_IMAGE_MAX_EDGE", "1024"))
+    # Images declaring more pixels are rejected before decoding (RGB costs 3 bytes per pixel in a worker)
+    config["PREPROCESS_MAX_PIXELS"] = int(os.getenv("PREPROCESS_MAX_PIXELS", "50000000"))
+    
+    # Ingestion pipeline: bounded queue per stage, write stage workers and the budget for image bytes in flight
+    # (download workers = DOWNLOAD_MAX_CONNECTIONS, embed workers = EMBEDDING_MAX_CONCURRENCY)
+    config["PIPELINE_QUEUE_SIZE"] = int(os.getenv("PIPELINE_QUEUE_SIZE", "64"))
+    config["PIPELINE_PREPROCESS_WORKERS"] = int(os.getenv("PIPELINE_PREPROCESS_WORKERS", "0"))  # 0 = PREPROCESS_WORKERS
+    config["PIPELINE_WRITE_WORKERS"] = int(os.getenv("PIPELINE_WRITE_WORKERS", "2"))
+    config["PIPELINE_MEMORY_BUDGET_MB"] = int(os.getenv("PIPELINE_MEMORY_BUDGET_MB", "512"))
+    
+    # Concurrent embedding generation
+    config["EMBEDDING_MAX_CONCURRENCY"] = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "8"))
+    config["EMBEDDING_MAX_RETRIES"] = int(os.getenv("EMBEDDING_MAX_RETRIES", "5"))
+    
+    # Embedding backend: "vertex", "local" (deterministic, offline) or "open_clip" (CPU, optional packages)
+    config["EMBEDDING_BACKEND"] = os.getenv("EMBEDDING_BACKEND", "vertex")
+    config["LOCAL_EMBEDDING_DIMENSION"] = int(os.getenv("LOCAL_EMBEDDING_DIMENSION", "1408"))
+    config["OPEN_CLIP_MODEL"] = os.getenv("OPEN_CLIP_MODEL", "ViT-B-32")
+    config["OPEN_CLIP_PRETRAINED"] = os.getenv("OPEN_CLIP_PRETRAINED", "laion2b_s34b_b79k")
+    # Ingest into the served collection even when search queries another vector field (searchConfig/active)
+    config["ALLOW_VECTOR_FIELD_MISMATCH"] = os.getenv("ALLOW_VECTOR_FIELD_MISMATCH", "false").lower() == "true"
+    
+    # Blue/green rebuilds: minimum size of the new collection relative to the active one
+    config["REBUILD_MIN_COUNT_RATIO"] = float(os.getenv("REBUILD_MIN_COUNT_RATIO", "0.9"))
+    # The two collections rebuilds alternate between (default: <products>_blue,<products>_green)
+    config["REBUILD_COLLECTIONS"] = os.getenv("REBUILD_COLLECTIONS", "")
+    
+    # Garbage collection of orphaned image documents
+    config["GC_ENABLED"] = os.getenv("GC_ENABLED", "true").lower() == "true"
+    config["GC_MAX_DELETE_FRACTION"] = float(os.getenv("GC_MAX_DELETE_FRACTION", "0.25"))
+    
+    # Search-path embeddings: deadline and hedging
+    config["SEARCH_EMBEDDING_DEADLINE"] = float(os.getenv("SEARCH_EMBEDDING_DEADLINE", "10"))  # seconds
+    config["SEARCH_HEDGE_PERCENTILE"] = float(os.getenv("SEARCH_HEDGE_PERCENTILE", "95"))  # 0 disables hedging
+    config["SEARCH_CONFIG_TTL"] = float(os.getenv("SEARCH_CONFIG_TTL", "60"))  # seconds before re-reading the active vector field
+    config["SEARCH_HEDGE_MIN_DELAY"] = float(os.getenv("SEARCH_HEDGE_MIN_DELAY", "0.5"))  # seconds
+    config["SEARCH_MAX_IN_FLIGHT"] = int(os.getenv("SEARCH_MAX_IN_FLIGHT", "16"))  # embedding requests; no hedge beyond it
+    
+    # Local embedding cache, off unless a path is set. On Cloud Run the container filesystem lives in
+    # memory: the file then counts against the instance's memory limit (up to EMBEDDING_CACHE_MAX_MB of
+    # vectors plus roughly 10-20% for keys, index and WAL) and is gone after the run. Point it at a
+    # mounted volume instead; 512 MB holds about 90,000 vectors of 1408 dimensions.
+    config["EMBEDDING_CACHE_PATH"] = os.getenv("EMBEDDING_CACHE_PATH", "")
+    config["EMBEDDING_CACHE_MAX_MB"] = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "512"))
+    
+    # Near-duplicate detection on perceptual hashes (off by default)
+    config["PHASH_DEDUPE"] = os.getenv("PHASH_DEDUPE", "false").lower() in ("1", "true", "yes")
+    config["PHASH_MAX_DISTANCE"] = int(os.getenv("PHASH_MAX_DISTANCE", "4"))
+    
+    # Incremental ingestion
+    config["FULL_SWEEP_INTERVAL_DAYS"] = float(os.getenv("FULL_SWEEP_INTERVAL_DAYS", "7"))
+    config["INCREMENTAL_OVERLAP_SECONDS"] = int(os.getenv("INCREMENTAL_OVERLAP_SECONDS", "300"))
+    
     return config
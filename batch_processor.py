@@ -1,201 +1,1207 @@
 import time
+import uuid
+import collections
+import concurrent.futures
+import array
+import dataclasses
+import re
+import threading
+import zlib
+import requests
+from google.cloud import firestore
 from typing import List, Dict, Any, Optional
 from inriver_client import InRiverClient
-from vision_client import VisionEmbeddingGenerator
+from embedding_backends import LEGACY_VECTOR_FIELD, get_embedding_backend, vector_field_for
 from firestore_client import FirestoreClient
-from image_utils import download_image, calculate_image_hash, is_valid_image
+from image_preprocessing import DEFAULT_MAX_PIXELS, ImagePreprocessor
+from perceptual_index import PerceptualHashIndex
+from embedding_cache import open_embedding_cache
+from embedding_executor import EmbeddingExecutor
+from ingestion_pipeline import MemoryBudget, Pipeline
+from image_downloader import get_downloader
 from app_config import get_config
 
+# Product document IDs: item_<entity id>_<image index>
+DOC_ID_PATTERN = re.compile(r"^item_(\d+)_(\d+)$")
+# Error records of Items that could not be fetched at all: item_<entity id>
+ITEM_RECORD_PATTERN = re.compile(r"^item_(\d+)$")
+
+# Stored fields needed to decide whether an image changed (never the vectors; embedding_model and
+# embedding_dim are written with the vector field and tell which backend's vector the document holds)
+LOOKUP_FIELDS = ["item_id", "item_code", "name", "parent_product_id", "image_url", "image_hash",
+                 "image_etag", "image_last_modified", "phash", "mean_rgb", "embedding_model", "embedding_dim"]
+
+def shard_of(item_id: int, shard_count: int) -> int:
+    """
+    Deterministic shard of an Item ID: the same in every process and run.
+    """
+    return zlib.crc32(str(item_id).encode("ascii")) % shard_count
+
 class BatchProcessor:
-    def __init__(self, dry_run: bool = False):
+    def __init__(self, dry_run: bool = False, shard_index: Optional[int] = None, shard_count: Optional[int] = None):
         self.config = get_config()
-        self.inriver = InRiverClient(self.config["IN_RIVER_BASE_URL"], self.config["ECOM_INRIVER_API_KEY"])
-        self.vision = VisionEmbeddingGenerator()
+        # This process only handles the Items of its shard (Cloud Run task index / count, or --shard i/n)
+        self.shard_index = self.config.get("SHARD_INDEX", 0) if shard_index is None else shard_index
+        self.shard_count = self.config.get("SHARD_COUNT", 1) if shard_count is None else shard_count
+        if self.shard_count < 1 or not 0 <= self.shard_index < self.shard_count:
+            raise ValueError(f"Invalid shard {self.shard_index}/{self.shard_count}")
+        self.run_group = self.config.get("RUN_GROUP") or None
+        self.inriver = InRiverClient(
+            self.config["IN_RIVER_BASE_URL"],
+            self.config["ECOM_INRIVER_API_KEY"],
+            fetch_mode=self.config.get("INRIVER_FETCH_MODE", "bulk"),
+            max_concurrency=self.config.get("INRIVER_MAX_CONCURRENCY", 16),
+            rate_per_second=self.config.get("INRIVER_RATE_LIMIT", 0)
+        )
+        self.vision = get_embedding_backend(self.config)
         self.db = FirestoreClient()
+        self.downloader = get_downloader()
+        self.preprocessor = ImagePreprocessor(
+            workers=self.config.get("PREPROCESS_WORKERS") or None,
+            max_edge=self.config.get("EMBEDDING_IMAGE_MAX_EDGE", 1024),
+            max_pixels=self.config.get("PREPROCESS_MAX_PIXELS", DEFAULT_MAX_PIXELS)
+        )
+        # Persistent content-addressed embeddings; the key includes the preprocessing variant
+        self.embedding_cache = open_embedding_cache(self.config)
+        self.embedding_model_key = f"{self.vision.model_key}/max{self.preprocessor.max_edge}px"
+        # Each model/dimension writes its own vector field (see embedding_migration for switching models)
+        self.vector_field = vector_field_for(self.vision)
+        # Optional near-duplicate detection on perceptual hashes (run-scoped)
+        self.phash_index = None
+        if self.config.get("PHASH_DEDUPE"):
+            self.phash_index = PerceptualHashIndex(max_distance=self.config.get("PHASH_MAX_DISTANCE", 4))
+        # Recently computed embeddings by doc_id, so near-duplicates can reuse them without a read
+        self._recent_embeddings = collections.OrderedDict()
+        # Concurrent embedding: AIMD-limited Vertex calls
+        embedding_concurrency = self.config.get("EMBEDDING_MAX_CONCURRENCY", 8)
+        self.embedder = EmbeddingExecutor(max_concurrency=embedding_concurrency,
+                                          max_retries=self.config.get("EMBEDDING_MAX_RETRIES", 5))
+        self._lock = threading.Lock()
+        self.run_id = None
+        # doc_ids that failed in this process, and those whose image was indexed or found
+        # unchanged (used to resolve retried error records)
+        self._failed_docs = set()
+        self._handled_docs = set()
+        # doc_ids indexed in the current batch (to correct the counts when their commit fails)
+        self._indexed_docs = set()
+        # Unresolved error records by doc_id (loaded per run)
+        self._open_errors: Dict[str, List[str]] = {}
+        # Buffered product and error writes, flushed before every checkpoint
+        self.writer = self.db.batched_writer(
+            flush_size=self.config.get("FIRESTORE_WRITE_BATCH_SIZE", 200),
+            max_in_flight=self.config.get("FIRESTORE_MAX_IN_FLIGHT_COMMITS", 4))
+        # Runs the batched stored-state reads (and the embedding migration's per-document work)
+        self.io_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.config.get("DOWNLOAD_MAX_CONNECTIONS", 32), thread_name_prefix="image-io")
         self.dry_run = dry_run
+        # Image ingestion as concurrent stages with bounded queues; process_batch feeds the first one
+        # while iter_items prefetches the Items from InRiver. Image bytes in flight stay within the budget.
+        self.memory_budget = MemoryBudget(self.config.get("PIPELINE_MEMORY_BUDGET_MB", 512) * 1024 * 1024)
+        self.pipeline = Pipeline([
+            ("download", self._fetch_image, self.config.get("DOWNLOAD_MAX_CONNECTIONS", 32)),
+            ("preprocess", self._prepare_image, self.config.get("PIPELINE_PREPROCESS_WORKERS") or self.preprocessor.workers),
+            # One worker: near-duplicate decisions must see every earlier image
+            ("dedupe", self._check_image, 1),
+            # Queued images are embedded together, up to the backend's batch size
+            ("embed", self._embed_images, embedding_concurrency, self.vision.max_batch_size),
+            ("write", self._write_image, self.config.get("PIPELINE_WRITE_WORKERS", 2)),
+        ], queue_size=self.config.get("PIPELINE_QUEUE_SIZE", 64),
+            on_error=self._on_image_error, on_done=self._on_image_done)
+        # Set by request_stop() (SIGTERM)
+        self._stop = threading.Event()
         
-    def process_batch(self, start_index: int, limit: int, item_code: Optional[str] = None) -> Dict[str, Any]:
+    def _data_criteria(self, item_code: Optional[str] = None) -> List[Dict]:
+        """
+        Builds the InRiver data criteria for the configured filter (or a single ItemCode).
+        """
+        if item_code:
+            return [
+                {
+                    "fieldTypeId": "ItemCode",
+                    "value": item_code,
+                    "operator": "Equal"
+                }
+            ]
+
+        formula = self.config.get("INRIVER_FILTER_FORMULA", "C")
+        min_year = self.config.get("INRIVER_FILTER_MIN_YEAR", 2025)
+        return [
+            {
+                "fieldTypeId": "ItemBusinessFormula",
+                "value": formula,
+                "operator": "Equal"
+            },
+            {
+                "fieldTypeId": "ItemSeasonYear",
+                "value": min_year,
+                "operator": "GreaterThanOrEqual"
+            }
+        ]
+
+    def check_vector_field(self) -> None:
+        """
+        Refuses to write into the collection search is serving when this backend's vector field
+        is not the one search queries (searchConfig/active): new documents would be missing from
+        search. Only warns in dry-run or with ALLOW_VECTOR_FIELD_MISMATCH.
+        """
+        search_config = self.db.get_search_config()
+        served_collection = search_config.get("products_collection") or self.db.default_products_collection
+        served_field = search_config.get("embedding_field") or LEGACY_VECTOR_FIELD
+        if self.db.products_collection != served_collection or served_field == self.vector_field:
+            return
+        message = (f"EMBEDDING_BACKEND writes '{self.vector_field}', but search queries '{served_field}' "
+                   f"in {served_collection}; new documents would be missing from search.")
+        if self.dry_run or self.config.get("ALLOW_VECTOR_FIELD_MISMATCH"):
+            print(f"WARNING: {message}")
+            return
+        raise RuntimeError(f"{message} Configure the backend search uses, or migrate (--migrate-embeddings) "
+                           f"and cut over first. ALLOW_VECTOR_FIELD_MISMATCH=true overrides this check.")
+
+    def select_mode(self, requested_mode: str = "auto", item_code: Optional[str] = None) -> tuple[str, Optional[float]]:
+        """
+        Decides between a full sweep and an incremental run.
+        Returns (mode, modified_since). Incremental runs only pick up Items modified since
+        the start of the last successful run; "auto" falls back to a full sweep when there
+        is no such run, the filter changed, or the last full sweep is older than
+        FULL_SWEEP_INTERVAL_DAYS.
         """
-        Processes a single batch of Items.
+        if item_code or requested_mode == "full":
+            return "full", None
+
+        last_run = self.db.get_last_completed_run(collection=self.db.products_collection)
+        if not last_run:
+            print("No previous successful run found. Running a full sweep.")
+            return "full", None
+
+        if (last_run.get("filter_formula") != self.config.get("INRIVER_FILTER_FORMULA", "C")
+                or last_run.get("filter_min_year") != self.config.get("INRIVER_FILTER_MIN_YEAR", 2025)):
+            print("InRiver filter changed since the last successful run. Running a full sweep.")
+            return "full", None
+
+        if requested_mode == "auto":
+            last_full = self.db.get_last_completed_run(full_only=True, collection=self.db.products_collection)
+            max_age = self.config.get("FULL_SWEEP_INTERVAL_DAYS", 7) * 86400
+            if not last_full or time.time() - (last_full.get("started_at") or 0) > max_age:
+                print("Last full sweep is too old. Running a full sweep.")
+                return "full", None
+
+        # Overlap a little with the previous run to absorb clock skew between us and InRiver
+        modified_since = (last_run.get("query_started_at") or last_run["started_at"]) - self.config.get("INCREMENTAL_OVERLAP_SECONDS", 300)
+        return "incremental", modified_since
+
+    def build_manifest(self, run_id: str, total_limit: int, item_code: Optional[str] = None, mode: str = "full",
+                       modified_since: Optional[float] = None) -> tuple[List[int], Dict[str, Any]]:
+        """
+        Queries InRiver once and freezes the sorted Item ID list for this run.
+        The manifest is persisted in the progress collection (skipped in dry-run).
+        Returns the manifest and the run metadata.
+        """
+        formula = self.config.get("INRIVER_FILTER_FORMULA", "C")
+        min_year = self.config.get("INRIVER_FILTER_MIN_YEAR", 2025)
+        filter_desc = f"ItemCode: {item_code}" if item_code else f"Filter: {formula}, Year >= {min_year}"
+        if modified_since is not None:
+            filter_desc += f", modified since {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(modified_since))} UTC"
+        print(f"--- Building {mode} manifest for run {run_id} ({filter_desc}) ---")
+
+        query_started_at = time.time()
+        item_ids = self.inriver.query_item_ids(self._data_criteria(item_code), modified_since=modified_since)
+        manifest = item_ids[:total_limit]
+        # Whether the run as a whole (all shards together) covers every Item that matches the filter
+        covers_filter = not item_code and len(manifest) == len(item_ids)
+        if self.shard_count > 1:
+            # --limit applies to the whole run; each shard takes its part of it
+            manifest = [item_id for item_id in manifest if shard_of(item_id, self.shard_count) == self.shard_index]
+            print(f"Shard {self.shard_index}/{self.shard_count}: {len(manifest)} of {min(total_limit, len(item_ids))} Items")
+
+        metadata = {
+            "status": "running",
+            "started_at": time.time(),
+            "query_started_at": query_started_at,
+            "mode": mode,
+            "modified_since": modified_since,
+            "covers_filter": covers_filter,
+            "item_code": item_code,
+            "filter_formula": None if item_code else formula,
+            "filter_min_year": None if item_code else min_year,
+            "total_matching": len(item_ids),
+            "products_collection": self.db.products_collection,
+            "shard_index": self.shard_index,
+            "shard_count": self.shard_count,
+            "run_group": self.run_group
+        }
+        if not self.dry_run:
+            self.db.save_manifest(run_id, manifest, metadata=metadata)
+        return manifest, metadata
+
+    def process_batch(self, item_ids: List[int], start_index: int = 0,
+                      only_images: Optional[Dict[int, set]] = None) -> Dict[str, Any]:
+        """
+        Processes a single page of the run manifest.
         Each Item may have multiple images; each image becomes a searchable document.
+        With only_images ({item_id: image indexes, or None for all}) only those images are reprocessed.
+        After a stop request no new Items are started; stats["interrupted"] is then True.
+        Items InRiver does not return count as failed ("unfetched") and get an error record.
         """
         stats = {
             "batch_start": start_index,
             "items_processed": 0,
             "images_indexed": 0,
             "skipped": 0,
-            "failed": 0
+            "not_modified": 0,
+            "metadata_updated": 0,
+            "deduplicated": 0,
+            "orphans_deleted": 0,
+            "failed": 0,
+            "unfetched": 0,
+            "interrupted": False
         }
-        
-        formula = self.config.get("INRIVER_FILTER_FORMULA", "C")
-        min_year = self.config.get("INRIVER_FILTER_MIN_YEAR", 2025)
-        
-        filter_desc = f"ItemCode: {item_code}" if item_code else f"Filter: {formula}, Year >= {min_year}"
-        print(f"--- Processing Batch: start={start_index}, limit={limit} ({filter_desc}) ---")
-        
-        # 1. Fetch Items from InRiver with filters
+
+        print(f"--- Processing Batch: start={start_index}, size={len(item_ids)} ---")
+        with self._lock:
+            self._indexed_docs.clear()
+
+        # 1. Stream Item details from InRiver (iter_items prefetches them in the background) and feed
+        # their images into the pipeline; when the download queue is full, the feed waits.
+        live_images = {}
+        # Per-Item outcome of this batch, written to the ingestion ledger at the end
+        ledger = {}
+        # The stored state of every image in the batch is read up front (batched, projected),
+        # so the per-image skip check is a dictionary lookup. Submitted first, so it runs first.
+        stored = self.io_executor.submit(self.db.get_products_by_item, item_ids, LOOKUP_FIELDS)
+        fetched = set()
+        fetch_error = None
         try:
-            if item_code:
-                data_criteria = [
-                    {
-                        "fieldTypeId": "ItemCode",
-                        "value": item_code,
-                        "operator": "Equal"
-                    }
-                ]
-            else:
-                data_criteria = [
-                    {
-                        "fieldTypeId": "ItemBusinessFormula",
-                        "value": formula,
-                        "operator": "Equal"
-                    },
-                    {
-                        "fieldTypeId": "ItemSeasonYear",
-                        "value": min_year,
-                        "operator": "GreaterThanOrEqual"
-                    }
-                ]
-            items = self.inriver.get_products(start_index, limit, data_criteria=data_criteria)
+            for item in self.inriver.iter_items(item_ids, prefetch=self.config.get("INRIVER_PREFETCH", 32)):
+                if self._stop.is_set():
+                    stats["interrupted"] = True
+                    break
+                fetched.add(item.get("entity_id"))
+                selected = only_images.get(item.get("entity_id"), set()) if only_images is not None else None
+                if item.get("images_complete"):
+                    live_images[item.get("entity_id")] = len(item.get("image_urls", []))
+                for task in self._start_item(item, stored, stats, ledger, selected):
+                    self.pipeline.submit(task)
         except Exception as e:
             print(f"Failed to fetch batch from InRiver: {e}")
-            stats["failed"] = limit
-            return stats
+            fetch_error = e
+
+        # The batch (and its checkpoint) is only done when every image has left the pipeline
+        self.pipeline.join()
+        self._collect_write_failures(stats, ledger)
+        self._write_ledger(ledger)
+        if stats["interrupted"]:
+            print(f"Stop requested: {stats['items_processed']} of {len(item_ids)} Items of this batch were processed.")
+        else:
+            # Items InRiver did not return were not ingested: never let them pass silently
+            for item_id in item_ids:
+                if item_id not in fetched:
+                    self._count(stats, "unfetched")
+                    self._record_error(f"item_{item_id}", item_id, "N/A", None,
+                                       fetch_error or RuntimeError("Item not returned by InRiver"), stats)
+        fetched_records = [f"item_{item_id}" for item_id in fetched]
+        for doc_id in fetched_records:
+            self._handled(doc_id)
+        self._resolve_open_errors(fetched_records)
 
-        if not items:
+        # Items that lost images: documents beyond the current image count are orphans.
+        # Only Items whose Resources were all resolved count, so a failed lookup never deletes.
+        try:
+            stored_ids = list(stored.result()) if self.config.get("GC_ENABLED", True) else []
+        except Exception:
+            stored_ids = []
+        orphans = []
+        for doc_id in stored_ids:
+            match = DOC_ID_PATTERN.match(doc_id)
+            if match and int(match.group(1)) in live_images and int(match.group(2)) >= live_images[int(match.group(1))]:
+                orphans.append(doc_id)
+        stats["orphans_deleted"] = self._delete_orphans(orphans, "images removed from their Item")
+
+        if not stats["items_processed"]:
             print("No items found in this range.")
-            return stats
-
-        for item in items:
-            stats["items_processed"] += 1
-            item_id = item.get("entity_id")
-            item_fields = item.get("item_fields", {})
-            product_fields = item.get("product_fields", {})
-            image_urls = item.get("image_urls", [])
-            
-            item_code = item_fields.get("ItemCode", "N/A")
-            # Resolve name from nested dictionary (Product Name)
-            names = product_fields.get("ProductNameCommercial", {})
-            if isinstance(names, dict):
-                p_name = names.get("nl-NL") or names.get("en-GB") or "Naamloos"
+
+        return stats
+
+    def request_stop(self, signum: Optional[int] = None, frame: Any = None) -> None:
+        """
+        Signal handler (SIGTERM): no new Items are started, the images already in the
+        pipeline are finished and written, and the run ends at its last checkpoint.
+        """
+        print("Stop requested: draining in-flight images...")
+        self._stop.set()
+
+    def _delete_orphans(self, doc_ids: List[str], reason: str) -> int:
+        """
+        Deletes orphaned image documents in bulk (reported only in dry-run). Returns the count.
+        """
+        if not doc_ids:
+            return 0
+        sample = ", ".join(sorted(doc_ids)[:10]) + (", ..." if len(doc_ids) > 10 else "")
+        if self.dry_run:
+            print(f"  - Dry-run: would delete {len(doc_ids)} orphaned documents ({reason}): {sample}")
+            return len(doc_ids)
+        print(f"  - Deleting {len(doc_ids)} orphaned documents ({reason}): {sample}")
+        for doc_id in doc_ids:
+            self.writer.delete_product(doc_id)
+        return len(doc_ids)
+
+    def sweep_orphans(self, manifest: List[int]) -> int:
+        """
+        Deletes the documents of Items that no longer match the InRiver filter, i.e. are
+        missing from a full run's manifest, and closes their open error records. Refuses to
+        delete more than GC_MAX_DELETE_FRACTION of the collection, which would rather point
+        at a broken query than at real deletions.
+        """
+        live_items = set(manifest)
+        # A shard only knows (and cleans up) the Items of its own shard
+        doc_ids = [doc_id for doc_id in self.db.get_product_ids() if self._in_shard(doc_id)]
+        orphans = []
+        for doc_id in doc_ids:
+            match = DOC_ID_PATTERN.match(doc_id)
+            if match and int(match.group(1)) not in live_items:
+                orphans.append(doc_id)
+        max_fraction = self.config.get("GC_MAX_DELETE_FRACTION", 0.25)
+        if doc_ids and len(orphans) > max_fraction * len(doc_ids):
+            print(f"GC: {len(orphans)} of {len(doc_ids)} documents are not in the manifest (more than {max_fraction:.0%}). "
+                  "Nothing deleted; check the InRiver filter.")
+            return 0
+        print(f"--- GC: {len(orphans)} of {len(doc_ids)} documents belong to Items outside the filter ---")
+        deleted = self._delete_orphans(orphans, "Item no longer matches the filter")
+        # Their open error records would make --retry-failed write the documents back
+        with self._lock:
+            open_docs = list(self._open_errors)
+        stale = []
+        for doc_id in open_docs:
+            match = DOC_ID_PATTERN.match(doc_id) or ITEM_RECORD_PATTERN.match(doc_id)
+            item_id = int(match.group(1)) if match else None
+            if item_id is not None and item_id not in live_items and shard_of(item_id, self.shard_count) == self.shard_index:
+                stale.append(doc_id)
+        if stale:
+            print(f"  - Closing the error records of {len(stale)} documents outside the filter")
+            self._resolve_open_errors(stale, resolution="Item no longer matches the filter")
+        if not self.dry_run:
+            for item_id in self.db.get_ledger_item_ids():
+                if item_id not in live_items and shard_of(item_id, self.shard_count) == self.shard_index:
+                    self.writer.delete_ledger_item(item_id)
+        return deleted
+
+    def _in_shard(self, doc_id: str) -> bool:
+        if self.shard_count == 1:
+            return True
+        match = DOC_ID_PATTERN.match(doc_id)
+        return bool(match) and shard_of(int(match.group(1)), self.shard_count) == self.shard_index
+
+    def _fetch_image(self, task: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Download stage: looks up the stored state of the image in the batch's preloaded map and
+        downloads it, conditionally (ETag / Last-Modified) when the document was indexed from
+        the same URL. Waits before reading the body while the memory budget for in-flight image bytes is used up.
+        """
+        doc_id = task["doc_id"]
+        try:
+            existing_doc = task["stored"].result().get(doc_id)
+        except Exception:
+            # The batched read failed; fall back to a (projected) read of this document
+            existing_doc = self.db.get_products([doc_id], LOOKUP_FIELDS).get(doc_id)
+        etag = last_modified = None
+        if (existing_doc and existing_doc.get("image_url") == task["image_url"] and existing_doc.get("image_hash")
+                and self._has_current_embedding(existing_doc)):
+            etag = existing_doc.get("image_etag")
+            last_modified = existing_doc.get("image_last_modified")
+        # The body's expected size is reserved before it is read; the excess is given back after
+        download = self.downloader.fetch(task["image_url"], etag=etag, last_modified=last_modified,
+                                         reserve=self.memory_budget.acquire)
+        task["reserved"] = min(download.reserved, len(download.content or b""))
+        self.memory_budget.release(download.reserved - task["reserved"])
+        task.update(existing_doc=existing_doc, download=download, downloaded=bool(download.content))
+        return task
+
+    def _prepare_image(self, task: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Preprocess stage: decodes, validates, normalizes and hashes the download in the process pool.
+        Only the normalized image travels on; the rest of its budget is given back.
+        """
+        download = task["download"]
+        if not download.content:
+            return task
+        prepared = self.preprocessor.process(download.content)
+        task["prepared"] = prepared
+        task["download"] = dataclasses.replace(download, content=None)
+        kept = min(task["reserved"], len(prepared["content"])) if prepared else 0
+        self.memory_budget.release(task["reserved"] - kept)
+        task["reserved"] = kept
+        return task
+
+    def _has_current_embedding(self, existing_doc: Dict[str, Any]) -> bool:
+        """
+        Whether a stored document holds this backend's vector, so an unchanged image can be skipped.
+        Documents from before embedding_model was stored hold the legacy model's vector.
+        """
+        model = existing_doc.get("embedding_model")
+        if model is None:
+            return self.vector_field == LEGACY_VECTOR_FIELD
+        return model == self.vision.model_key and existing_doc.get("embedding_dim") == self.vision.dimension
+
+    def _remember_image(self, doc_id: str, item_id: Any, phash: Optional[str], mean_rgb: Optional[List[int]],
+                        stored: bool = False) -> None:
+        """
+        Registers an indexed image in the near-duplicate index (no-op when disabled).
+        stored marks an unchanged image whose current vector is already in Firestore;
+        the others only get theirs once this run embedded them.
+        """
+        if self.phash_index is None or not phash:
+            return
+        with self._lock:
+            self.phash_index.add(phash, mean_rgb, {"doc_id": doc_id, "item_id": item_id, "stored": stored})
+
+    def _remember_embedding(self, doc_id: str, embedding: List[float]) -> None:
+        """
+        Keeps a freshly computed embedding in memory so near-duplicates can reuse it.
+        """
+        if self.phash_index is None:
+            return
+        with self._lock:
+            self._recent_embeddings[doc_id] = array.array("f", embedding)
+            if len(self._recent_embeddings) > self.config.get("PHASH_EMBEDDING_CACHE", 2000):
+                self._recent_embeddings.popitem(last=False)
+
+    def _find_near_duplicate(self, prepared: Dict[str, Any]) -> Optional[tuple[Dict[str, Any], int]]:
+        if self.phash_index is None or not prepared.get("phash"):
+            return None
+        with self._lock:
+            return self.phash_index.find(prepared["phash"], prepared.get("mean_rgb"))
+
+    def _embedding_of(self, doc_id: str, stored: bool = False) -> Optional[List[float]]:
+        """
+        Returns the embedding of an already indexed image: one computed in this run, or for a
+        stored (unchanged) image its vector field alone from Firestore. None when there is none
+        yet, e.g. while the image is still being embedded: the stored document then holds the
+        vector of the image it replaces.
+        """
+        with self._lock:
+            recent = self._recent_embeddings.get(doc_id)
+        if recent is not None:
+            return list(recent)
+        if not stored:
+            return None
+        vector = self.db.get_products([doc_id], [self.vector_field]).get(doc_id, {}).get(self.vector_field)
+        return list(vector) if vector is not None else None
+
+    def _embed(self, prepared: Dict[str, Any]) -> List[float]:
+        """
+        Returns the embedding of a preprocessed image, from the local embedding cache
+        when the same bytes were embedded before with the same model and dimension.
+        Vertex calls go through the embedding executor (rate limiting and retries)
+        and raise once retries are exhausted.
+        """
+        result = self._embed_many([prepared])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _embed_many(self, prepared_images: List[Dict[str, Any]]) -> List[Any]:
+        """
+        Embeds several preprocessed images: cache hits are not sent, the rest go to the
+        backend's embed_batch() in chunks of its max_batch_size, concurrently through the
+        embedding executor. Returns one embedding, or the exception it failed with, per image.
+        """
+        results: List[Any] = [None] * len(prepared_images)
+        missing = []
+        for i, prepared in enumerate(prepared_images):
+            cached = None
+            if self.embedding_cache:
+                cached = self.embedding_cache.get(prepared["image_hash"], self.embedding_model_key, self.vision.dimension)
+            if cached:
+                results[i] = cached
             else:
-                p_name = str(names) or "Naamloos"
+                missing.append(i)
+
+        size = max(1, self.vision.max_batch_size)
+        chunks = [missing[start:start + size] for start in range(0, len(missing), size)]
+        futures = [self.embedder.submit(self.vision.embed_batch, [prepared_images[i]["content"] for i in chunk])
+                   for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            try:
+                embeddings = future.result()
+            except Exception as e:
+                if len(chunk) == 1:
+                    embeddings = [e]
+                else:
+                    # Embed one by one, so one bad image does not fail the whole chunk
+                    embeddings = []
+                    for i in chunk:
+                        try:
+                            embeddings.append(self.embedder.call(self.vision.embed, prepared_images[i]["content"]))
+                        except Exception as single_error:
+                            embeddings.append(single_error)
+            for i, embedding in zip(chunk, embeddings):
+                results[i] = embedding
+                if self.embedding_cache and not isinstance(embedding, Exception):
+                    self.embedding_cache.put(prepared_images[i]["image_hash"], self.embedding_model_key,
+                                             self.vision.dimension, embedding)
+        return results
+
+    def _count(self, stats: Dict[str, Any], key: str, amount: int = 1) -> None:
+        with self._lock:
+            stats[key] += amount
+
+    def _record_error(self, doc_id: str, item_id: Any, item_code: str, idx: Optional[int], error: Exception,
+                      stats: Dict[str, Any]) -> None:
+        """
+        Counts a failure and logs its error record; idx None stands for the whole Item.
+        """
+        print(f"  - [{f'Image {idx}' if idx is not None else f'Item {item_id}'}] ❌ Error: {error}")
+        self._count(stats, "failed")
+        # Log error
+        if not self.dry_run:
+            error_doc = {
+                "doc_id": doc_id,
+                "item_id": item_id,
+                "item_code": item_code,
+                "image_idx": idx,
+                "error_message": str(error),
+                "timestamp": time.time(),
+                "run_id": self.run_id,
+                "products_collection": self.db.products_collection,
+                # Open until --retry-failed or a later run indexes the image successfully
+                "resolved": False,
+                "attempts": firestore.Increment(1)
+            }
+            # One record per image and collection: repeated failures update it instead of piling up,
+            # and a rebuild's records stay apart from those of the collection search is serving
+            self.writer.log_error(error_doc, record_id=self._error_record_id(doc_id))
+        with self._lock:
+            self._failed_docs.add(doc_id)
 
-            if not image_urls:
-                print(f"[Item {item_id}] Skip: No image URLs found.")
-                stats["skipped"] += 1
+    def _error_record_id(self, doc_id: str) -> str:
+        collection = self.db.products_collection
+        return doc_id if collection == self.db.default_products_collection else f"{collection}_{doc_id}"
+
+    @staticmethod
+    def _changed_fields(existing_doc: Dict[str, Any], fields: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Returns the fields whose stored value differs from the given one.
+        """
+        return {key: value for key, value in fields.items() if existing_doc.get(key) != value}
+
+    def _update_metadata(self, doc_id: str, changes: Dict[str, Any], stats: Dict[str, Any]) -> None:
+        """
+        Partial update of changed metadata; the embedding is left alone. No-op without changes.
+        """
+        if not changes:
+            return
+        self._count(stats, "metadata_updated")
+        if not self.dry_run:
+            self.writer.upsert_product(dict(changes, doc_id=doc_id, metadata_updated_at=time.time()))
+
+    def _write_ledger(self, ledger: Dict[Any, Dict[str, Any]]) -> None:
+        """
+        Records each Item's outcome (image counts, status, run) in the ingestion ledger,
+        so verification and monitoring can count instead of scanning the products collection.
+        """
+        if self.dry_run:
+            return
+        for entry in ledger.values():
+            if not entry["images"]:
+                status = "no_images"
+            elif entry["failed"] >= entry["images"]:
+                status = "failed"
+            elif entry["failed"]:
+                status = "partial"
+            else:
+                status = "ok"
+            self.writer.update_ledger(dict(entry, status=status, indexed_count=entry["indexed"] + entry["unchanged"],
+                                           last_run_id=self.run_id, updated_at=time.time()))
+
+    def _collect_write_failures(self, stats: Dict[str, Any], ledger: Dict[Any, Dict[str, Any]]) -> None:
+        """
+        Commits the batch's buffered writes and turns product documents whose commit failed
+        into image failures: corrected counts and ledger entries, and an error record each,
+        so --retry-failed picks them up.
+        """
+        if self.dry_run:
+            return
+        self.writer.flush()
+        for doc_id, error in self.writer.take_failed_products():
+            match = DOC_ID_PATTERN.match(doc_id)
+            item_id, idx = (int(match.group(1)), int(match.group(2))) if match else (None, 0)
+            entry = ledger.get(item_id)
+            with self._lock:
+                indexed = doc_id in self._indexed_docs
+                self._indexed_docs.discard(doc_id)
+                if indexed:
+                    stats["images_indexed"] -= 1
+                if entry:
+                    key = "indexed" if indexed else "unchanged"
+                    entry[key] = max(0, entry[key] - 1)
+                    entry["failed"] += 1
+            self._record_error(doc_id, item_id, entry["item_code"] if entry else "N/A", idx,
+                               RuntimeError(f"Firestore write failed: {error}"), stats)
+
+        # Images that failed before and are now committed: close their error records
+        with self._lock:
+            indexed = list(self._indexed_docs)
+        self._resolve_open_errors(indexed)
+
+    def _resolve_open_errors(self, doc_ids: List[str], resolution: Optional[str] = None) -> None:
+        """
+        Marks the open error records of the given doc_ids (or Item records) resolved;
+        resolution notes why when it is not a successful write.
+        """
+        if self.dry_run:
+            return
+        with self._lock:
+            resolved = [self._open_errors.pop(doc_id) for doc_id in doc_ids if doc_id in self._open_errors]
+        for record_ids in resolved:
+            for record_id in record_ids:
+                fields = {"resolved": True, "resolved_at": time.time(), "resolved_by": self.run_id}
+                if resolution:
+                    fields["resolution"] = resolution
+                self.writer.update_error(record_id, fields)
+
+    def _tally(self, entry: Dict[str, Any], key: str) -> None:
+        with self._lock:
+            entry[key] += 1
+
+    def _start_item(self, item: Dict[str, Any], stored: concurrent.futures.Future, stats: Dict[str, Any],
+                    ledger: Dict[Any, Dict[str, Any]], selected: Optional[set] = None) -> List[Dict[str, Any]]:
+        """
+        Opens the ledger entry of one InRiver Item and returns a pipeline task per image.
+        With selected (retry mode) only those image indexes get a task; the others count as unchanged.
+        """
+        self._count(stats, "items_processed")
+        item_id = item.get("entity_id")
+        item_fields = item.get("item_fields", {})
+        product_fields = item.get("product_fields", {})
+        image_urls = item.get("image_urls", [])
+        
+        item_code = item_fields.get("ItemCode", "N/A")
+        # Resolve name from nested dictionary (Product Name)
+        names = product_fields.get("ProductNameCommercial", {})
+        if isinstance(names, dict):
+            p_name = names.get("nl-NL") or names.get("en-GB") or "Naamloos"
+        else:
+            p_name = str(names) or "Naamloos"
+
+        entry = ledger[item_id] = {"item_id": item_id, "item_code": item_code, "images": len(image_urls),
+                                   "indexed": 0, "unchanged": 0, "skipped": 0, "failed": 0}
+        if not image_urls:
+            print(f"[Item {item_id}] Skip: No image URLs found.")
+            self._count(stats, "skipped")
+            return []
+
+        print(f"[Item {item_id} | {item_code}] Processing {len(image_urls)} images for: {p_name}...")
+
+        tasks = []
+        for idx, image_url in enumerate(image_urls):
+            if selected is not None and idx not in selected:
+                # Not selected for reprocessing (retry mode): the image was fine
+                self._tally(entry, "unchanged")
                 continue
+            tasks.append({
+                "doc_id": f"item_{item_id}_{idx}",
+                "idx": idx,
+                "item_id": item_id,
+                "item_code": item_code,
+                "names": names,
+                "image_url": image_url,
+                "parent_product_id": product_fields.get("product_entity_id"),
+                "stored": stored,
+                "stats": stats,
+                "entry": entry,
+                "reserved": 0,
+                "prepared": None
+            })
+        return tasks
 
-            print(f"[Item {item_id} | {item_code}] Processing {len(image_urls)} images for: {p_name}...")
+    def _check_image(self, task: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Dedupe stage: decides whether an image needs a (new) embedding. Unchanged images only get
+        their changed metadata written; near-duplicates within the Item are dropped. Returns the
+        task with its product_data when it goes on to the embed stage, else None.
+        Runs on a single worker, so near-duplicate decisions see every earlier image.
+        """
+        doc_id, idx, item_id = task["doc_id"], task["idx"], task["item_id"]
+        stats, entry = task["stats"], task["entry"]
+        existing_doc, download, prepared = task["existing_doc"], task["download"], task["prepared"]
+        # Document fields that come from InRiver rather than from the image
+        metadata = {
+            "item_id": item_id,
+            "item_code": task["item_code"],
+            "name": task["names"],
+            "image_url": task["image_url"],
+            "parent_product_id": task["parent_product_id"]
+        }
+        if download.not_modified:
+            # HTTP 304: the asset is unchanged since it was indexed; only metadata may need a refresh
+            self._update_metadata(doc_id, self._changed_fields(existing_doc, metadata), stats)
+            self._remember_image(doc_id, item_id, existing_doc.get("phash"), existing_doc.get("mean_rgb"), stored=True)
+            self._count(stats, "not_modified")
+            self._count(stats, "skipped")
+            self._tally(entry, "unchanged")
+            self._handled(doc_id)
+            return None
 
-            for idx, image_url in enumerate(image_urls):
-                doc_id = f"item_{item_id}_{idx}"
-                try:
-                    # 2. Download and Validate
-                    image_bytes = download_image(image_url)
-                    if not image_bytes:
-                        # download_image already logs video skip or error
-                        stats["skipped"] += 1
-                        continue
-                    
-                    if not is_valid_image(image_bytes):
-                        print(f"  - [Image {idx}] Skip: Invalid image format at {image_url}")
-                        stats["skipped"] += 1
-                        continue
-                        
-                    current_hash = calculate_image_hash(image_bytes)
-                    
-                    # Check Firestore
-                    existing_doc = self.db.get_product(doc_id)
-                    if existing_doc and existing_doc.get("image_hash") == current_hash:
-                        # Skip if hash matches
-                        stats["skipped"] += 1
-                        continue
+        if not task["downloaded"]:
+            # The downloader already logs video skip or error
+            self._count(stats, "skipped")
+            self._tally(entry, "skipped")
+            return None
+        
+        if not prepared:
+            print(f"  - [Image {idx}] Skip: Invalid image format at {task['image_url']}")
+            self._count(stats, "skipped")
+            self._tally(entry, "skipped")
+            return None
+            
+        current_hash = prepared["image_hash"]
+        
+        # Check Firestore
+        if existing_doc and existing_doc.get("image_hash") == current_hash and self._has_current_embedding(existing_doc):
+            # Skip the embedding if hash matches, but update changed metadata and backfill the
+            # validators (for a conditional GET next run) and the perceptual hash when missing or changed
+            backfill = self._changed_fields(existing_doc, metadata)
+            metadata_changed = bool(backfill)
+            if (download.etag or download.last_modified) and (
+                    existing_doc.get("image_etag") != download.etag
+                    or existing_doc.get("image_last_modified") != download.last_modified):
+                backfill.update({"image_etag": download.etag, "image_last_modified": download.last_modified})
+            if self.phash_index is not None and prepared.get("phash") and not existing_doc.get("phash"):
+                backfill.update({"phash": prepared["phash"], "mean_rgb": prepared["mean_rgb"]})
+            if metadata_changed:
+                self._count(stats, "metadata_updated")
+                backfill["metadata_updated_at"] = time.time()
+            if backfill and not self.dry_run:
+                self.writer.upsert_product(dict(backfill, doc_id=doc_id))
+            self._remember_image(doc_id, item_id, prepared.get("phash"), prepared.get("mean_rgb"), stored=True)
+            self._count(stats, "skipped")
+            self._tally(entry, "unchanged")
+            self._handled(doc_id)
+            return None
+
+        # Near-duplicates: collapse within the Item, reuse the embedding across Items
+        duplicate_of = None
+        near_duplicate = self._find_near_duplicate(prepared)
+        if near_duplicate:
+            match, distance = near_duplicate
+            if match["item_id"] == item_id:
+                print(f"  - [Image {idx}] Skip: near-duplicate of {match['doc_id']} (distance {distance})")
+                if existing_doc and not self.dry_run:
+                    # The document at this index holds the image this one replaced; match now stands for it
+                    self.writer.delete_product(doc_id)
+                self._count(stats, "deduplicated")
+                self._count(stats, "skipped")
+                self._tally(entry, "skipped")
+                self._handled(doc_id)
+                return None
+            duplicate_of = match["doc_id"]
+            task["duplicate_stored"] = match.get("stored", False)
+        # Register now so later images in this run can match it while it is being embedded
+        self._remember_image(doc_id, item_id, prepared.get("phash"), prepared.get("mean_rgb"))
+
+        task["product_data"] = {
+            "doc_id": doc_id,
+            "item_id": item_id,
+            "item_code": task["item_code"],
+            "name": task["names"], # Store full dict
+            "image_url": task["image_url"],
+            "image_hash": current_hash,
+            "image_etag": download.etag,
+            "image_last_modified": download.last_modified,
+            "phash": prepared.get("phash"),
+            "mean_rgb": prepared.get("mean_rgb"),
+            "duplicate_of": duplicate_of,
+            "parent_product_id": task["parent_product_id"]
+        }
+        return task
 
-                    # 3. Generate Embedding (if not dry run)
-                    embedding = None
-                    if not self.dry_run:
-                        embedding = self.vision.get_embedding(image_bytes)
-                        if not embedding:
-                            raise ValueError(f"Failed to generate embedding for image {idx}")
-                    
-                    # 4. Upsert to Firestore
-                    if not self.dry_run:
-                        product_data = {
-                            "doc_id": doc_id,
-                            "item_id": item_id,
-                            "item_code": item_code,
-                            "name": names, # Store full dict
-                            "image_url": image_url,
-                            "image_hash": current_hash,
-                            "embedding": embedding,
-                            "last_updated": time.time(),
-                            "parent_product_id": product_fields.get("product_entity_id")
-                        }
-                        self.db.upsert_product(product_data)
-                        stats["images_indexed"] += 1
+    def _embed_images(self, tasks: List[Dict[str, Any]]) -> List[Any]:
+        """
+        Embed stage: embeds the queued images together (up to the backend's max_batch_size),
+        except those that can reuse a near-duplicate's embedding. Its workers share the
+        embedding executor's rate limit and retries. Returns the task, or its error, per image.
+        """
+        # 3. Generate Embedding (if not dry run), unless a near-duplicate's can be reused
+        embeddings: List[Any] = [None] * len(tasks)
+        if not self.dry_run:
+            to_embed = []
+            for i, task in enumerate(tasks):
+                product_data = task["product_data"]
+                duplicate_of = product_data.get("duplicate_of")
+                if duplicate_of:
+                    embeddings[i] = self._embedding_of(duplicate_of, stored=task.get("duplicate_stored", False))
+                    if embeddings[i]:
+                        self._count(task["stats"], "deduplicated")
                     else:
-                        print(f"  - Dry-run: Image {idx} processed (simulated).")
-                        stats["images_indexed"] += 1
-
-                except Exception as e:
-                    print(f"  - [Image {idx}] ❌ Error: {e}")
-                    stats["failed"] += 1
-                    # Log error
-                    if not self.dry_run:
-                        error_doc = {
-                            "doc_id": doc_id,
-                            "item_id": item_id,
-                            "item_code": item_code,
-                            "error_message": str(e),
-                            "timestamp": time.time()
-                        }
-                        try:
-                            self.db.db.collection(self.config["FIRESTORE_ERRORS_COLLECTION"]).add(error_doc)
-                        except:
-                            pass
+                        product_data["duplicate_of"] = None
+                if not embeddings[i]:
+                    to_embed.append(i)
+            for i, embedding in zip(to_embed, self._embed_many([tasks[i]["prepared"] for i in to_embed])):
+                embeddings[i] = embedding
 
-        return stats
+        results = []
+        for task, embedding in zip(tasks, embeddings):
+            if not self.dry_run and not isinstance(embedding, Exception):
+                if embedding:
+                    self._remember_embedding(task["product_data"]["doc_id"], embedding)
+                else:
+                    embedding = ValueError(f"Failed to generate embedding for image {task['idx']}")
+            task["embedding"] = None if isinstance(embedding, Exception) else embedding
+            # The image bytes are not needed past this point
+            task["prepared"] = None
+            self.memory_budget.release(task["reserved"])
+            task["reserved"] = 0
+            results.append(embedding if isinstance(embedding, Exception) else task)
+        return results
 
-    def run(self, total_limit: int = 500, item_code: Optional[str] = None):
+    def _write_image(self, task: Dict[str, Any]) -> None:
         """
-        Runs the full batch process up to total_limit.
+        Write stage: hands the document to the batched writer.
         """
-        batch_size = 50 # Internal loop batch size (can be smaller than CLI arg for safety)
-        processed_so_far = 0
-        
+        product_data = task["product_data"]
+        # 4. Upsert to Firestore
+        if not self.dry_run:
+            product_data[self.vector_field] = task["embedding"]
+            product_data["embedding_model"] = self.vision.model_key
+            product_data["embedding_dim"] = self.vision.dimension
+            product_data["last_updated"] = time.time()
+            self.writer.upsert_product(product_data)
+        else:
+            print(f"  - Dry-run: Image {task['idx']} processed (simulated).")
+        self._count(task["stats"], "images_indexed")
+        self._tally(task["entry"], "indexed")
+        with self._lock:
+            self._indexed_docs.add(product_data["doc_id"])
+        self._handled(product_data["doc_id"])
+
+    def _handled(self, doc_id: str) -> None:
+        with self._lock:
+            self._handled_docs.add(doc_id)
+
+    def _on_image_error(self, task: Dict[str, Any], error: Exception) -> None:
+        self._record_error(task["doc_id"], task["item_id"], task["item_code"], task["idx"], error, task["stats"])
+        self._tally(task["entry"], "failed")
+
+    def _on_image_done(self, task: Dict[str, Any]) -> None:
+        self.memory_budget.release(task.get("reserved", 0))
+        task["reserved"] = 0
+
+    def retry_failed(self, limit: int = 1000, collection: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Reprocesses only the images behind unresolved error records: groups them by Item,
+        re-fetches just those Items from InRiver and reruns the failed image indexes.
+        Records of images that are now indexed (or found unchanged) are marked resolved; the
+        others, including images that never got that far because their Item could not be
+        fetched, get a later next_retry_at (exponential backoff over retry runs).
+        Writes go to the collection search is serving, or to collection (a rebuild not yet activated);
+        only the error records of that collection are retried.
+        """
+        now = time.time()
+        if collection:
+            self.db.products_collection = collection
+        else:
+            self.db.use_active_collection()
+        self.check_vector_field()
+        self.run_id = f"retry_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        self._failed_docs.clear()
+        self._handled_docs.clear()
+        # Records of this retry are resolved below, not by the batches
+        self._open_errors = {}
+        if not self.dry_run:
+            backfilled = self.db.backfill_error_status()
+            if backfilled:
+                print(f"Marked {backfilled} older error records as unresolved.")
+        records = self.db.get_unresolved_errors(limit, collection=self.db.products_collection)
+        records = [(record_id, data) for record_id, data in records if (data.get("next_retry_at") or 0) <= now]
+        print(f"--- Retrying {len(records)} unresolved error records (run {self.run_id}) ---")
+
+        only_images: Dict[int, Optional[set]] = collections.defaultdict(set)
+        whole_items = set()
+        records_by_doc: Dict[str, List[tuple]] = collections.defaultdict(list)
+        for record_id, data in records:
+            doc_id = data.get("doc_id") or ""
+            match = DOC_ID_PATTERN.match(doc_id)
+            item_match = ITEM_RECORD_PATTERN.match(doc_id)
+            if match:
+                item_id, idx = int(match.group(1)), data.get("image_idx")
+                only_images[item_id].add(int(match.group(2)) if idx is None else int(idx))
+            elif item_match:
+                # The Item could not be fetched: all of its images are processed
+                whole_items.add(int(item_match.group(1)))
+            else:
+                continue
+            records_by_doc[doc_id].append((record_id, data))
+        for item_id in whole_items:
+            only_images[item_id] = None
+
+        stats = collections.Counter()
+        item_ids = sorted(only_images)
+        batch_size = max(1, int(self.config.get("BATCH_SIZE", 500)))
+        for start in range(0, len(item_ids), batch_size):
+            if self._stop.is_set():
+                break
+            stats.update(self.process_batch(item_ids[start:start + batch_size], start_index=start, only_images=only_images))
+        stats.pop("batch_start", None)
+
+        resolved = still_failing = not_reached = 0
+        if self._stop.is_set():
+            # Unprocessed images would look resolved; the next retry run picks all records up again
+            print("Stop requested: error records are left unresolved.")
+        elif not self.dry_run:
+            for doc_id, doc_records in records_by_doc.items():
+                for record_id, data in doc_records:
+                    if doc_id in self._handled_docs and doc_id not in self._failed_docs:
+                        self.writer.update_error(record_id, {"resolved": True, "resolved_at": time.time(),
+                                                             "resolved_by": self.run_id})
+                        resolved += 1
+                        continue
+                    # Back off: 5 minutes, doubling per attempt, at most a day
+                    attempts = int(data.get("attempts") or 1)
+                    self.writer.update_error(record_id, {"next_retry_at": time.time() + min(86400, 300 * 2 ** attempts)})
+                    if doc_id in self._failed_docs:
+                        still_failing += 1
+                    else:
+                        # Its Item (or image) was not fetched, so it was never retried
+                        not_reached += 1
+            self.writer.flush()
+
+        print("\n" + "="*30)
+        print("RETRY COMPLETE")
+        print(f"Items re-fetched: {stats['items_processed']} of {len(item_ids)}")
+        print(f"Images indexed:   {stats['images_indexed']} ({stats['skipped']} unchanged or skipped)")
+        print(f"Resolved:         {resolved}")
+        print(f"Still failing:    {still_failing}")
+        print(f"Not reached:      {not_reached}")
+        print("="*30)
+        return dict(stats, resolved=resolved, still_failing=still_failing, not_reached=not_reached, run_id=self.run_id)
+
+    def run(self, total_limit: int = 500, item_code: Optional[str] = None, resume: bool = False, mode: str = "full",
+            target_collection: Optional[str] = None):
+        """
+        Runs the full batch process up to total_limit Items.
+        InRiver is queried once; the frozen manifest is paged with a cursor and a
+        checkpoint is committed after every batch. With resume=True the last
+        unfinished run continues from its last committed checkpoint.
+        mode is "full", "incremental" or "auto" (see select_mode).
+        Documents go to the collection search is serving, or to target_collection (blue/green rebuild).
+        A sharded processor runs its shard under a run ID derived from the run group, so a
+        retried task continues its own shard; see shard_summary() for the combined result.
+        """
+        batch_size = max(1, int(self.config.get("BATCH_SIZE", 500)))
+
         overall_stats = {
             "total_items_processed": 0,
             "total_images_indexed": 0,
             "total_skipped": 0,
+            "total_not_modified": 0,
+            "total_metadata_updated": 0,
+            "total_deduplicated": 0,
+            "total_orphans_deleted": 0,
             "total_failed": 0,
+            "total_unfetched": 0,
             "start_time": time.time()
         }
 
-        while processed_so_far < total_limit:
-            current_batch_limit = min(batch_size, total_limit - processed_so_far)
-            batch_stats = self.process_batch(processed_so_far, current_batch_limit, item_code=item_code)
-            
+        shard_run_id = None
+        if self.shard_count > 1:
+            if not self.run_group:
+                # Never reuse an earlier group: its completed shards would be skipped
+                self.run_group = f"shards_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+                print(f"No RUN_GROUP (or --run-group) set; this shard runs as group '{self.run_group}'. "
+                      f"Shards only combine when every task uses the same group.")
+            shard_run_id = f"{self.run_group}_shard_{self.shard_index}_of_{self.shard_count}"
+            previous_run = self.db.get_run(shard_run_id)
+            if previous_run and previous_run.get("status") == "completed":
+                print(f"Shard run {shard_run_id} already completed.")
+                return self.shard_summary()
+            if previous_run and previous_run.get("status") != "running":
+                previous_run = None
+        else:
+            previous_run = self.db.get_resumable_run() if resume else None
+        if previous_run and previous_run.get("products_collection"):
+            self.db.products_collection = previous_run["products_collection"]
+        elif target_collection and not previous_run:
+            self.db.products_collection = target_collection
+        else:
+            self.db.use_active_collection()
+        self.check_vector_field()
+
+        if previous_run:
+            run_id = previous_run["run_id"]
+            run_metadata = previous_run
+            manifest = self.db.load_manifest(run_id)
+            position = int(previous_run.get("position", 0))
+            for key, value in (previous_run.get("totals") or {}).items():
+                if key in overall_stats:
+                    overall_stats[key] = value
+            print(f"--- Resuming run {run_id} at position {position}/{len(manifest)} ---")
+        else:
+            if resume:
+                print("No unfinished run found to resume. Starting a new run.")
+            run_id = shard_run_id or f"run_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+            run_mode, modified_since = self.select_mode(mode, item_code=item_code)
+            try:
+                manifest, run_metadata = self.build_manifest(run_id, total_limit, item_code=item_code,
+                                                             mode=run_mode, modified_since=modified_since)
+            except requests.HTTPError as e:
+                if run_mode != "incremental" or mode == "incremental":
+                    raise
+                print(f"Incremental query rejected by InRiver ({e}). Running a full sweep.")
+                manifest, run_metadata = self.build_manifest(run_id, total_limit, item_code=item_code)
+            position = 0
+
+        overall_stats["run_id"] = run_id
+        self.run_id = run_id
+        overall_stats["products_collection"] = self.db.products_collection
+        overall_stats["covers_filter"] = bool(run_metadata.get("covers_filter"))
+        self.inriver.reset_caches()
+        # Open error records by document, resolved as soon as their image is indexed again
+        self._open_errors = collections.defaultdict(list)
+        if not self.dry_run:
+            for record_id, data in self.db.get_unresolved_errors(limit=None, fields=["doc_id"],
+                                                                 collection=self.db.products_collection):
+                self._open_errors[data.get("doc_id") or record_id].append(record_id)
+        if self.phash_index is not None:
+            self.phash_index.clear()
+            self._recent_embeddings.clear()
+
+        while position < len(manifest):
+            page = manifest[position:position + batch_size]
+            batch_stats = self.process_batch(page, start_index=position)
+
             overall_stats["total_items_processed"] += batch_stats["items_processed"]
             overall_stats["total_images_indexed"] += batch_stats["images_indexed"]
             overall_stats["total_skipped"] += batch_stats["skipped"]
+            overall_stats["total_not_modified"] += batch_stats["not_modified"]
+            overall_stats["total_metadata_updated"] += batch_stats["metadata_updated"]
+            overall_stats["total_deduplicated"] += batch_stats["deduplicated"]
+            overall_stats["total_orphans_deleted"] += batch_stats["orphans_deleted"]
             overall_stats["total_failed"] += batch_stats["failed"]
-            
-            processed_so_far += current_batch_limit
-            if batch_stats["items_processed"] < current_batch_limit:
-                # No more items
+            overall_stats["total_unfetched"] += batch_stats["unfetched"]
+
+            if batch_stats["interrupted"]:
+                # Not checkpointed: a resumed run redoes this batch (finished images are skipped by hash)
                 break
-        
+            position += len(page)
+
+            if not self.dry_run:
+                # The checkpoint may only cover writes that are committed
+                self.writer.flush()
+                totals = {k: v for k, v in overall_stats.items() if k.startswith("total_")}
+                self.db.save_checkpoint(run_id, position, batch_stats, totals)
+
+        interrupted = position < len(manifest)
+        overall_stats["interrupted"] = interrupted
+        # A full sweep over the whole filter knows every live Item: remove the rest
+        if (not interrupted and run_metadata.get("mode") == "full" and run_metadata.get("covers_filter")
+                and self.config.get("GC_ENABLED", True)):
+            overall_stats["total_orphans_deleted"] += self.sweep_orphans(manifest)
+
+        self.writer.flush()
+        write_stats = self.writer.stats()
+        overall_stats["total_write_failures"] = write_stats["failed"]
+        if interrupted:
+            print(f"Stopped at checkpoint {position}/{len(manifest)}; continue with --resume.")
+            if not self.dry_run:
+                self.db.update_run(run_id, {"interrupted_at": time.time()})
+        elif not self.dry_run:
+            if overall_stats["total_unfetched"]:
+                # Not ingested, and as the baseline of the next incremental run they would be skipped
+                # until the next full sweep; --retry-failed brings them back through their error records
+                print(f"{overall_stats['total_unfetched']} Items could not be fetched; "
+                      "this run is not a baseline for incremental runs.")
+            self.db.update_run(run_id, {"status": "completed", "finished_at": time.time(),
+                                        "write_failures": write_stats["failed"],
+                                        "items_unfetched": overall_stats["total_unfetched"],
+                                        "totals": {k: v for k, v in overall_stats.items() if k.startswith("total_")}})
+
         overall_stats["end_time"] = time.time()
         duration = overall_stats["end_time"] - overall_stats["start_time"]
         
         print("\n" + "="*30)
-        print("BATCH PROCESSING COMPLETE")
+        print(f"BATCH PROCESSING {'INTERRUPTED' if interrupted else 'COMPLETE'}")
         print(f"Duration: {duration:.2f}s")
         print(f"Items Processed: {overall_stats['total_items_processed']}")
         print(f"Images Indexed:  {overall_stats['total_images_indexed']}")
-        print(f"Skipped:         {overall_stats['total_skipped']}")
-        print(f"Failed:          {overall_stats['total_failed']}")
+        print(f"Skipped:         {overall_stats['total_skipped']} ({overall_stats['total_not_modified']} not modified)")
+        print(f"Metadata only:   {overall_stats['total_metadata_updated']}")
+        print(f"Deduplicated:    {overall_stats['total_deduplicated']}")
+        print(f"Orphans deleted: {overall_stats['total_orphans_deleted']}{' (dry-run, not deleted)' if self.dry_run else ''}")
+        print(f"Failed:          {overall_stats['total_failed']} ({overall_stats['total_unfetched']} Items not fetched)")
+        for name, counters in self.inriver.cache_stats().items():
+            print(f"InRiver cache {name}: {counters['hits']} hits / {counters['misses']} misses")
+        embedding_stats = self.embedder.stats()
+        if embedding_stats["calls"]:
+            print(f"Embedding calls: {embedding_stats['calls']} (p50 {embedding_stats['p50']:.2f}s, "
+                  f"p95 {embedding_stats['p95']:.2f}s), {embedding_stats['retries']} retried, "
+                  f"{embedding_stats['throttle_events']} throttled")
+        if self.embedding_cache:
+            cache_stats = self.embedding_cache.stats()
+            print(f"Embedding cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses ({cache_stats['entries']} stored)")
+        for name, counters in self.pipeline.stats().items():
+            print(f"Stage {name}: {counters['processed']} images, {counters['workers']} workers, "
+                  f"{counters['utilization']:.0%} busy, {counters['errors']} errors")
+        if self.preprocessor.restarts:
+            print(f"Preprocessing pool restarted {self.preprocessor.restarts}x (a worker died)")
+        budget = self.memory_budget.stats()
+        print(f"Image memory: peak {budget['peak'] / 2**20:.0f} of {budget['limit'] / 2**20:.0f} MB "
+              f"(downloads waited {budget['waits']}x)")
+        print(f"Firestore writes: {write_stats['written']} in {write_stats['commits']} commits, "
+              f"{write_stats['retries']} retried, {write_stats['failed']} failed")
+        for failure in self.writer.failures[:10]:
+            print(f"  - {failure}")
+        requests_stats = self.inriver.request_stats()
+        print(f"InRiver requests: {requests_stats['requests_sent']} sent, {requests_stats['retries']} retried, "
+              f"{requests_stats['throttle_events']} throttled")
         print("="*30)
-        
+
+        if self.shard_count > 1 and not self.dry_run:
+            self.shard_summary()
         return overall_stats
+
+    def shard_summary(self, run_group: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Prints the combined progress of every shard of a sharded run and returns the summed totals.
+        Once all shards completed, the combined run is recorded under the run group's ID, so
+        incremental runs and verification see one completed run instead of its shards.
+        """
+        run_group = run_group or self.run_group
+        shards = self.db.get_shard_runs(run_group) if run_group else []
+        shard_count = max([s.get("shard_count", 1) for s in shards] or [self.shard_count])
+        completed = [s for s in shards if s.get("status") == "completed"]
+        totals = collections.Counter()
+        for shard in shards:
+            totals.update({k: v for k, v in (shard.get("totals") or {}).items() if isinstance(v, (int, float))})
+
+        print("\n" + "="*30)
+        print(f"SHARDED RUN {run_group}: {len(completed)} of {shard_count} shards completed")
+        for shard in shards:
+            shard_totals = shard.get("totals") or {}
+            print(f"  Shard {shard.get('shard_index')}/{shard_count}: {shard.get('status')}, "
+                  f"{shard.get('position', 0)}/{shard.get('manifest_size', 0)} Items, "
+                  f"{shard_totals.get('total_images_indexed', 0)} indexed, {shard_totals.get('total_failed', 0)} failed")
+        print(f"Items Processed: {totals['total_items_processed']}")
+        print(f"Images Indexed:  {totals['total_images_indexed']}")
+        print(f"Skipped:         {totals['total_skipped']} ({totals['total_not_modified']} not modified)")
+        print(f"Orphans deleted: {totals['total_orphans_deleted']}")
+        print(f"Failed:          {totals['total_failed']} (+{totals['total_write_failures']} writes)")
+        print("="*30)
+
+        if shards and len(completed) == shard_count and not self.dry_run:
+            started = min(shards, key=lambda s: s.get("started_at") or 0)
+            self.db.update_run(run_group, {
+                "run_id": run_group,
+                "status": "completed",
+                "shards": shard_count,
+                "started_at": started.get("started_at"),
+                "query_started_at": min(s.get("query_started_at") or s.get("started_at") or 0 for s in shards),
+                "finished_at": max(s.get("finished_at") or 0 for s in shards),
+                "mode": "full" if all(s.get("mode") == "full" for s in shards) else "incremental",
+                "covers_filter": all(s.get("covers_filter") for s in shards),
+                "items_unfetched": sum(s.get("items_unfetched") or 0 for s in shards),
+                "item_code": started.get("item_code"),
+                "filter_formula": started.get("filter_formula"),
+                "filter_min_year": started.get("filter_min_year"),
+                "products_collection": started.get("products_collection"),
+                "totals": dict(totals)
+            })
+        return dict(totals, run_id=run_group, shards=shard_count, shards_completed=len(completed))
@@ -1,4 +1,5 @@
 import argparse
+import signal
 import sys
 from batch_processor import BatchProcessor
 
@@ -7,12 +8,80 @@ def main():
     parser.add_argument("--limit", type=int, default=1000, help="Total number of products to process.")
     parser.add_argument("--dry-run", action="store_true", help="Run without writing to Firestore or generating embeddings.")
     parser.add_argument("--item-code", type=str, help="Ingest only a specific item by its ItemCode.")
+    parser.add_argument("--mode", choices=["auto", "full", "incremental"], default="auto",
+                        help="full: walk the whole filter; incremental: only Items modified since the last successful run; "
+                             "auto: incremental, with a full sweep every FULL_SWEEP_INTERVAL_DAYS.")
+    parser.add_argument("--resume", action="store_true", help="Continue the last unfinished run from its last committed checkpoint.")
+    parser.add_argument("--shard", type=str,
+                        help="Process shard i of n (e.g. 0/4) of the Item IDs. Defaults to CLOUD_RUN_TASK_INDEX/CLOUD_RUN_TASK_COUNT.")
+    parser.add_argument("--run-group", type=str,
+                        help="Name shared by the shards of one run (defaults to RUN_GROUP or CLOUD_RUN_EXECUTION).")
+    parser.add_argument("--summary", action="store_true", help="Print the combined progress of the shards of --run-group.")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Reprocess only the images of unresolved error records (up to --limit records) and mark them resolved.")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Blue/green rebuild: run a full sweep into the collection search is not serving, validate it, "
+                             "switch search over and empty the old collection.")
+    parser.add_argument("--keep-old", action="store_true",
+                        help="With --rebuild or --activate: keep the previous collection until the next rebuild.")
+    parser.add_argument("--activate", type=str, metavar="COLLECTION",
+                        help="Validate a collection an earlier rebuild filled and switch search over to it.")
+    parser.add_argument("--collection", type=str,
+                        help="With --retry-failed: repair this collection (e.g. a rebuild not yet activated) "
+                             "instead of the one search is serving.")
+    parser.add_argument("--migrate-embeddings", action="store_true",
+                        help="Re-embed the stored image URLs of all product documents with EMBEDDING_BACKEND "
+                             "into its own vector field, then switch search over (no InRiver crawl).")
+    parser.add_argument("--no-cutover", action="store_true", help="With --migrate-embeddings: do not switch search to the new field.")
+    parser.add_argument("--cutover", action="store_true", help="Only switch search to the vector field of EMBEDDING_BACKEND.")
     
     args = parser.parse_args()
+
+    shard_index = shard_count = None
+    if args.shard:
+        try:
+            shard_index, shard_count = (int(part) for part in args.shard.split("/"))
+        except ValueError:
+            parser.error("--shard expects i/n, e.g. 0/4")
     
-    processor = BatchProcessor(dry_run=args.dry_run)
+    processor = BatchProcessor(dry_run=args.dry_run, shard_index=shard_index, shard_count=shard_count)
+    if args.run_group:
+        processor.run_group = args.run_group
+    if args.shard and processor.shard_count > 1 and not processor.run_group:
+        parser.error("--shard needs --run-group (or RUN_GROUP) so the shards share one run")
+    if processor.shard_count > 1 and (args.migrate_embeddings or args.cutover or args.retry_failed or args.rebuild
+                                     or args.activate):
+        parser.error("sharding only applies to ingestion runs")
+    if args.collection and not args.retry_failed:
+        parser.error("--collection only applies to --retry-failed")
+    # Cloud Run sends SIGTERM before stopping a task: drain in-flight images, keep the last checkpoint
+    signal.signal(signal.SIGTERM, processor.request_stop)
     try:
-        processor.run(total_limit=args.limit, item_code=args.item_code)
+        if args.migrate_embeddings or args.cutover:
+            from embedding_migration import EmbeddingMigration
+            migration = EmbeddingMigration(processor)
+            if args.cutover:
+                migration.cutover()
+            else:
+                migration.run(resume=args.resume, cutover=not args.no_cutover)
+            return
+        if args.summary:
+            if not processor.run_group:
+                parser.error("--summary needs --run-group (or RUN_GROUP)")
+            processor.shard_summary()
+            return
+        if args.retry_failed:
+            processor.retry_failed(limit=args.limit, collection=args.collection)
+            return
+        if args.rebuild or args.activate:
+            from collection_rebuild import CollectionRebuild
+            rebuild = CollectionRebuild(processor)
+            if args.activate:
+                rebuild.activate(args.activate, keep_old=args.keep_old)
+            else:
+                rebuild.run(total_limit=args.limit, resume=args.resume, keep_old=args.keep_old)
+            return
+        processor.run(total_limit=args.limit, item_code=args.item_code, resume=args.resume, mode=args.mode)
     except Exception as e:
         print(f"FATAL ERROR: {e}")
         sys.exit(1)
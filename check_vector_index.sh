@@ -1,20 +1,33 @@
 #!/bin/bash
 # Quick script to check Firestore vector index status
+# Blue/green rebuilds write into products_blue / products_green (REBUILD_COLLECTIONS):
+# both need their vector index before the first rebuild.
+
+COLLECTIONS="products products_blue products_green"
 
 echo "Checking Firestore vector indexes for project: ecom-agents"
 echo ""
 
-gcloud firestore indexes composite list \
-  --project=ecom-agents \
-  --format="table(name,state,queryScope,fields)" \
-  --filter="collectionGroup:products"
+for collection in $COLLECTIONS; do
+  echo "Collection: $collection"
+  gcloud firestore indexes composite list \
+    --project=ecom-agents \
+    --database=product \
+    --format="table(name,state,queryScope,fields)" \
+    --filter="collectionGroup:$collection"
+  echo ""
+done
 
-echo ""
 echo "Looking for vector index with:"
-echo "  - Collection: products"
+echo "  - Collection: each of: $COLLECTIONS"
 echo "  - Field: embedding"
 echo "  - Type: VECTOR (dimension 1408)"
 echo ""
+echo "Create a missing one (once per collection) with:"
+echo "  gcloud firestore indexes composite create --project=ecom-agents --database=product \\"
+echo "    --collection-group=<collection> --query-scope=COLLECTION \\"
+echo "    --field-config=field-path=embedding,vector-config='{\"dimension\":\"1408\",\"flat\":\"{}\"}'"
+echo ""
 echo "Status meanings:"
 echo "  CREATING - Index is being built (can take 10-30 min)"
 echo "  READY    - Index is ready for use"
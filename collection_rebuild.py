@@ -0,0 +1,173 @@
+import time
+from typing import Any, Dict, Optional, Tuple
+from batch_processor import ITEM_RECORD_PATTERN
+
+class CollectionRebuild:
+    """
+    Blue/green rebuild of the products collection.
+    Rebuilds alternate between two fixed collections (REBUILD_COLLECTIONS), so their
+    vector indexes are created once, ahead of time. A full ingestion run writes into
+    the one search is not serving (emptied first) while search keeps serving the other.
+    The shadow collection is validated (complete run, no failures, document count, a
+    working vector index) and then made active with one write to the search config;
+    search picks it up within SEARCH_CONFIG_TTL. The previous collection is emptied
+    in bulk afterwards.
+    """
+    def __init__(self, processor: Any):
+        self.processor = processor
+        self.db = processor.db
+        self.config = processor.config
+
+    def collection_pair(self) -> Tuple[str, str]:
+        """
+        Returns the two collections rebuilds alternate between: REBUILD_COLLECTIONS, or
+        <products>_blue and <products>_green.
+        """
+        names = [name.strip() for name in self.config.get("REBUILD_COLLECTIONS", "").split(",") if name.strip()]
+        if not names:
+            base = self.db.default_products_collection
+            names = [f"{base}_blue", f"{base}_green"]
+        if len(names) != 2 or names[0] == names[1]:
+            raise ValueError(f"REBUILD_COLLECTIONS needs two different collection names, got {names}")
+        return names[0], names[1]
+
+    def shadow_for(self, active: str) -> str:
+        """
+        The collection of the pair that search is not serving.
+        """
+        blue, green = self.collection_pair()
+        return green if active == blue else blue
+
+    def validate(self, shadow: str, active: str, run_stats: Dict[str, Any]) -> Optional[str]:
+        """
+        Returns the reason the shadow collection must not go live, or None when it may.
+        """
+        if run_stats.get("interrupted"):
+            return "the run was interrupted (continue it with --rebuild --resume)"
+        if not run_stats.get("covers_filter"):
+            return "the run did not cover the whole InRiver filter (raise --limit)"
+        if run_stats.get("total_failed") or run_stats.get("total_write_failures"):
+            return (f"{run_stats.get('total_failed', 0)} images and {run_stats.get('total_write_failures', 0)} writes failed "
+                    f"(repair them with --retry-failed --collection {shadow}, then --activate {shadow})")
+
+        shadow_count = self.db.count_products(shadow)
+        active_count = self.db.count_products(active)
+        min_ratio = self.config.get("REBUILD_MIN_COUNT_RATIO", 0.9)
+        print(f"Validation: {shadow_count} documents in {shadow}, {active_count} in {active}")
+        if not shadow_count:
+            return f"{shadow} is empty"
+        if shadow_count < min_ratio * active_count:
+            return f"{shadow} holds fewer than {min_ratio:.0%} of the documents in {active}"
+
+        try:
+            self.db.probe_vector_index(self.processor.vector_field, shadow)
+        except Exception as e:
+            return f"vector query on {shadow}.{self.processor.vector_field} failed ({e}); create its vector index first"
+        return None
+
+    def cutover(self, shadow: str, previous: str) -> None:
+        """
+        Makes the shadow collection (and this backend's vector field) the one search serves.
+        """
+        backend = self.processor.vision
+        self.db.set_search_config({
+            "products_collection": shadow,
+            "previous_collection": previous,
+            "embedding_field": self.processor.vector_field,
+            "embedding_model": backend.model_key,
+            "embedding_dim": backend.dimension
+        })
+        print(f"Search now serves '{shadow}' (was '{previous}').")
+
+    def run(self, total_limit: int, resume: bool = False, keep_old: bool = False) -> Dict[str, Any]:
+        active = self.db.use_active_collection()
+        shadow = self.shadow_for(active)
+        if self.processor.dry_run:
+            print(f"Dry-run: a rebuild would write into {shadow}; running a dry full sweep instead.")
+            return self.processor.run(total_limit=total_limit, resume=resume, mode="full")
+
+        # Only an unfinished run into the shadow collection is continued
+        unfinished = self.db.get_resumable_run() if resume else None
+        if resume and not (unfinished and unfinished.get("products_collection") == shadow):
+            if self._completed_rebuild(shadow, active):
+                print(f"{shadow} holds a completed rebuild that was never activated.")
+                return self.activate(shadow, keep_old=keep_old)
+            print(f"No unfinished rebuild into {shadow} found. Starting a new one.")
+            resume = False
+        if not resume:
+            # Left over from an earlier rebuild (--keep-old, or one that was not activated)
+            deleted = self.db.clear_collection(shadow)
+            if deleted:
+                print(f"Emptied {shadow} ({deleted} documents from an earlier rebuild).")
+
+        print(f"--- Blue/green rebuild: writing into {shadow} while search serves {active} ---")
+        run_stats = self.processor.run(total_limit=total_limit, resume=resume, mode="full", target_collection=shadow)
+        return self._switch(shadow, active, run_stats, self.validate(shadow, active, run_stats), keep_old)
+
+    def activate(self, collection: str, keep_old: bool = False) -> Dict[str, Any]:
+        """
+        Validates a collection an earlier rebuild filled and makes it the one search serves.
+        Failures count from its ingestion ledger and the open records of Items that could not be
+        fetched instead of the run, so what --retry-failed --collection repaired since no longer blocks it.
+        """
+        active = self.db.use_active_collection()
+        if collection == active:
+            print(f"Search already serves '{collection}'.")
+            return {"products_collection": collection, "activated": True}
+        run = self._completed_rebuild(collection, active)
+        if not run:
+            print(f"'{collection}' NOT activated: it holds no completed full sweep newer than the one in {active}.")
+            return {"products_collection": collection, "activated": False}
+
+        ledger = self.db.ledger_counts(collection)
+        run_stats = dict(run.get("totals") or {}, run_id=run.get("run_id"), products_collection=collection,
+                         covers_filter=True, total_failed=0, total_write_failures=0)
+        problem = None
+        records = self.db.get_unresolved_errors(limit=None, fields=["doc_id"], collection=collection)
+        unfetched = [record_id for record_id, data in records if ITEM_RECORD_PATTERN.match(data.get("doc_id") or "")]
+        if unfetched:
+            problem = f"{len(unfetched)} Items could not be fetched (repair them with --retry-failed --collection {collection})"
+        elif ledger["failed"] or ledger["partial"]:
+            problem = (f"{ledger['failed'] + ledger['partial']} Items still have failed images "
+                       f"(repair them with --retry-failed --collection {collection})")
+        return self._switch(collection, active, run_stats, problem or self.validate(collection, active, run_stats), keep_old)
+
+    def _completed_rebuild(self, collection: str, active: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the last completed full sweep into collection when it started after the last
+        one into the active collection (so it is not the collection search switched away from), else None.
+        """
+        run = self.db.get_last_completed_run(full_only=True, collection=collection, include_unfetched=True)
+        serving = self.db.get_last_completed_run(full_only=True, collection=active, include_unfetched=True)
+        if run and (not serving or (run.get("started_at") or 0) > (serving.get("started_at") or 0)):
+            return run
+        return None
+
+    def _switch(self, shadow: str, active: str, run_stats: Dict[str, Any], problem: Optional[str],
+                keep_old: bool) -> Dict[str, Any]:
+        """
+        Cuts over to the validated shadow collection and empties the previous one (unless keep_old).
+        """
+        if problem:
+            print(f"Rebuild NOT activated: {problem}. {shadow} is kept for inspection; search still serves {active}.")
+            run_stats["activated"] = False
+            return run_stats
+
+        if self.processor.dry_run:
+            print(f"Dry-run: {shadow} passed validation; search still serves {active}.")
+            run_stats["activated"] = False
+            return run_stats
+
+        self.cutover(shadow, active)
+        run_stats["activated"] = True
+        if keep_old:
+            print(f"Keeping {active} (--keep-old) until the next rebuild; switch back with the search config if needed.")
+            return run_stats
+
+        # Give searchers holding the old config time to pick up the new one
+        grace = self.config.get("SEARCH_CONFIG_TTL", 60) * 2
+        print(f"Emptying {active} in {grace:.0f}s...")
+        time.sleep(grace)
+        deleted = self.db.clear_collection(active)
+        print(f"Emptied {active} ({deleted} documents).")
+        return run_stats
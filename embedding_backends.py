@@ -0,0 +1,155 @@
+import abc
+import hashlib
+import io
+import re
+import threading
+from typing import Dict, List, Optional
+import numpy as np
+
+class EmbeddingBackend(abc.ABC):
+    """
+    Interface of an image embedding model.
+    model_name and model_version identify the vectors (together with dimension) in
+    caches and stored documents; embed_batch() lets backends that can batch do so.
+    """
+    name = "base"
+    model_name = ""
+    model_version = "1"
+    dimension = 0
+    max_batch_size = 1
+
+    @property
+    def model_key(self) -> str:
+        return self.model_name
+
+    @abc.abstractmethod
+    def embed(self, image_bytes: bytes, contextual_text: Optional[str] = None) -> List[float]:
+        """
+        Returns the embedding of one image and raises on errors.
+        """
+
+    def embed_batch(self, images: List[bytes]) -> List[List[float]]:
+        """
+        Embeds several images; results keep the input order.
+        """
+        return [self.embed(image_bytes) for image_bytes in images]
+
+    def get_embedding(self, image_bytes: bytes) -> Optional[List[float]]:
+        """
+        Like embed(), but returns None on any error.
+        """
+        try:
+            if not image_bytes:
+                return None
+            return self.embed(image_bytes)
+        except Exception as e:
+            print(f"Error generating embedding: {e}")
+            return None
+
+class LocalHashEmbeddingBackend(EmbeddingBackend):
+    """
+    Deterministic offline backend: a unit vector seeded by the SHA256 of the image
+    (and contextual text). Identical bytes give identical vectors, there is no
+    network round trip, and the default dimension matches the Firestore vector index.
+    Meant for throughput measurements and dry rebuilds, not for search quality.
+    """
+    name = "local"
+    model_name = "local-hash"
+    max_batch_size = 256
+
+    def __init__(self, dimension: int = 1408):
+        self.dimension = dimension
+
+    def embed(self, image_bytes: bytes, contextual_text: Optional[str] = None) -> List[float]:
+        if not image_bytes:
+            raise ValueError("No image bytes to embed")
+        digest = hashlib.sha256(image_bytes)
+        if contextual_text:
+            digest.update(contextual_text.encode("utf-8"))
+        rng = np.random.default_rng(int.from_bytes(digest.digest()[:8], "little"))
+        vector = rng.standard_normal(self.dimension).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+class OpenClipEmbeddingBackend(EmbeddingBackend):
+    """
+    CPU-only open model (OpenCLIP). Requires the optional 'open_clip_torch' and 'torch'
+    packages. Its vectors have the model's own dimension (e.g. 512 for ViT-B-32), so
+    they need their own collection and vector index.
+    """
+    name = "open_clip"
+    max_batch_size = 32
+
+    def __init__(self, model: str = "ViT-B-32", pretrained: str = "laion2b_s34b_b79k"):
+        try:
+            import open_clip
+            import torch
+        except ImportError as e:
+            raise ImportError("EMBEDDING_BACKEND=open_clip requires 'open_clip_torch' and 'torch'") from e
+
+        self._torch = torch
+        self.model_name = f"open_clip/{model}"
+        self.model_version = pretrained
+        self._model, _, self._preprocess = open_clip.create_model_and_transforms(model, pretrained=pretrained, device="cpu")
+        self._model.eval()
+        self._tokenizer = open_clip.get_tokenizer(model)
+        self.dimension = self._model.visual.output_dim
+        # torch releases the GIL but one forward pass at a time keeps memory predictable
+        self._lock = threading.Lock()
+
+    @property
+    def model_key(self) -> str:
+        return f"{self.model_name}@{self.model_version}"
+
+    def _load(self, image_bytes: bytes):
+        from PIL import Image as PILImage
+        with PILImage.open(io.BytesIO(image_bytes)) as img:
+            return self._preprocess(img.convert("RGB"))
+
+    def embed(self, image_bytes: bytes, contextual_text: Optional[str] = None) -> List[float]:
+        # Contextual text is not part of a CLIP image embedding; it is ignored
+        return self.embed_batch([image_bytes])[0]
+
+    def embed_batch(self, images: List[bytes]) -> List[List[float]]:
+        torch = self._torch
+        vectors = []
+        for start in range(0, len(images), self.max_batch_size):
+            pixels = torch.stack([self._load(image_bytes) for image_bytes in images[start:start + self.max_batch_size]])
+            with self._lock, torch.no_grad():
+                features = self._model.encode_image(pixels)
+            features = features / features.norm(dim=-1, keepdim=True)
+            vectors.extend(features.tolist())
+        return vectors
+
+BACKENDS = ("vertex", "local", "open_clip")
+
+# Vectors of the original model stay in the legacy 'embedding' field
+LEGACY_VECTOR_FIELD = "embedding"
+LEGACY_MODEL = ("multimodalembedding@001", 1408)
+
+def vector_field_for(backend: EmbeddingBackend) -> str:
+    """
+    Returns the Firestore field holding this backend's vectors, e.g.
+    'embedding_local_hash_1408'. Each model/dimension gets its own (versioned) field,
+    so a new model can be indexed next to the one search is using.
+    """
+    if (backend.model_key, backend.dimension) == LEGACY_MODEL:
+        return LEGACY_VECTOR_FIELD
+    slug = re.sub(r"[^a-z0-9]+", "_", backend.model_key.lower()).strip("_")
+    return f"embedding_{slug}_{backend.dimension}"
+
+def get_embedding_backend(config: Dict, location: Optional[str] = None,
+                          request_timeout: Optional[float] = None) -> EmbeddingBackend:
+    """
+    Creates the backend selected by EMBEDDING_BACKEND (vertex, local or open_clip).
+    location and request_timeout (seconds per request) only apply to Vertex.
+    """
+    backend = config.get("EMBEDDING_BACKEND", "vertex")
+    if backend == "vertex":
+        from vision_client import VisionEmbeddingGenerator
+        return VisionEmbeddingGenerator(location=location, request_timeout=request_timeout)
+    if backend == "local":
+        return LocalHashEmbeddingBackend(dimension=config.get("LOCAL_EMBEDDING_DIMENSION", 1408))
+    if backend == "open_clip":
+        return OpenClipEmbeddingBackend(model=config.get("OPEN_CLIP_MODEL", "ViT-B-32"),
+                                        pretrained=config.get("OPEN_CLIP_PRETRAINED", "laion2b_s34b_b79k"))
+    raise ValueError(f"Unknown EMBEDDING_BACKEND '{backend}' (expected one of {', '.join(BACKENDS)})")
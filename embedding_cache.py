@@ -0,0 +1,120 @@
+import array
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+class EmbeddingCache:
+    """
+    Local, persistent, content-addressed embedding store.
+    Vectors are keyed by (image SHA256, model key, dimension) and stored as packed
+    little-endian float32 blobs in SQLite. When the store grows beyond max_bytes the
+    least recently used vectors are evicted.
+    """
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " image_hash TEXT NOT NULL, model TEXT NOT NULL, dimension INTEGER NOT NULL,"
+            " vector BLOB NOT NULL, last_access REAL NOT NULL,"
+            " PRIMARY KEY (image_hash, model, dimension)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _pack(embedding: List[float]) -> bytes:
+        vector = array.array("f", embedding)
+        if sys.byteorder == "big":
+            vector.byteswap()
+        return vector.tobytes()
+
+    @staticmethod
+    def _unpack(blob: bytes) -> List[float]:
+        vector = array.array("f")
+        vector.frombytes(blob)
+        if sys.byteorder == "big":
+            vector.byteswap()
+        return vector.tolist()
+
+    def get(self, image_hash: str, model: str, dimension: int) -> Optional[List[float]]:
+        key = (image_hash, model, dimension)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM embeddings WHERE image_hash = ? AND model = ? AND dimension = ?", key
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE embeddings SET last_access = ? WHERE image_hash = ? AND model = ? AND dimension = ?",
+                (time.time(),) + key
+            )
+            self._conn.commit()
+        return self._unpack(row[0])
+
+    def put(self, image_hash: str, model: str, dimension: int, embedding: List[float]) -> None:
+        blob = self._pack(embedding)
+        with self._lock:
+            previous = self._conn.execute(
+                "SELECT LENGTH(vector) FROM embeddings WHERE image_hash = ? AND model = ? AND dimension = ?",
+                (image_hash, model, dimension)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (image_hash, model, dimension, vector, last_access) VALUES (?, ?, ?, ?, ?)",
+                (image_hash, model, dimension, blob, time.time())
+            )
+            self._size += len(blob) - (previous[0] if previous else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        # Drop least recently used vectors until the store is back under 90% of its budget
+        target = int(self.max_bytes * 0.9)
+        while self._size > target:
+            rows = self._conn.execute(
+                "SELECT image_hash, model, dimension, LENGTH(vector) FROM embeddings ORDER BY last_access LIMIT 256"
+            ).fetchall()
+            if not rows:
+                break
+            for image_hash, model, dimension, size in rows:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE image_hash = ? AND model = ? AND dimension = ?",
+                    (image_hash, model, dimension)
+                )
+                self._size -= size
+                if self._size <= target:
+                    break
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "entries": count, "bytes": self._size}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+def open_embedding_cache(config: Dict) -> Optional[EmbeddingCache]:
+    """
+    Opens the configured embedding cache, or returns None when EMBEDDING_CACHE_PATH is empty.
+    """
+    path = config.get("EMBEDDING_CACHE_PATH")
+    if not path:
+        return None
+    return EmbeddingCache(path, max_bytes=config.get("EMBEDDING_CACHE_MAX_MB", 512) * 1024 * 1024)
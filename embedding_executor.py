@@ -0,0 +1,83 @@
+import concurrent.futures
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from google.api_core import exceptions as google_exceptions
+from throttling import AdaptiveLimiter, LatencyTracker, backoff_delay
+
+# Quota / overload errors: retried, and they shrink the concurrency limit
+THROTTLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+)
+# Transient errors that are retried without counting as throttling
+TRANSIENT_ERRORS = (
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+)
+
+class EmbeddingExecutor:
+    """
+    Runs embedding calls concurrently under an AIMD limit tuned to the Vertex quota.
+    429 / UNAVAILABLE responses halve the limit and are retried with jittered
+    exponential backoff; every call's latency is tracked.
+    """
+    def __init__(self, max_concurrency: int = 8, max_retries: int = 5):
+        self.max_retries = max_retries
+        self.limiter = AdaptiveLimiter(max_limit=max_concurrency, initial=max(1, max_concurrency // 2))
+        self.latency = LatencyTracker()
+        self.retries = 0
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="embedding")
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Calls fn (e.g. VisionEmbeddingGenerator.embed) within the limit, retrying
+        throttled and transient failures. Other errors are raised immediately.
+        """
+        attempt = 0
+        while True:
+            with self.limiter:
+                started = time.monotonic()
+                try:
+                    result = fn(*args, **kwargs)
+                except THROTTLE_ERRORS + TRANSIENT_ERRORS as e:
+                    self.latency.record_error()
+                    if isinstance(e, THROTTLE_ERRORS):
+                        self.limiter.on_throttle()
+                    if attempt >= self.max_retries:
+                        raise
+                    error = e
+                else:
+                    self.latency.record(time.monotonic() - started)
+                    self.limiter.on_success()
+                    return result
+
+            delay = backoff_delay(attempt, base=1.0, cap=60.0)
+            print(f"  - Embedding call failed ({type(error).__name__}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            with self._lock:
+                self.retries += 1
+            attempt += 1
+            time.sleep(delay)
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> concurrent.futures.Future:
+        """
+        Schedules call(fn, ...) on the executor's own threads.
+        """
+        return self._executor.submit(self.call, fn, *args, **kwargs)
+
+    def map(self, fn: Callable[..., Any], inputs: List[Any]) -> List[Any]:
+        """
+        Calls fn for every input concurrently; results keep the input order.
+        """
+        return [future.result() for future in [self.submit(fn, value) for value in inputs]]
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        counters = dict(self.latency.summary(), retries=self.retries)
+        counters.update(self.limiter.stats())
+        return counters
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,187 @@
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+from batch_processor import DOC_ID_PATTERN
+
+# Fields read per product document; the vectors themselves are never loaded
+MIGRATION_FIELDS = ["image_url", "image_hash", "item_id", "item_code", "embedding_model", "embedding_dim"]
+
+class EmbeddingMigration:
+    """
+    Re-embeds the images of existing product documents with the processor's current
+    embedding backend, without crawling InRiver. Vectors go into the backend's own
+    versioned field (next to the one search is using), each document records
+    embedding_model / embedding_dim, progress is checkpointed as a document-ID cursor,
+    and search is switched over in one write to the search config once every document is done.
+    Images are embedded in batches when the backend supports it (max_batch_size).
+    Reuses the BatchProcessor's backend, embedding executor and cache, downloader and preprocessor.
+    """
+    def __init__(self, processor: Any):
+        self.processor = processor
+        self.db = processor.db
+        self.backend = processor.vision
+        self.target_field = processor.vector_field
+        self.dry_run = processor.dry_run
+
+    def _is_migrated(self, data: Dict[str, Any]) -> bool:
+        return data.get("embedding_model") == self.backend.model_key and data.get("embedding_dim") == self.backend.dimension
+
+    def _prepare_doc(self, doc_id: str, data: Dict[str, Any], stats: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Returns what is needed to re-embed one document: its cached embedding, or its downloaded
+        and preprocessed image. None when the document is skipped or failed.
+        """
+        processor = self.processor
+        image_url = data.get("image_url")
+        if self._is_migrated(data) or not image_url:
+            processor._count(stats, "skipped")
+            return None
+        try:
+            # Unchanged images are re-embedded from the local cache without downloading them
+            embedding = None
+            if processor.embedding_cache and data.get("image_hash"):
+                embedding = processor.embedding_cache.get(data["image_hash"], processor.embedding_model_key, self.backend.dimension)
+            if embedding:
+                processor._count(stats, "cached")
+                return {"doc_id": doc_id, "data": data, "embedding": embedding}
+
+            download = processor.downloader.fetch(image_url)
+            if not download.content:
+                raise ValueError(f"Could not download {image_url}")
+            prepared = processor.preprocessor.process(download.content)
+            if not prepared:
+                raise ValueError(f"Invalid image format at {image_url}")
+            if prepared["image_hash"] != data.get("image_hash"):
+                # The next ingestion run will refresh the rest of the document
+                processor._count(stats, "changed")
+            return {"doc_id": doc_id, "data": data, "prepared": prepared}
+        except Exception as e:
+            self._record_error(doc_id, data, e, stats)
+            return None
+
+    def _record_error(self, doc_id: str, data: Dict[str, Any], error: Exception, stats: Dict[str, Any]) -> None:
+        # The retry queue reprocesses the image index and Item taken from the document ID
+        match = DOC_ID_PATTERN.match(doc_id)
+        item_id, idx = (int(match.group(1)), int(match.group(2))) if match else (data.get("item_id"), 0)
+        self.processor._record_error(doc_id, item_id, data.get("item_code", "N/A"), idx, error, stats)
+
+    def _migrate_page(self, page: List[Tuple[str, Dict[str, Any]]], stats: Dict[str, Any]) -> None:
+        """
+        Downloads and preprocesses a page of documents concurrently, then embeds the ones
+        without a cached embedding in batches (see BatchProcessor._embed_many) and writes them.
+        """
+        processor = self.processor
+        futures = [processor.io_executor.submit(self._prepare_doc, doc_id, data, stats) for doc_id, data in page]
+        docs = [doc for doc in (future.result() for future in futures) if doc]
+
+        to_embed = [doc for doc in docs if "prepared" in doc]
+        if not self.dry_run:
+            for doc, embedding in zip(to_embed, processor._embed_many([doc["prepared"] for doc in to_embed])):
+                doc["embedding"] = embedding
+
+        for doc in docs:
+            embedding = doc.get("embedding")
+            if isinstance(embedding, Exception):
+                self._record_error(doc["doc_id"], doc["data"], embedding, stats)
+                continue
+            if not self.dry_run:
+                processor.writer.upsert_product({
+                    "doc_id": doc["doc_id"],
+                    self.target_field: embedding,
+                    "embedding_model": self.backend.model_key,
+                    "embedding_dim": self.backend.dimension
+                })
+            processor._count(stats, "migrated")
+
+    def cutover(self, run_id: Optional[str] = None) -> None:
+        """
+        Points search at the target vector field (one document write).
+        """
+        search_config = {
+            "embedding_field": self.target_field,
+            "embedding_model": self.backend.model_key,
+            "embedding_dim": self.backend.dimension,
+            "embedding_backend": self.backend.name
+        }
+        if run_id:
+            search_config["migration_run_id"] = run_id
+        self.db.set_search_config(search_config)
+        print(f"Search now uses '{self.target_field}' ({self.backend.model_key}, {self.backend.dimension} dims).")
+
+    def run(self, resume: bool = False, cutover: bool = True) -> Dict[str, Any]:
+        """
+        Streams all product documents in ID order and re-embeds them concurrently.
+        With resume=True an unfinished migration to the same field continues from its cursor.
+        """
+        page_size = max(1, int(self.processor.config.get("BATCH_SIZE", 500)))
+        self.db.use_active_collection()
+        totals = {"migrated": 0, "cached": 0, "changed": 0, "skipped": 0, "failed": 0}
+        start_time = time.time()
+
+        previous = self.db.get_resumable_run(kind="migration") if resume else None
+        if previous and previous.get("target_field") == self.target_field:
+            run_id = previous["run_id"]
+            cursor = previous.get("cursor")
+            totals.update(previous.get("totals") or {})
+            print(f"--- Resuming migration {run_id} after document {cursor} ---")
+        else:
+            if resume:
+                print("No unfinished migration to this field found. Starting a new one.")
+            run_id = f"migration_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+            cursor = None
+            if not self.dry_run:
+                self.db.update_run(run_id, {
+                    "run_id": run_id,
+                    "kind": "migration",
+                    "status": "running",
+                    "started_at": start_time,
+                    "target_field": self.target_field,
+                    "embedding_model": self.backend.model_key,
+                    "embedding_dim": self.backend.dimension
+                })
+        print(f"--- Migrating embeddings to '{self.target_field}' ({self.backend.model_key}, {self.backend.dimension} dims) ---")
+
+        while True:
+            page = self.db.get_products_page(MIGRATION_FIELDS, page_size, start_after=cursor)
+            if not page:
+                break
+            stats = {key: 0 for key in totals}
+            self._migrate_page(page, stats)
+            if not self.dry_run:
+                # Documents whose commit failed are not migrated
+                self.processor.writer.flush()
+                page_data = dict(page)
+                for doc_id, error in self.processor.writer.take_failed_products():
+                    stats["migrated"] -= 1
+                    self._record_error(doc_id, page_data.get(doc_id, {}), RuntimeError(f"Firestore write failed: {error}"), stats)
+
+            for key, value in stats.items():
+                totals[key] += value
+            cursor = page[-1][0]
+            print(f"  Migrated up to {cursor}: {stats['migrated']} re-embedded ({stats['cached']} from cache), "
+                  f"{stats['skipped']} skipped, {stats['failed']} failed")
+            if not self.dry_run:
+                self.processor.writer.flush()
+                self.db.update_run(run_id, {"cursor": cursor, "totals": totals, "last_checkpoint_at": time.time()})
+
+        self.processor.writer.flush()
+        write_stats = self.processor.writer.stats()
+        # Failed product writes are already counted per document; this also covers error records
+        totals["write_failures"] = write_stats["failed"]
+        if not self.dry_run:
+            self.db.update_run(run_id, {"status": "completed", "finished_at": time.time(), "totals": totals})
+            if cutover and not totals["failed"] and not totals["write_failures"]:
+                print(f"Requires a READY vector index on '{self.target_field}' (dimension {self.backend.dimension}), see check_vector_index.sh.")
+                self.cutover(run_id)
+            elif cutover:
+                print(f"{totals['failed']} documents and {totals['write_failures']} writes failed; search was not switched. "
+                      "Re-run the migration to retry them (migrated documents are skipped).")
+
+        print("\n" + "="*30)
+        print("EMBEDDING MIGRATION COMPLETE")
+        print(f"Duration: {time.time() - start_time:.2f}s")
+        print(f"Re-embedded:     {totals['migrated']} ({totals['cached']} from cache, {totals['changed']} changed images)")
+        print(f"Skipped:         {totals['skipped']}")
+        print(f"Failed:          {totals['failed']}")
+        print("="*30)
+        return dict(totals, run_id=run_id)
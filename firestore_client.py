@@ -1,7 +1,32 @@
+import concurrent.futures
+import threading
+import time
+from google.api_core import exceptions as google_exceptions
 from google.cloud import firestore
 from google.cloud.firestore_v1.vector import Vector
-from typing import Optional, Dict, Any
+from google.cloud.firestore_v1.base_query import FieldFilter
+from typing import Optional, Dict, Any, List, Tuple
 from app_config import get_config
+from throttling import backoff_delay
+
+# Values per 'in' filter and document references per get_all call
+IN_FILTER_LIMIT = 30
+GET_ALL_CHUNK_SIZE = 300
+
+# Firestore accepts at most 500 writes per commit
+MAX_WRITES_PER_COMMIT = 500
+
+# Commit errors worth retrying (contention, overload, timeouts)
+RETRYABLE_WRITE_ERRORS = (
+    google_exceptions.Aborted,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+)
+
+# Entity IDs stored per manifest chunk document (keeps each doc well below the 1 MiB limit)
+MANIFEST_CHUNK_SIZE = 10000
 
 class FirestoreClient:
     def __init__(self):
@@ -9,8 +34,11 @@ class FirestoreClient:
         self.project_id = config.get("GOOGLE_CLOUD_PROJECT")
         self.database = config.get("FIRESTORE_DATABASE", "product")
         self.products_collection = config.get("FIRESTORE_PRODUCTS_COLLECTION", "products")
+        self.default_products_collection = self.products_collection
         self.progress_collection = config.get("FIRESTORE_PROGRESS_COLLECTION", "batchProgress")
         self.errors_collection = config.get("FIRESTORE_ERRORS_COLLECTION", "processingErrors")
+        self.config_collection = config.get("FIRESTORE_CONFIG_COLLECTION", "searchConfig")
+        self.ledger_collection = config.get("FIRESTORE_LEDGER_COLLECTION", "ingestionLedger")
         
         self.db = firestore.Client(project=self.project_id, database=self.database)
 
@@ -24,10 +52,38 @@ class FirestoreClient:
             return doc.to_dict()
         return None
 
-    def upsert_product(self, product_data: Dict[str, Any]) -> None:
+    def get_products(self, doc_ids: List[str], fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
         """
-        Upserts (creates or updates) a product document.
-        product_data must contain 'doc_id', 'entity_id' or 'id' to be used as document key.
+        Reads several product documents in batched get_all calls, optionally only the given fields.
+        Returns {doc_id: data} for the documents that exist.
+        """
+        collection = self.db.collection(self.products_collection)
+        refs = [collection.document(str(doc_id)) for doc_id in doc_ids]
+        products = {}
+        for start in range(0, len(refs), GET_ALL_CHUNK_SIZE):
+            for snapshot in self.db.get_all(refs[start:start + GET_ALL_CHUNK_SIZE], field_paths=fields):
+                if snapshot.exists:
+                    products[snapshot.id] = snapshot.to_dict() or {}
+        return products
+
+    def get_products_by_item(self, item_ids: List[int], fields: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Reads the given fields of every image document of the given Items
+        ('in' queries on item_id). Returns {doc_id: data}.
+        """
+        collection = self.db.collection(self.products_collection)
+        products = {}
+        for start in range(0, len(item_ids), IN_FILTER_LIMIT):
+            query = (collection
+                     .where(filter=FieldFilter("item_id", "in", list(item_ids[start:start + IN_FILTER_LIMIT])))
+                     .select(fields))
+            for doc in query.stream():
+                products[doc.id] = doc.to_dict() or {}
+        return products
+
+    def _product_write(self, product_data: Dict[str, Any]) -> Tuple[Any, Dict[str, Any]]:
+        """
+        Returns the document reference and data for a product upsert.
         """
         # Use doc_id, entity_id or id as key
         p_id = product_data.get('doc_id') or product_data.get('entity_id') or product_data.get('id')
@@ -36,9 +92,425 @@ class FirestoreClient:
             
         doc_ref = self.db.collection(self.products_collection).document(str(p_id))
         
-        # Ensure embedding is stored as the official Vector type
-        if "embedding" in product_data and isinstance(product_data["embedding"], list):
-            product_data["embedding"] = Vector(product_data["embedding"])
-            
+        # Ensure embeddings (legacy and versioned vector fields) are stored as the official Vector type
+        for field, value in product_data.items():
+            if field.startswith("embedding") and isinstance(value, list):
+                product_data[field] = Vector(value)
+        return doc_ref, product_data
+
+    def upsert_product(self, product_data: Dict[str, Any]) -> None:
+        """
+        Upserts (creates or updates) a product document.
+        product_data must contain 'doc_id', 'entity_id' or 'id' to be used as document key.
+        """
+        doc_ref, data = self._product_write(product_data)
         # Set with merge=True to avoid overwriting unrelated fields if any
-        doc_ref.set(product_data, merge=True)
+        doc_ref.set(data, merge=True)
+
+    def batched_writer(self, flush_size: int = 200, max_in_flight: int = 4, max_retries: int = 5) -> "BatchedWriter":
+        """
+        Returns a buffered write path for products and error records (see BatchedWriter).
+        """
+        return BatchedWriter(self, flush_size=flush_size, max_in_flight=max_in_flight, max_retries=max_retries)
+
+    def get_products_page(self, fields: List[str], limit: int, start_after: Optional[str] = None) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Returns up to limit (doc_id, data) pairs in document ID order, after the
+        document ID start_after. Only the given fields are read.
+        """
+        query = (self.db.collection(self.products_collection)
+                 .order_by("__name__")
+                 .select(fields)
+                 .limit(limit))
+        if start_after:
+            query = query.start_after({"__name__": start_after})
+        return [(doc.id, doc.to_dict() or {}) for doc in query.stream()]
+
+    def get_product_ids(self) -> List[str]:
+        """
+        Returns the IDs of all product documents (no fields are read).
+        """
+        query = self.db.collection(self.products_collection).select(["__name__"])
+        return [doc.id for doc in query.stream()]
+
+    def get_unresolved_errors(self, limit: Optional[int] = 1000, fields: Optional[List[str]] = None,
+                              collection: Optional[str] = None) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Returns up to limit (None: all) (record_id, data) pairs of error records not marked
+        resolved, optionally projected to fields. Records without a 'resolved' field are only
+        found after backfill_error_status(). With collection only the records of that products
+        collection are returned (records from before it was stored belong to the default collection).
+        """
+        query = self.db.collection(self.errors_collection).where(filter=FieldFilter("resolved", "==", False))
+        if fields:
+            query = query.select(list(fields) + (["products_collection"] if collection else []))
+        if limit and not collection:
+            query = query.limit(limit)
+        records = [(doc.id, doc.to_dict() or {}) for doc in query.stream()]
+        if collection:
+            records = [(record_id, data) for record_id, data in records
+                       if data.get("products_collection", self.default_products_collection) == collection]
+            if limit:
+                records = records[:limit]
+        return records
+
+    def backfill_error_status(self) -> int:
+        """
+        Marks error records written before the 'resolved' field existed as unresolved, so
+        the retry queue (which queries that field) sees them. Returns the number updated.
+        """
+        refs = [doc.reference for doc in self.db.collection(self.errors_collection).select(["resolved"]).stream()
+                if "resolved" not in (doc.to_dict() or {})]
+        for start in range(0, len(refs), MAX_WRITES_PER_COMMIT):
+            batch = self.db.batch()
+            for ref in refs[start:start + MAX_WRITES_PER_COMMIT]:
+                batch.set(ref, {"resolved": False}, merge=True)
+            batch.commit()
+        return len(refs)
+
+    def get_search_config(self) -> Dict[str, Any]:
+        """
+        Returns the active search configuration (e.g. the vector field to query),
+        or an empty dict when none was written yet.
+        """
+        doc = self.db.collection(self.config_collection).document("active").get()
+        return doc.to_dict() if doc.exists else {}
+
+    def set_search_config(self, search_config: Dict[str, Any]) -> None:
+        """
+        Updates the active search configuration (vector field, products collection) in a
+        single document write, so readers switch atomically. Keys not given are kept.
+        """
+        self.db.collection(self.config_collection).document("active").set(
+            dict(search_config, updated_at=firestore.SERVER_TIMESTAMP), merge=True)
+
+    def use_active_collection(self) -> str:
+        """
+        Points this client at the products collection search is serving (set by a
+        blue/green rebuild), falling back to FIRESTORE_PRODUCTS_COLLECTION. Returns its name.
+        """
+        self.products_collection = (self.get_search_config().get("products_collection")
+                                    or self.default_products_collection)
+        return self.products_collection
+
+    def count_products(self, collection: Optional[str] = None) -> int:
+        """
+        Counts the documents of a products collection with a server-side count() aggregation.
+        """
+        result = self.db.collection(collection or self.products_collection).count().get()
+        return int(result[0][0].value)
+
+    def probe_vector_index(self, vector_field: str, collection: Optional[str] = None) -> None:
+        """
+        Runs a 1-nearest-neighbour query with a stored vector; raises when the collection
+        has no usable vector index on the field (or no vectors at all).
+        """
+        from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
+        col = self.db.collection(collection or self.products_collection)
+        vectors = [doc.to_dict().get(vector_field) for doc in col.select([vector_field]).limit(50).stream()]
+        vector = next((v for v in vectors if v is not None), None)
+        if vector is None:
+            raise ValueError(f"No documents with '{vector_field}' in {col.id}")
+        list(col.find_nearest(vector_field=vector_field, query_vector=vector,
+                              distance_measure=DistanceMeasure.COSINE, limit=1).stream())
+
+    def clear_collection(self, collection: str) -> int:
+        """
+        Deletes every document of a products collection (and its ingestion ledger) in bulk.
+        The collection ID and its indexes stay, so a later rebuild can write into it again.
+        Returns the number of deleted product documents.
+        """
+        deleted = self.db.recursive_delete(self.db.collection(collection))
+        self.db.recursive_delete(self.db.collection(self.ledger_collection).document(collection))
+        return deleted
+
+    def ledger_items(self, collection: Optional[str] = None):
+        """
+        Returns the ledger subcollection with one document per Item of a products collection.
+        """
+        return (self.db.collection(self.ledger_collection)
+                .document(collection or self.products_collection)
+                .collection("items"))
+
+    def ledger_counts(self, collection: Optional[str] = None) -> Dict[str, int]:
+        """
+        Counts ledger Items in total and per status (ok, partial, failed, no_images)
+        with count() aggregations.
+        """
+        items = self.ledger_items(collection)
+        counts = {"items": int(items.count().get()[0][0].value)}
+        for status in ("ok", "partial", "failed", "no_images"):
+            query = items.where(filter=FieldFilter("status", "==", status))
+            counts[status] = int(query.count().get()[0][0].value)
+        return counts
+
+    def get_ledger_item_ids(self, collection: Optional[str] = None) -> List[int]:
+        """
+        Returns the Item IDs in the ledger of a products collection (no fields are read).
+        """
+        return [int(doc.id.split("_", 1)[1]) for doc in self.ledger_items(collection).select(["__name__"]).stream()]
+
+    def save_manifest(self, run_id: str, item_ids: List[int], metadata: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Freezes the run's Item ID manifest in the progress collection.
+        The run document holds the metadata; the IDs are stored in chunked
+        documents in its 'manifest' subcollection.
+        """
+        run_ref = self.db.collection(self.progress_collection).document(run_id)
+        batch = self.db.batch()
+        run_doc = dict(metadata or {})
+        run_doc.update({
+            "run_id": run_id,
+            "manifest_size": len(item_ids),
+            "manifest_chunks": (len(item_ids) + MANIFEST_CHUNK_SIZE - 1) // MANIFEST_CHUNK_SIZE
+        })
+        batch.set(run_ref, run_doc, merge=True)
+        for chunk_no, start in enumerate(range(0, len(item_ids), MANIFEST_CHUNK_SIZE)):
+            chunk_ref = run_ref.collection("manifest").document(f"chunk_{chunk_no:05d}")
+            batch.set(chunk_ref, {"chunk": chunk_no, "item_ids": item_ids[start:start + MANIFEST_CHUNK_SIZE]})
+        batch.commit()
+
+    def load_manifest(self, run_id: str) -> List[int]:
+        """
+        Loads a frozen Item ID manifest saved by save_manifest().
+        """
+        run_ref = self.db.collection(self.progress_collection).document(run_id)
+        item_ids = []
+        for chunk in run_ref.collection("manifest").order_by("chunk").stream():
+            item_ids.extend(chunk.get("item_ids") or [])
+        return item_ids
+
+    def save_checkpoint(self, run_id: str, position: int, batch_stats: Dict[str, Any], totals: Dict[str, Any]) -> None:
+        """
+        Commits a progress checkpoint for a run: the manifest position reached,
+        the running totals and the stats of the batch that just finished.
+        Both writes go in one commit, so a checkpoint is either fully visible or not at all.
+        """
+        run_ref = self.db.collection(self.progress_collection).document(run_id)
+        batch_ref = run_ref.collection("batches").document(f"batch_{batch_stats.get('batch_start', 0):07d}")
+
+        batch = self.db.batch()
+        batch.set(batch_ref, dict(batch_stats, committed_at=firestore.SERVER_TIMESTAMP))
+        batch.set(run_ref, {
+            "position": position,
+            "totals": totals,
+            "last_checkpoint_at": firestore.SERVER_TIMESTAMP
+        }, merge=True)
+        batch.commit()
+
+    def update_run(self, run_id: str, fields: Dict[str, Any]) -> None:
+        """
+        Merges fields (e.g. status, finished_at) into a run's progress document.
+        """
+        self.db.collection(self.progress_collection).document(run_id).set(fields, merge=True)
+
+    def get_run(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns a run's progress document, or None.
+        """
+        doc = self.db.collection(self.progress_collection).document(run_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def get_shard_runs(self, run_group: str) -> List[Dict[str, Any]]:
+        """
+        Returns the progress documents of every shard of a sharded run, ordered by shard index.
+        """
+        query = self.db.collection(self.progress_collection).where(filter=FieldFilter("run_group", "==", run_group))
+        runs = [doc.to_dict() for doc in query.stream()]
+        return sorted((r for r in runs if r.get("shard_count", 1) > 1), key=lambda r: r.get("shard_index", 0))
+
+    def get_last_completed_run(self, full_only: bool = False, collection: Optional[str] = None,
+                               include_unfetched: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Returns the most recently started completed run that covered the whole filter
+        (no ItemCode, no --limit truncation), or None. With full_only=True only full sweeps count;
+        with collection only runs that wrote into that products collection.
+        A sharded run counts once all its shards completed (its group document), never per shard.
+        Runs that could not fetch some Items are no baseline and only count with include_unfetched=True.
+        """
+        query = (self.db.collection(self.progress_collection)
+                 .where(filter=FieldFilter("status", "==", "completed"))
+                 .where(filter=FieldFilter("covers_filter", "==", True)))
+        if full_only:
+            query = query.where(filter=FieldFilter("mode", "==", "full"))
+        runs = [run for run in (doc.to_dict() for doc in query.stream())
+                if run.get("shard_count", 1) == 1 and (include_unfetched or not run.get("items_unfetched"))]
+        if collection:
+            # Runs from before blue/green rebuilds wrote into the configured collection
+            runs = [r for r in runs if r.get("products_collection", self.default_products_collection) == collection]
+        if not runs:
+            return None
+        return max(runs, key=lambda r: r.get("started_at") or 0)
+
+    def get_resumable_run(self, kind: str = "ingest", shard: Tuple[int, int] = (0, 1)) -> Optional[Dict[str, Any]]:
+        """
+        Returns the most recently started run of the given kind ("ingest" or "migration")
+        that never reached 'completed', or None. shard (index, count) selects the runs of
+        that shard; the default only matches unsharded runs.
+        """
+        query = self.db.collection(self.progress_collection).where(filter=FieldFilter("status", "==", "running"))
+        # Ingestion runs predate the 'kind' and shard fields
+        runs = [run for run in (doc.to_dict() for doc in query.stream())
+                if run.get("kind", "ingest") == kind and (run.get("shard_index", 0), run.get("shard_count", 1)) == tuple(shard)]
+        if not runs:
+            return None
+        return max(runs, key=lambda r: r.get("started_at") or 0)
+
+class BatchedWriter:
+    """
+    Buffered write path on top of batched commits.
+    Writes are collected and committed flush_size at a time on a small pool of threads.
+    Commits failing with a retryable error are retried with jittered backoff. When
+    max_in_flight commits are already running, callers block until one finishes
+    (backpressure). flush() commits the buffer and waits for every commit;
+    failures are counted and kept for the report instead of being swallowed, and the
+    product documents they contained can be collected with take_failed_products().
+    """
+    def __init__(self, client: FirestoreClient, flush_size: int = 200, max_in_flight: int = 4, max_retries: int = 5):
+        self.client = client
+        self.flush_size = max(1, min(flush_size, MAX_WRITES_PER_COMMIT))
+        self.max_retries = max_retries
+        self._buffer: List[Tuple[Any, Dict[str, Any], bool, Optional[str]]] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, max_in_flight))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_in_flight),
+                                                               thread_name_prefix="firestore-commit")
+        self._in_flight: List[concurrent.futures.Future] = []
+        self.written = 0
+        self.commits = 0
+        self.retries = 0
+        self.failed = 0
+        self.failures: List[str] = []
+        self._failed_products: List[Tuple[str, Exception]] = []
+
+    def set(self, doc_ref: Any, data: Optional[Dict[str, Any]], merge: bool = True,
+            product_id: Optional[str] = None) -> None:
+        """
+        Buffers a set (merge by default); data None buffers a delete.
+        product_id marks a product upsert, reported by take_failed_products() when its commit fails.
+        """
+        with self._lock:
+            self._buffer.append((doc_ref, data, merge, product_id))
+            if len(self._buffer) < self.flush_size:
+                return
+            writes, self._buffer = self._buffer, []
+        self._submit(writes)
+
+    def upsert_product(self, product_data: Dict[str, Any]) -> None:
+        """
+        Buffered equivalent of FirestoreClient.upsert_product().
+        """
+        doc_ref, data = self.client._product_write(product_data)
+        self.set(doc_ref, data, product_id=doc_ref.id)
+
+    def delete(self, doc_ref: Any) -> None:
+        self.set(doc_ref, None)
+
+    def delete_product(self, doc_id: str) -> None:
+        self.delete(self.client.db.collection(self.client.products_collection).document(str(doc_id)))
+
+    def update_ledger(self, entry: Dict[str, Any]) -> None:
+        """
+        Buffers an Item's ledger entry (merged into ledger/<collection>/items/item_<id>).
+        """
+        self.set(self.client.ledger_items().document(f"item_{entry['item_id']}"), entry)
+
+    def delete_ledger_item(self, item_id: int) -> None:
+        self.delete(self.client.ledger_items().document(f"item_{item_id}"))
+
+    def log_error(self, error_doc: Dict[str, Any], record_id: Optional[str] = None) -> None:
+        """
+        Buffers an error record. With record_id the record is merged into that document
+        (one record per image); otherwise a new document is added.
+        """
+        errors = self.client.db.collection(self.client.errors_collection)
+        if record_id:
+            self.set(errors.document(record_id), error_doc)
+        else:
+            self.set(errors.document(), error_doc, merge=False)
+
+    def update_error(self, record_id: str, fields: Dict[str, Any]) -> None:
+        self.set(self.client.db.collection(self.client.errors_collection).document(record_id), fields)
+
+    def _submit(self, writes: List[Tuple[Any, Dict[str, Any], bool, Optional[str]]]) -> None:
+        # Backpressure: wait for a free commit slot before taking on more work
+        self._slots.acquire()
+        future = self._executor.submit(self._commit, writes)
+        with self._lock:
+            self._in_flight = [f for f in self._in_flight if not f.done()]
+            self._in_flight.append(future)
+
+    def _commit(self, writes: List[Tuple[Any, Dict[str, Any], bool, Optional[str]]]) -> None:
+        try:
+            attempt = 0
+            while True:
+                batch = self.client.db.batch()
+                for doc_ref, data, merge, _ in writes:
+                    if data is None:
+                        batch.delete(doc_ref)
+                    else:
+                        batch.set(doc_ref, data, merge=merge)
+                try:
+                    batch.commit()
+                except RETRYABLE_WRITE_ERRORS as e:
+                    if attempt >= self.max_retries:
+                        self._record_failure(writes, e)
+                        return
+                    with self._lock:
+                        self.retries += 1
+                    time.sleep(backoff_delay(attempt))
+                    attempt += 1
+                    continue
+                except Exception as e:
+                    self._record_failure(writes, e)
+                    return
+                with self._lock:
+                    self.written += len(writes)
+                    self.commits += 1
+                return
+        finally:
+            self._slots.release()
+
+    def _record_failure(self, writes: List[Tuple[Any, Dict[str, Any], bool, Optional[str]]], error: Exception) -> None:
+        print(f"  - ❌ Firestore commit of {len(writes)} writes failed: {error}")
+        with self._lock:
+            self.failed += len(writes)
+            for doc_ref, data, _, product_id in writes:
+                if len(self.failures) < 100:
+                    self.failures.append(f"{doc_ref.path}: {error}")
+                if product_id and data is not None:
+                    self._failed_products.append((product_id, error))
+
+    def take_failed_products(self) -> List[Tuple[str, Exception]]:
+        """
+        Returns (doc_id, error) for every product upsert whose commit failed since the last call.
+        Call after flush() to cover everything written so far.
+        """
+        with self._lock:
+            failed, self._failed_products = self._failed_products, []
+        return failed
+
+    def flush(self) -> None:
+        """
+        Commits everything buffered and waits until all commits have finished.
+        """
+        with self._lock:
+            writes, self._buffer = self._buffer, []
+        if writes:
+            self._submit(writes)
+        with self._lock:
+            in_flight, self._in_flight = self._in_flight, []
+        concurrent.futures.wait(in_flight)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"written": self.written, "commits": self.commits, "retries": self.retries,
+                    "failed": self.failed, "buffered": len(self._buffer)}
+
+    def close(self) -> Dict[str, int]:
+        """
+        Final flush; returns the write report.
+        """
+        self.flush()
+        self._executor.shutdown(wait=True)
+        return self.stats()
@@ -0,0 +1,125 @@
+import concurrent.futures
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from throttling import LatencyTracker
+
+class HedgedEmbeddingClient:
+    """
+    Latency-aware embedding client for the interactive search path.
+    Every call has a deadline. When the first request has not answered after the
+    hedge delay (a percentile of recently observed latencies), a duplicate request
+    is sent, to the secondary region when one is configured. The first successful
+    response wins; a failed request triggers the hedge immediately.
+    Requests that lost or outlived their deadline keep running until the backend gives
+    up (give it a request timeout), so at most max_in_flight requests run at once and
+    no hedge is sent while that many are in flight.
+    """
+    def __init__(self, primary: Any, secondary: Optional[Any] = None, deadline: float = 10.0,
+                 hedge_percentile: float = 95, min_hedge_delay: float = 0.5, min_samples: int = 20,
+                 max_in_flight: int = 16):
+        """
+        primary and secondary expose embed(image_bytes, contextual_text) (e.g. VisionEmbeddingGenerator).
+        hedge_percentile 0 disables hedging.
+        """
+        self.primary = primary
+        self.secondary = secondary
+        self.deadline = deadline
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+        self.latency = LatencyTracker(window=500)
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.hedges_skipped = 0
+        self.max_in_flight = max_in_flight
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight,
+                                                               thread_name_prefix="hedged-embedding")
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        Seconds to wait for the first request before hedging, or None when hedging is disabled.
+        Until enough latencies are observed the minimum delay is used.
+        """
+        if not self.hedge_percentile:
+            return None
+        observed = self.latency.percentile(self.hedge_percentile) if self.latency.count >= self.min_samples else None
+        return max(self.min_hedge_delay, observed or 0.0)
+
+    def _timed_embed(self, backend: Any, image_bytes: bytes, contextual_text: Optional[str]) -> List[float]:
+        started = time.monotonic()
+        try:
+            embedding = backend.embed(image_bytes, contextual_text=contextual_text)
+        except Exception:
+            self.latency.record_error()
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+        self.latency.record(time.monotonic() - started)
+        return embedding
+
+    def _submit(self, backend: Any, image_bytes: bytes, contextual_text: Optional[str],
+                optional: bool = False) -> Optional[concurrent.futures.Future]:
+        """
+        Starts a request. An optional one (the hedge) is not started, and None returned,
+        while max_in_flight requests are running: it would only queue behind them.
+        """
+        with self._lock:
+            if optional and self._in_flight >= self.max_in_flight:
+                self.hedges_skipped += 1
+                return None
+            self._in_flight += 1
+        return self._executor.submit(self._timed_embed, backend, image_bytes, contextual_text)
+
+    def embed(self, image_bytes: bytes, contextual_text: Optional[str] = None) -> List[float]:
+        """
+        Returns the first successful embedding. Raises TimeoutError when no request
+        answered within the deadline, or the last error when every request failed.
+        """
+        end = time.monotonic() + self.deadline
+        first = self._submit(self.primary, image_bytes, contextual_text)
+        pending = {first}
+        hedge_delay = self.hedge_delay()
+        hedged = hedge_delay is None
+        last_error: Optional[BaseException] = None
+
+        while pending:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            wait_for = remaining if hedged else min(remaining, max(0.0, hedge_delay - (self.deadline - remaining)))
+            done, pending = concurrent.futures.wait(pending, timeout=wait_for,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return future.result()
+                last_error = future.exception()
+
+            # Hedge once: after the delay, or right away when the first request failed
+            if not hedged:
+                hedged = True
+                hedge = self._submit(self.secondary or self.primary, image_bytes, contextual_text, optional=True)
+                if hedge is not None:
+                    with self._lock:
+                        self.hedges += 1
+                    pending.add(hedge)
+
+        if pending or last_error is None:
+            with self._lock:
+                self.timeouts += 1
+            raise TimeoutError(f"No embedding within {self.deadline:.1f}s")
+        raise last_error
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.latency.summary(), hedges=self.hedges, hedge_wins=self.hedge_wins, timeouts=self.timeouts,
+                    hedges_skipped=self.hedges_skipped, in_flight=self._in_flight)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
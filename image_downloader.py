@@ -0,0 +1,223 @@
+import asyncio
+import concurrent.futures
+import importlib.util
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlparse
+import httpx
+from app_config import get_config
+
+def _http2_available() -> bool:
+    # httpx only speaks HTTP/2 when the optional 'h2' package is installed
+    return importlib.util.find_spec("h2") is not None
+
+def _skip_reason(response: httpx.Response, max_bytes: int) -> Optional[str]:
+    """
+    Inspects response headers before the body is read.
+    Returns a human readable reason to skip the asset, or None.
+    """
+    content_type = response.headers.get("Content-Type", "").lower()
+    if "video" in content_type or "mp4" in content_type:
+        return f"Asset is a video ({content_type})"
+    content_length = response.headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        return f"Asset is too large ({int(content_length)} bytes)"
+    return None
+
+@dataclass
+class DownloadResult:
+    """
+    Outcome of a (conditional) download.
+    content is None when the asset was skipped, failed, or not modified (HTTP 304).
+    reserved is what the fetch's reserve callback granted (the caller releases it).
+    """
+    url: str
+    content: Optional[bytes] = None
+    not_modified: bool = False
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    reserved: int = 0
+
+def _expected_size(response: httpx.Response, max_bytes: int) -> int:
+    """
+    Size to reserve for a body before reading it: Content-Length, or max_bytes when unknown.
+    """
+    content_length = response.headers.get("Content-Length")
+    return min(int(content_length), max_bytes) if content_length and content_length.isdigit() else max_bytes
+
+def _conditional_headers(etag: Optional[str], last_modified: Optional[str]) -> Dict[str, str]:
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+class ImageDownloader:
+    """
+    Pooled image downloader shared by the ingestion job.
+    Connections are kept alive (HTTP/2 where available), each host gets a bounded
+    number of concurrent downloads, and bodies are streamed with a size limit.
+    Usable from sync code (fetch / download / submit / download_many) and async code (afetch / adownload).
+    """
+    def __init__(self, max_connections: int = 32, per_host_limit: int = 8,
+                 max_bytes: int = 30 * 1024 * 1024, timeout: float = 15):
+        self.per_host_limit = per_host_limit
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.http2 = _http2_available()
+        self._limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._client = httpx.Client(http2=self.http2, limits=self._limits, timeout=timeout, follow_redirects=True)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_connections, thread_name_prefix="image-download")
+        self._host_locks: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._async_host_locks: Dict[str, asyncio.Semaphore] = {}
+
+    def _host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_locks:
+                self._host_locks[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_locks[host]
+
+    def fetch(self, url: str, etag: Optional[str] = None, last_modified: Optional[str] = None,
+              timeout: Optional[float] = None, reserve: Optional[Callable[[int], int]] = None) -> DownloadResult:
+        """
+        Downloads an image, sending If-None-Match / If-Modified-Since when validators
+        from a previous download are given. A 304 response returns not_modified=True
+        without transferring the body. reserve (e.g. MemoryBudget.acquire) is called with
+        the expected body size before the body is read; its grant is returned in result.reserved.
+        """
+        result = DownloadResult(url=url)
+        try:
+            with self._host_semaphore(url):
+                with self._client.stream("GET", url, headers=_conditional_headers(etag, last_modified),
+                                         timeout=timeout or self.timeout) as response:
+                    result.etag = response.headers.get("ETag")
+                    result.last_modified = response.headers.get("Last-Modified")
+                    if response.status_code == 304:
+                        result.not_modified = True
+                        return result
+                    response.raise_for_status()
+                    reason = _skip_reason(response, self.max_bytes)
+                    if reason:
+                        print(f"  - Skip: {reason}")
+                        return result
+                    if reserve:
+                        result.reserved = reserve(_expected_size(response, self.max_bytes))
+
+                    chunks, size = [], 0
+                    for chunk in response.iter_bytes():
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            print(f"  - Skip: Asset exceeds {self.max_bytes} bytes at {url}")
+                            return result
+                        chunks.append(chunk)
+                    result.content = b"".join(chunks)
+                    return result
+        except httpx.HTTPError as e:
+            print(f"  - Error downloading {url}: {e}")
+            return result
+
+    def download(self, url: str, timeout: Optional[float] = None) -> Optional[bytes]:
+        """
+        Downloads an image from a URL.
+        Returns bytes if successful and it is an image, None otherwise.
+        """
+        return self.fetch(url, timeout=timeout).content
+
+    def submit(self, url: str, etag: Optional[str] = None, last_modified: Optional[str] = None) -> concurrent.futures.Future:
+        """
+        Starts a (conditional) download in the background and returns a Future of its DownloadResult.
+        """
+        return self._executor.submit(self.fetch, url, etag, last_modified)
+
+    def download_many(self, urls: List[str]) -> List[Optional[bytes]]:
+        """
+        Downloads several URLs concurrently; results are returned in input order.
+        """
+        return [future.result().content for future in [self.submit(url) for url in urls]]
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(http2=self.http2, limits=self._limits,
+                                                   timeout=self.timeout, follow_redirects=True)
+        return self._async_client
+
+    async def afetch(self, url: str, etag: Optional[str] = None, last_modified: Optional[str] = None,
+                     timeout: Optional[float] = None, reserve: Optional[Callable[[int], int]] = None) -> DownloadResult:
+        """
+        Async variant of fetch() sharing the same limits. The async client and
+        per-host semaphores are bound to the event loop of the first call.
+        """
+        host = urlparse(url).netloc
+        if host not in self._async_host_locks:
+            self._async_host_locks[host] = asyncio.Semaphore(self.per_host_limit)
+
+        result = DownloadResult(url=url)
+        try:
+            async with self._async_host_locks[host]:
+                async with self._get_async_client().stream("GET", url, headers=_conditional_headers(etag, last_modified),
+                                                           timeout=timeout or self.timeout) as response:
+                    result.etag = response.headers.get("ETag")
+                    result.last_modified = response.headers.get("Last-Modified")
+                    if response.status_code == 304:
+                        result.not_modified = True
+                        return result
+                    response.raise_for_status()
+                    reason = _skip_reason(response, self.max_bytes)
+                    if reason:
+                        print(f"  - Skip: {reason}")
+                        return result
+                    if reserve:
+                        result.reserved = reserve(_expected_size(response, self.max_bytes))
+
+                    chunks, size = [], 0
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            print(f"  - Skip: Asset exceeds {self.max_bytes} bytes at {url}")
+                            return result
+                        chunks.append(chunk)
+                    result.content = b"".join(chunks)
+                    return result
+        except httpx.HTTPError as e:
+            print(f"  - Error downloading {url}: {e}")
+            return result
+
+    async def adownload(self, url: str, timeout: Optional[float] = None) -> Optional[bytes]:
+        """
+        Async variant of download().
+        """
+        return (await self.afetch(url, timeout=timeout)).content
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self._client.close()
+
+    async def aclose(self) -> None:
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+_DEFAULT_DOWNLOADER: Optional[ImageDownloader] = None
+_DEFAULT_LOCK = threading.Lock()
+
+def get_downloader() -> ImageDownloader:
+    """
+    Returns the process-wide downloader, configured from the environment on first use.
+    """
+    global _DEFAULT_DOWNLOADER
+    with _DEFAULT_LOCK:
+        if _DEFAULT_DOWNLOADER is None:
+            config = get_config()
+            _DEFAULT_DOWNLOADER = ImageDownloader(
+                max_connections=config.get("DOWNLOAD_MAX_CONNECTIONS", 32),
+                per_host_limit=config.get("DOWNLOAD_PER_HOST_LIMIT", 8),
+                max_bytes=config.get("DOWNLOAD_MAX_BYTES", 30 * 1024 * 1024)
+            )
+        return _DEFAULT_DOWNLOADER
@@ -0,0 +1,125 @@
+import concurrent.futures
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Optional
+from PIL import Image as PILImage, ImageOps, ImageStat
+
+try:
+    import imagehash
+except ImportError:  # Perceptual hashing is optional
+    imagehash = None
+
+DEFAULT_MAX_PIXELS = 50_000_000
+
+def preprocess_image(image_bytes: bytes, max_edge: int = 1024, quality: int = 90,
+                     max_pixels: int = DEFAULT_MAX_PIXELS) -> Optional[Dict[str, Any]]:
+    """
+    Decodes an image once and prepares it for the embedding model:
+    validates it, applies the EXIF orientation, converts to RGB, downscales so the
+    longest edge is at most max_edge, and re-encodes it as a compact JPEG.
+
+    Returns None when the bytes are not a decodable image, or when the header declares
+    more than max_pixels pixels (a few MB of PNG can decode to many GB). 'image_hash' is the SHA256
+    of the original bytes (the change-detection key stored in Firestore); 'content'
+    holds the normalized JPEG that is sent to the embedding API; 'phash' (hex, None
+    without ImageHash) and 'mean_rgb' feed the near-duplicate index.
+    """
+    if not image_bytes:
+        return None
+    try:
+        with PILImage.open(io.BytesIO(image_bytes)) as img:
+            # open() only reads the header: refuse decompression bombs before decoding anything
+            original_size = img.size
+            if original_size[0] * original_size[1] > max_pixels:
+                return None
+            # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale (never below max_edge), which saves
+            # most of the decode memory and time; thumbnail() below does the exact resize
+            img.draft("RGB", (max_edge, max_edge))
+            # load() fully decodes the pixels, so truncated or corrupt files fail here
+            img.load()
+            img = ImageOps.exif_transpose(img)
+
+            if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+                # Flatten transparency onto white, like product packshots on a web page
+                rgba = img.convert("RGBA")
+                background = PILImage.new("RGB", rgba.size, (255, 255, 255))
+                background.paste(rgba, mask=rgba.split()[-1])
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+
+            if max(img.size) > max_edge:
+                img.thumbnail((max_edge, max_edge), PILImage.LANCZOS)
+
+            # Perceptual hash (grayscale structure) plus mean colour for near-duplicate detection
+            phash = str(imagehash.phash(img)) if imagehash else None
+            mean_rgb = [round(c) for c in ImageStat.Stat(img).mean]
+
+            out = io.BytesIO()
+            img.save(out, format="JPEG", quality=quality, optimize=True)
+            content = out.getvalue()
+    except Exception:
+        return None
+
+    return {
+        "image_hash": hashlib.sha256(image_bytes).hexdigest(),
+        "content": content,
+        "content_hash": hashlib.sha256(content).hexdigest(),
+        "phash": phash,
+        "mean_rgb": mean_rgb,
+        "original_size": original_size,
+        "size": img.size,
+        "original_bytes": len(image_bytes)
+    }
+
+class ImagePreprocessor:
+    """
+    Runs preprocess_image() in a process pool so decoding and re-encoding scale
+    across all CPUs instead of competing for the GIL with the I/O threads.
+
+    A worker that dies (e.g. OOM-killed) breaks the whole pool: every pending and later
+    call fails with BrokenProcessPool. process() then starts a new pool and retries once.
+    """
+    def __init__(self, workers: Optional[int] = None, max_edge: int = 1024, quality: int = 90,
+                 max_pixels: int = DEFAULT_MAX_PIXELS):
+        self.max_edge = max_edge
+        self.quality = quality
+        self.max_pixels = max_pixels
+        self.workers = workers or os.cpu_count() or 1
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._pool = self._new_pool()
+
+    def _new_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        # 'spawn' avoids forking a process that already runs HTTP and gRPC threads
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _restart(self, broken: concurrent.futures.ProcessPoolExecutor) -> None:
+        with self._lock:
+            # Concurrent callers see the same broken pool; only the first one replaces it
+            if self._pool is not broken:
+                return
+            self._pool = self._new_pool()
+            self.restarts += 1
+        print(f"Preprocessing pool broke (a worker died); restarted it ({self.restarts}x)")
+        broken.shutdown(wait=False)
+
+    def submit(self, image_bytes: bytes) -> concurrent.futures.Future:
+        return self._pool.submit(preprocess_image, image_bytes, self.max_edge, self.quality, self.max_pixels)
+
+    def process(self, image_bytes: bytes) -> Optional[Dict[str, Any]]:
+        pool = self._pool
+        try:
+            return pool.submit(preprocess_image, image_bytes, self.max_edge, self.quality, self.max_pixels).result()
+        except BrokenProcessPool:
+            self._restart(pool)
+            # Retried once: if this image itself kills the worker, the second failure reaches the caller
+            return self.submit(image_bytes).result()
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
@@ -1,4 +1,3 @@
-import requests
 import hashlib
 import io
 from PIL import Image as PILImage
@@ -10,20 +9,10 @@ def download_image(url: str, timeout: int = 15) -> Optional[bytes]:
     """
     Downloads an image from a URL.
     Returns bytes if successful and it is an image, None otherwise.
+    Uses the shared pooled downloader (keep-alive connections, per-host limits).
     """
-    try:
-        response = requests.get(url, timeout=timeout)
-        response.raise_for_status()
-        
-        content_type = response.headers.get("Content-Type", "").lower()
-        if "video" in content_type or "mp4" in content_type:
-            print(f"  - Skip: Asset is a video ({content_type})")
-            return None
-            
-        return response.content
-    except requests.RequestException as e:
-        print(f"  - Error downloading {url}: {e}")
-        return None
+    from image_downloader import get_downloader
+    return get_downloader().download(url, timeout=timeout)
 
 def is_valid_image(image_bytes: bytes) -> bool:
     """
@@ -0,0 +1,173 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Tells a stage worker to exit
+_STOP = object()
+
+class MemoryBudget:
+    """
+    Caps the bytes held by in-flight images. acquire() blocks while the budget is used up;
+    a single reservation larger than the whole budget is clamped so it can still proceed.
+    """
+    def __init__(self, limit_bytes: int):
+        self.limit = max(1, int(limit_bytes))
+        self.in_use = 0
+        self.peak = 0
+        self.waits = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size: int) -> int:
+        """
+        Reserves size bytes and returns the amount actually reserved (pass it to release()).
+        """
+        size = min(max(0, int(size)), self.limit)
+        with self._cond:
+            if self.in_use + size > self.limit:
+                self.waits += 1
+            while self.in_use + size > self.limit:
+                self._cond.wait()
+            self.in_use += size
+            self.peak = max(self.peak, self.in_use)
+        return size
+
+    def release(self, size: int) -> None:
+        if not size:
+            return
+        with self._cond:
+            self.in_use -= size
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {"limit": self.limit, "in_use": self.in_use, "peak": self.peak, "waits": self.waits}
+
+class Pipeline:
+    """
+    Chain of stages, each with its own worker threads and a bounded input queue.
+    A stage function takes a task and returns it (handed to the next stage) or None
+    (the task is finished). A full queue blocks the stage in front of it, so the
+    slowest stage sets the pace without unbounded buffering in between. Errors go to
+    on_error and finish the task; on_done runs once for every finished task.
+    A stage given a batch size (fourth tuple element) is called with a list of up to that
+    many queued tasks and returns one result per task; an Exception result is that task's error.
+    """
+    def __init__(self, stages: List[Tuple], queue_size: int = 64,
+                 on_error: Optional[Callable[[Any, Exception], None]] = None,
+                 on_done: Optional[Callable[[Any], None]] = None):
+        self.names = [stage[0] for stage in stages]
+        self.on_error = on_error
+        self.on_done = on_done
+        self._queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+        self._counters = {stage[0]: {"workers": max(1, stage[2]), "processed": 0, "errors": 0, "busy": 0.0}
+                          for stage in stages}
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._started = time.monotonic()
+        self._threads = []
+        for position, (name, fn, workers, *batch_size) in enumerate(stages):
+            batch_size = batch_size[0] if batch_size else None
+            for n in range(max(1, workers)):
+                thread = threading.Thread(target=self._work, args=(position, fn, batch_size), name=f"{name}-{n}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, task: Any) -> None:
+        """
+        Hands a task to the first stage; blocks while its queue is full.
+        """
+        with self._cond:
+            self._pending += 1
+        self._queues[0].put(task)
+
+    def join(self) -> None:
+        """
+        Waits until every submitted task has left the pipeline.
+        """
+        with self._cond:
+            while self._pending:
+                self._cond.wait()
+
+    def _take(self, inbox: queue.Queue, batch_size: Optional[int]) -> Tuple[List[Any], bool]:
+        """
+        Blocks for one task, then adds whatever else is queued, up to batch_size.
+        Returns the tasks and whether the stop marker was seen.
+        """
+        tasks = [inbox.get()]
+        while batch_size and len(tasks) < batch_size and tasks[-1] is not _STOP:
+            try:
+                tasks.append(inbox.get_nowait())
+            except queue.Empty:
+                break
+        if tasks[-1] is _STOP:
+            return tasks[:-1], True
+        return tasks, False
+
+    def _work(self, position: int, fn: Callable[[Any], Any], batch_size: Optional[int]) -> None:
+        inbox = self._queues[position]
+        counters = self._counters[self.names[position]]
+        is_last = position == len(self._queues) - 1
+        while True:
+            tasks, stop = self._take(inbox, batch_size)
+            if tasks:
+                started = time.monotonic()
+                try:
+                    results = fn(tasks) if batch_size else [fn(tasks[0])]
+                except Exception as e:
+                    results = [e] * len(tasks)
+                with self._cond:
+                    counters["processed"] += len(tasks)
+                    counters["busy"] += time.monotonic() - started
+                for task, result in zip(tasks, results):
+                    self._hand_on(position, task, result, counters, is_last)
+            if stop:
+                return
+
+    def _hand_on(self, position: int, task: Any, result: Any, counters: Dict[str, Any], is_last: bool) -> None:
+        if isinstance(result, Exception):
+            with self._cond:
+                counters["errors"] += 1
+            if self.on_error:
+                try:
+                    self.on_error(task, result)
+                except Exception as handler_error:
+                    print(f"Pipeline error handler failed: {handler_error}")
+            result = None
+        if result is None or is_last:
+            self._finish(task)
+        else:
+            self._queues[position + 1].put(result)
+
+    def _finish(self, task: Any) -> None:
+        try:
+            if self.on_done:
+                self.on_done(task)
+        finally:
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Per stage: tasks processed, errors, queue depth and utilization (share of the
+        stage's worker time spent working). The busiest stage is the bottleneck.
+        """
+        elapsed = max(1e-9, time.monotonic() - self._started)
+        with self._cond:
+            return {
+                name: dict(counters, queued=self._queues[position].qsize(),
+                           utilization=counters["busy"] / (counters["workers"] * elapsed))
+                for position, (name, counters) in enumerate(self._counters.items())
+            }
+
+    def close(self) -> None:
+        """
+        Stops the workers once the queued tasks are done.
+        """
+        self.join()
+        for position, inbox in enumerate(self._queues):
+            for _ in range(self._counters[self.names[position]]["workers"]):
+                inbox.put(_STOP)
+        for thread in self._threads:
+            thread.join()
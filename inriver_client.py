@@ -1,112 +1,429 @@
 import requests
-from typing import List, Dict, Optional
+import threading
+import concurrent.futures
+from typing import List, Dict, Optional, Any, Callable, Iterator
 import time
+from request_scheduler import RequestScheduler
+
+class MemoCache:
+    """
+    Thread-safe memo cache with hit/miss counters.
+    Concurrent lookups of the same key share a single load; failed loads are not cached.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[Any, Any] = {}
+        self._pending: Dict[Any, threading.Event] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key: Any, loader: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._values:
+                self.hits += 1
+                return self._values[key]
+            event = self._pending.get(key)
+            is_owner = event is None
+            if is_owner:
+                event = threading.Event()
+                self._pending[key] = event
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if not is_owner:
+            event.wait()
+            with self._lock:
+                if key in self._values:
+                    return self._values[key]
+            # The owning load failed; try again ourselves
+            return loader()
+
+        try:
+            value = loader()
+            with self._lock:
+                self._values[key] = value
+            return value
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            event.set()
+
+    def lookup_many(self, keys: List[Any]) -> tuple[Dict[Any, Any], List[Any]]:
+        """
+        Returns (cached values, missing keys) for a list of keys, counting hits and misses.
+        """
+        found, missing = {}, []
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                if key in self._values:
+                    self.hits += 1
+                    found[key] = self._values[key]
+                else:
+                    self.misses += 1
+                    missing.append(key)
+        return found, missing
+
+    def store(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._values[key] = value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._values)}
+
+def _linked_entity_id(link: Dict, direction: str) -> Optional[int]:
+    """
+    Extracts the entity on the other side of a link from an entities:fetchdata bundle.
+    """
+    entity = link.get("entity") or {}
+    key = "sourceEntityId" if direction == "inbound" else "targetEntityId"
+    return entity.get("entityId") or link.get(key)
 
 class InRiverClient:
-    def __init__(self, base_url: str, api_key: str):
+    # Entities per entities:fetchdata POST
+    BULK_CHUNK_SIZE = 200
+    # Items per bulk request when streaming with iter_items()
+    STREAM_CHUNK_SIZE = 25
+
+    def __init__(self, base_url: str, api_key: str, fetch_mode: str = "bulk",
+                 max_concurrency: int = 16, rate_per_second: float = 0):
         self.base_url = base_url.rstrip('/')
+        # "bulk" uses entities:fetchdata; "per_item" issues 4+N GETs per Item
+        self.fetch_mode = fetch_mode
         self.session = requests.Session()
         self.session.headers.update({
             "X-inRiver-APIKey": api_key,
             "Accept": "application/json"
         })
+        # One global budget (concurrency, rate, 429/503 backoff) for every InRiver call
+        self.scheduler = RequestScheduler(self.session, max_concurrency=max_concurrency,
+                                          rate_per_second=rate_per_second)
+        self.max_concurrency = max_concurrency
+        # Run-scoped memo caches: sibling Items share parents, Items share Resources
+        self.parent_cache = MemoCache()
+        self.resource_cache = MemoCache()
 
-    def get_products(self, start_index: int = 0, limit: int = 500, data_criteria: Optional[List[Dict]] = None) -> List[Dict]:
+    def reset_caches(self) -> None:
         """
-        Fetches Items from InRiver.
-        If data_criteria is provided, it searches for Items.
-        For each Item, it fetches Parent Product fields and ALL Resource images.
+        Clears the parent Product and Resource memo caches (call at the start of a run).
+        """
+        self.parent_cache.clear()
+        self.resource_cache.clear()
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Returns hit/miss counters of the memo caches.
+        """
+        return {
+            "parent_products": self.parent_cache.stats(),
+            "resources": self.resource_cache.stats()
+        }
+
+    def request_stats(self) -> Dict[str, int]:
+        """
+        Returns request, retry and throttling counters of the scheduler.
+        """
+        return self.scheduler.stats()
+
+    def _fetch_parent_fields(self, parent_id: int) -> Dict:
+        pf_url = f"{self.base_url}/api/v1.0.0/entities/{parent_id}/summary/fields"
+        p_r = self.scheduler.get(pf_url, timeout=10)
+        p_r.raise_for_status()
+        product_data = {f.get('fieldTypeId'): f.get('value') for f in p_r.json()}
+        product_data['product_entity_id'] = parent_id
+        return product_data
+
+    def _fetch_resource_url(self, resource_id: int) -> Optional[str]:
+        rm_url = f"{self.base_url}/api/v1.0.0/entities/{resource_id}/mediadetails"
+        rm_r = self.scheduler.get(rm_url, timeout=10)
+        rm_r.raise_for_status()
+        media = rm_r.json()
+        # Take the first URL found for this resource (usually just one)
+        return media[0].get('url') if media else None
+
+    def _cached_parent_fields(self, parent_id: int) -> Dict:
+        return self.parent_cache.get_or_load(parent_id, lambda: self._fetch_parent_fields(parent_id))
+
+    def _cached_resource_url(self, resource_id: int) -> Optional[str]:
+        return self.resource_cache.get_or_load(resource_id, lambda: self._fetch_resource_url(resource_id))
+
+    def query_item_ids(self, data_criteria: Optional[List[Dict]] = None, modified_since: Optional[float] = None) -> List[int]:
+        """
+        Runs the Item query once and returns the matching entity IDs, sorted.
+        The sorted list is stable between calls, so it can be frozen as a run manifest.
+        With modified_since (epoch seconds) only Items modified after that moment are returned.
         """
         url = f"{self.base_url}/api/v1.0.0/query"
-        
-        # 1. Search for Items
+        system_criteria = [{"type": "EntityTypeId", "value": "Item", "operator": "Equal"}]
+        if modified_since is not None:
+            system_criteria.append({
+                "type": "LastModified",
+                "value": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(modified_since)),
+                "operator": "GreaterThan"
+            })
         query_payload = {
-            "systemCriteria": [{"type": "EntityTypeId", "value": "Item", "operator": "Equal"}],
+            "systemCriteria": system_criteria,
             "dataCriteria": data_criteria or []
         }
-        
+
+        response = self.scheduler.post(url, json=query_payload)
+        if not response.ok:
+            print(f"Item Query Failed: {response.text}")
+        response.raise_for_status()
+
+        item_ids = sorted(response.json().get("entityIds", []))
+        print(f"✓ Found {len(item_ids)} Items matching filters.")
+        return item_ids
+
+    def get_items(self, item_ids: List[int]) -> List[Dict]:
+        """
+        Fetches details for the given Item IDs.
+        For each Item, it fetches Parent Product fields and ALL Resource images.
+        Returns records of {entity_id, item_fields, product_fields, image_urls}.
+        """
+        if not item_ids:
+            return []
+
+        if self.fetch_mode == "bulk":
+            try:
+                return self.get_items_bulk(item_ids)
+            except requests.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status in (404, 405):
+                    print(f"Bulk fetch not supported by InRiver (HTTP {status}). Falling back to per-item fetching.")
+                    self.fetch_mode = "per_item"
+                else:
+                    print(f"Bulk fetch failed ({e}). Retrying this batch per item.")
+            except requests.RequestException as e:
+                print(f"Bulk fetch failed ({e}). Retrying this batch per item.")
+
+        return self._get_items_per_item(item_ids)
+
+    def iter_items(self, item_ids: List[int], prefetch: int = 32) -> Iterator[Dict]:
+        """
+        Yields Item records as soon as they are fetched (completion order, not input order).
+        About `prefetch` Items are being fetched ahead of the consumer, so a slow
+        Item never holds back the ones behind it (in bulk mode: whole chunks, at least two).
+        """
+        if not item_ids:
+            return
+
+        if self.fetch_mode == "bulk":
+            groups = [item_ids[i:i + self.STREAM_CHUNK_SIZE] for i in range(0, len(item_ids), self.STREAM_CHUNK_SIZE)]
+            fetch = self.get_items
+            # Round up, and keep at least two chunks in flight so fetching overlaps with the consumer
+            max_in_flight = max(2, -(-prefetch // self.STREAM_CHUNK_SIZE))
+        else:
+            groups = [[item_id] for item_id in item_ids]
+            fetch = lambda group: [r for r in [self._fetch_item_details(group[0])] if r]
+            max_in_flight = max(1, prefetch)
+
+        pending_groups = iter(groups)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="inriver-prefetch")
+        in_flight = set()
+        try:
+            for group in pending_groups:
+                in_flight.add(executor.submit(fetch, group))
+                if len(in_flight) >= max_in_flight:
+                    break
+
+            while in_flight:
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                # Refill the prefetch window before handing results to the consumer
+                for _ in done:
+                    group = next(pending_groups, None)
+                    if group is not None:
+                        in_flight.add(executor.submit(fetch, group))
+                for future in done:
+                    yield from future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _fetch_data(self, entity_ids: List[int], objects: str, inbound: Optional[Dict] = None,
+                    outbound: Optional[Dict] = None) -> Dict[int, Dict]:
+        """
+        POSTs entities:fetchdata in chunks and returns the bundles keyed by entity ID.
+        """
+        url = f"{self.base_url}/api/v1.0.0/entities:fetchdata"
+        futures = []
+        for start in range(0, len(entity_ids), self.BULK_CHUNK_SIZE):
+            payload = {"entityIds": entity_ids[start:start + self.BULK_CHUNK_SIZE], "objects": objects}
+            if inbound:
+                payload["inbound"] = inbound
+            if outbound:
+                payload["outbound"] = outbound
+            futures.append(self.scheduler.submit("POST", url, json=payload, timeout=60))
+
+        bundles = {}
+        for future in futures:
+            response = future.result()
+            response.raise_for_status()
+            for bundle in response.json() or []:
+                bundles[bundle.get("entityId")] = bundle
+        return bundles
+
+    def get_items_bulk(self, item_ids: List[int]) -> List[Dict]:
+        """
+        Fetches a whole batch in a few round trips using entities:fetchdata:
+        one pass for the Items (fields + links), one for uncached parent Products
+        and one for uncached Resources' media details.
+        """
+        item_bundles = self._fetch_data(
+            list(item_ids),
+            objects="FieldValues",
+            inbound={"linkTypeIds": "ProductItem", "objects": "EntitySummary"},
+            outbound={"linkTypeIds": "ItemResource", "objects": "EntitySummary"}
+        )
+
+        links = {}
+        for item_id, bundle in item_bundles.items():
+            parent_id = next((_linked_entity_id(l, "inbound") for l in bundle.get("inbound") or []
+                              if l.get("linkTypeId") == "ProductItem"), None)
+            # InRiver's link order, as in per-item mode: image indexes (and so document IDs) follow it
+            outbound = [l for l in bundle.get("outbound") or [] if l.get("linkTypeId") == "ItemResource"]
+            resource_ids = [rid for rid in (_linked_entity_id(l, "outbound") for l in outbound) if rid]
+            links[item_id] = (parent_id, resource_ids)
+
+        # Parent Products (shared by sibling Items)
+        parents, missing_parents = self.parent_cache.lookup_many([p for p, _ in links.values() if p])
+        if missing_parents:
+            for parent_id, bundle in self._fetch_data(missing_parents, objects="FieldValues").items():
+                product_data = {f.get('fieldTypeId'): f.get('value') for f in bundle.get("fieldValues") or []}
+                product_data['product_entity_id'] = parent_id
+                self.parent_cache.store(parent_id, product_data)
+                parents[parent_id] = product_data
+
+        # Resource media URLs (shared between Items)
+        all_resource_ids = [rid for _, rids in links.values() for rid in rids]
+        resource_urls, missing_resources = self.resource_cache.lookup_many(all_resource_ids)
+        if missing_resources:
+            for rid, bundle in self._fetch_data(missing_resources, objects="MediaDetails").items():
+                media = bundle.get("mediaDetails") or []
+                url = media[0].get('url') if media else None
+                self.resource_cache.store(rid, url)
+                resource_urls[rid] = url
+
+        items_data = []
+        for item_id in item_ids:
+            bundle = item_bundles.get(item_id)
+            if not bundle:
+                print(f"Failed to fetch item {item_id}: not returned by InRiver")
+                continue
+            parent_id, resource_ids = links[item_id]
+            image_urls = [resource_urls.get(rid) for rid in resource_ids]
+            items_data.append({
+                "entity_id": item_id,
+                "item_fields": {f.get('fieldTypeId'): f.get('value') for f in bundle.get("fieldValues") or []},
+                "product_fields": dict(parents.get(parent_id) or {}),
+                # Deduplicate URLs
+                "image_urls": list(dict.fromkeys([u for u in image_urls if u])),
+                # False when some Resource could not be resolved (the list may be short)
+                "images_complete": all(rid in resource_urls for rid in resource_ids)
+            })
+
+        return items_data
+
+    def _fetch_item_details(self, item_id: int) -> Optional[Dict]:
+        """
+        Fetches one Item's fields, parent Product fields and Resource image URLs.
+        """
         try:
-            response = self.session.post(url, json=query_payload)
-            if not response.ok:
-                print(f"Item Query Failed: {response.text}")
-                return []
-            
-            all_item_ids = response.json().get("entityIds", [])
-            print(f"✓ Found {len(all_item_ids)} Items matching filters.")
-            
-            # Slice for the requested batch
-            batch_ids = all_item_ids[start_index : start_index + limit]
-            
-            if not batch_ids:
-                return []
-
-            items_data = []
-            
-            def fetch_item_details(item_id):
+            entity_url = f"{self.base_url}/api/v1.0.0/entities/{item_id}"
+            # A-C. Item fields and both link directions are independent: fan them out
+            fields_f = self.scheduler.submit("GET", f"{entity_url}/summary/fields", timeout=10)
+            inbound_f = self.scheduler.submit("GET", f"{entity_url}/links", params={'linkDirection': 'inbound'}, timeout=10)
+            outbound_f = self.scheduler.submit("GET", f"{entity_url}/links", params={'linkDirection': 'outbound'}, timeout=10)
+
+            r = fields_f.result()
+            r.raise_for_status()
+            item_fields = {f.get('fieldTypeId'): f.get('value') for f in r.json()}
+
+            # B. Parent Product Details (memoized, fetched concurrently with the media details)
+            parent_f = None
+            l_r = inbound_f.result()
+            if l_r.ok:
+                links = l_r.json()
+                parent_id = next((l.get('sourceEntityId') for l in links if l.get('linkTypeId') == 'ProductItem'), None)
+                if parent_id:
+                    parent_f = self.scheduler.submit_call(self._cached_parent_fields, parent_id)
+
+            # C. ALL Resource Images (outbound links from Item to Resource)
+            resource_fs = []
+            il_r = outbound_f.result()
+            images_complete = il_r.ok
+            if il_r.ok:
+                resource_ids = [l.get('targetEntityId') for l in il_r.json() if l.get('linkTypeId') == 'ItemResource']
+                resource_fs = [self.scheduler.submit_call(self._cached_resource_url, rid) for rid in resource_ids]
+
+            product_data = {}
+            if parent_f:
                 try:
-                    # A. Fetch Item Fields
-                    f_url = f"{self.base_url}/api/v1.0.0/entities/{item_id}/summary/fields"
-                    r = self.session.get(f_url, timeout=10)
-                    r.raise_for_status()
-                    item_fields = {f.get('fieldTypeId'): f.get('value') for f in r.json()}
-                    
-                    # B. Fetch Parent Product Details
+                    product_data = dict(parent_f.result())
+                except requests.HTTPError:
                     product_data = {}
-                    links_url = f"{self.base_url}/api/v1.0.0/entities/{item_id}/links"
-                    l_r = self.session.get(links_url, params={'linkDirection': 'inbound'}, timeout=10)
-                    if l_r.ok:
-                        links = l_r.json()
-                        parent_id = next((l.get('sourceEntityId') for l in links if l.get('linkTypeId') == 'ProductItem'), None)
-                        if parent_id:
-                            pf_url = f"{self.base_url}/api/v1.0.0/entities/{parent_id}/summary/fields"
-                            p_r = self.session.get(pf_url, timeout=10)
-                            if p_r.ok:
-                                product_data = {f.get('fieldTypeId'): f.get('value') for f in p_r.json()}
-                                product_data['product_entity_id'] = parent_id
-
-                    # C. Fetch ALL Resource Images
-                    image_urls = []
-                    # Get outbound links from Item to Resource
-                    i_links_url = f"{self.base_url}/api/v1.0.0/entities/{item_id}/links"
-                    il_r = self.session.get(i_links_url, params={'linkDirection': 'outbound'}, timeout=10)
-                    if il_r.ok:
-                        resource_ids = [l.get('targetEntityId') for l in il_r.json() if l.get('linkTypeId') == 'ItemResource']
-                        for rid in resource_ids:
-                            rm_url = f"{self.base_url}/api/v1.0.0/entities/{rid}/mediadetails"
-                            rm_r = self.session.get(rm_url, timeout=10)
-                            if rm_r.ok:
-                                media = rm_r.json()
-                                if media:
-                                    # Take the first URL found for this resource (usually just one)
-                                    image_urls.append(media[0].get('url'))
-                    
-                    # Deduplicate URLs
-                    image_urls = list(dict.fromkeys([u for u in image_urls if u]))
-
-                    return {
-                        "entity_id": item_id,
-                        "item_fields": item_fields,
-                        "product_fields": product_data,
-                        "image_urls": image_urls
-                    }
-                except Exception as ex:
-                    print(f"Failed to fetch item {item_id}: {ex}")
-                    return None
-
-            import concurrent.futures
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                results = executor.map(fetch_item_details, batch_ids)
-                
-            for res in results:
-                if res:
-                    items_data.append(res)
-                
-            return items_data
 
+            image_urls = []
+            for future in resource_fs:
+                try:
+                    image_urls.append(future.result())
+                except requests.HTTPError:
+                    images_complete = False
+                    continue
+
+            # Deduplicate URLs
+            image_urls = list(dict.fromkeys([u for u in image_urls if u]))
+
+            return {
+                "entity_id": item_id,
+                "item_fields": item_fields,
+                "product_fields": product_data,
+                "image_urls": image_urls,
+                "images_complete": images_complete
+            }
+        except Exception as ex:
+            print(f"Failed to fetch item {item_id}: {ex}")
+            return None
+
+    def _get_items_per_item(self, item_ids: List[int]) -> List[Dict]:
+        """
+        Fetches Item details with individual GETs per Item, parent and Resource.
+        """
+        items_data = []
+
+        # Item workers only wait on scheduled requests; the scheduler enforces the real budget
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            results = executor.map(self._fetch_item_details, item_ids)
+
+        for res in results:
+            if res:
+                items_data.append(res)
+
+        return items_data
+
+    def get_products(self, start_index: int = 0, limit: int = 500, data_criteria: Optional[List[Dict]] = None) -> List[Dict]:
+        """
+        Fetches Items from InRiver.
+        If data_criteria is provided, it searches for Items.
+        Convenience wrapper for one-off scripts: it runs the full query on every call.
+        Batch runs should use query_item_ids() once and page with get_items().
+        """
+        try:
+            all_item_ids = self.query_item_ids(data_criteria)
         except requests.RequestException as e:
             print(f"Error fetching items from InRiver: {e}")
             raise
 
+        # Slice for the requested batch
+        batch_ids = all_item_ids[start_index : start_index + limit]
+        return self.get_items(batch_ids)
+
     def get_total_count(self) -> int:
         """
         Returns total count of products.
@@ -121,7 +438,7 @@ class InRiverClient:
                 }
             ]
         }
-        response = self.session.post(url, json=query_payload)
+        response = self.scheduler.post(url, json=query_payload)
         if not response.ok:
             print(f"Count Query Failed: {response.text}")
         response.raise_for_status()
@@ -0,0 +1,70 @@
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+HASH_BITS = 64
+
+class PerceptualHashIndex:
+    """
+    In-memory index of 64-bit perceptual hashes with Hamming-distance lookups.
+
+    Uses multi-index hashing: each hash is split into max_distance + 1 blocks and
+    bucketed per block. Two hashes within max_distance bits must agree exactly on at
+    least one block (pigeonhole), so a lookup only compares against the few entries
+    that share a block instead of scanning the whole index.
+
+    A mean-RGB check rejects matches with a different colour, so colour variants of
+    the same packshot (same structure, other colour) are not treated as duplicates.
+    """
+    def __init__(self, max_distance: int = 4, max_color_delta: int = 16):
+        self.max_distance = max_distance
+        self.max_color_delta = max_color_delta
+        self.blocks = max_distance + 1
+        bounds = [round(i * HASH_BITS / self.blocks) for i in range(self.blocks + 1)]
+        self._masks = [(bounds[i], ((1 << (bounds[i + 1] - bounds[i])) - 1)) for i in range(self.blocks)]
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in range(self.blocks)]
+        self._entries: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _block_keys(self, value: int) -> List[int]:
+        return [(value >> shift) & mask for shift, mask in self._masks]
+
+    def add(self, phash: str, mean_rgb: Optional[Sequence[int]], payload: Dict[str, Any]) -> None:
+        """
+        Adds a hash (hex string) with its mean colour and an arbitrary payload (e.g. doc_id, embedding).
+        """
+        value = int(phash, 16)
+        with self._lock:
+            entry_no = len(self._entries)
+            self._entries.append({"value": value, "mean_rgb": mean_rgb, "payload": payload})
+            for block, key in enumerate(self._block_keys(value)):
+                self._buckets[block].setdefault(key, []).append(entry_no)
+
+    def find(self, phash: str, mean_rgb: Optional[Sequence[int]] = None) -> Optional[tuple[Dict[str, Any], int]]:
+        """
+        Returns (payload, distance) of the closest near-duplicate, or None.
+        """
+        value = int(phash, 16)
+        best = None
+        with self._lock:
+            candidates = set()
+            for block, key in enumerate(self._block_keys(value)):
+                candidates.update(self._buckets[block].get(key, ()))
+            for entry_no in candidates:
+                entry = self._entries[entry_no]
+                distance = (entry["value"] ^ value).bit_count()
+                if distance > self.max_distance:
+                    continue
+                if mean_rgb and entry["mean_rgb"] and max(
+                        abs(a - b) for a, b in zip(mean_rgb, entry["mean_rgb"])) > self.max_color_delta:
+                    continue
+                if best is None or distance < best[1]:
+                    best = (entry["payload"], distance)
+        return best
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets = [{} for _ in range(self.blocks)]
+            self._entries = []
@@ -0,0 +1,115 @@
+import concurrent.futures
+import threading
+import time
+from typing import Dict
+import requests
+from requests.adapters import HTTPAdapter
+from throttling import AdaptiveLimiter, TokenBucket, backoff_delay, parse_retry_after
+
+# Status codes that mean "slow down": they shrink the concurrency budget
+THROTTLE_STATUSES = {429, 503}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class RequestScheduler:
+    """
+    Runs HTTP requests on a shared requests.Session under one global budget:
+    an adaptive (AIMD) concurrency limit, an optional requests-per-second rate,
+    and retries with jittered backoff on throttling and transient errors.
+    """
+    def __init__(self, session: requests.Session, max_concurrency: int = 16,
+                 rate_per_second: float = 0, max_retries: int = 5):
+        self.session = session
+        self.max_retries = max_retries
+        self.limiter = AdaptiveLimiter(max_limit=max_concurrency)
+        self.bucket = TokenBucket(rate_per_second) if rate_per_second > 0 else None
+
+        # Size the connection pool to the concurrency budget so requests never queue on a connection
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrency)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="inriver-request")
+        self._pause_until = 0.0
+        self._lock = threading.Lock()
+        self.requests_sent = 0
+        self.retries = 0
+
+    def _wait_for_pause(self) -> None:
+        with self._lock:
+            delay = self._pause_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _pause(self, seconds: float) -> None:
+        with self._lock:
+            self._pause_until = max(self._pause_until, time.monotonic() + seconds)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a request within the budget and returns the final response.
+        Throttled or failing responses are retried; the last response is returned
+        as-is so callers can keep using .ok / raise_for_status().
+        """
+        attempt = 0
+        while True:
+            self._wait_for_pause()
+            if self.bucket:
+                self.bucket.acquire()
+
+            try:
+                with self.limiter:
+                    with self._lock:
+                        self.requests_sent += 1
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                self.limiter.on_success()
+                return response
+            if attempt >= self.max_retries:
+                return response
+
+            delay = backoff_delay(attempt)
+            if response is not None and response.status_code in THROTTLE_STATUSES:
+                self.limiter.on_throttle()
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if retry_after is not None:
+                    # The server told everyone to back off, not just this request
+                    delay = retry_after
+                    self._pause(retry_after)
+
+            with self._lock:
+                self.retries += 1
+            attempt += 1
+            time.sleep(delay)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def submit(self, method: str, url: str, **kwargs) -> concurrent.futures.Future:
+        """
+        Schedules a request and returns a Future of its response.
+        """
+        return self.executor.submit(self.request, method, url, **kwargs)
+
+    def submit_call(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        """
+        Schedules an arbitrary callable that itself issues requests through request().
+        """
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counters = {"requests_sent": self.requests_sent, "retries": self.retries}
+        counters.update(self.limiter.stats())
+        return counters
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,66 @@
+import pathlib
+import sys
+
+import pytest
+
+# The modules live in the repository root
+ROOT = str(pathlib.Path(__file__).resolve().parent.parent)
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from fakes import FakeFirestore, FakeInRiver, ImageServer
+
+@pytest.fixture
+def firestore_db():
+    db = FakeFirestore()
+    # Search queries the vector field of the test backend (local, 8 dimensions)
+    db.docs["searchConfig/active"] = {"embedding_field": "embedding_local_hash_8"}
+    return db
+
+@pytest.fixture
+def inriver():
+    return FakeInRiver()
+
+@pytest.fixture
+def image_server():
+    server = ImageServer()
+    yield server
+    server.close()
+
+@pytest.fixture
+def make_processor(monkeypatch, firestore_db, inriver):
+    """
+    Builds BatchProcessors on the fakes: Firestore in memory, InRiver from a dict and the
+    deterministic local embedding backend. Extra keyword arguments become environment variables.
+    """
+    import batch_processor
+    import firestore_client
+
+    monkeypatch.setattr(firestore_client.firestore, "Client", lambda *args, **kwargs: firestore_db)
+    monkeypatch.setattr(batch_processor, "InRiverClient", lambda *args, **kwargs: inriver)
+    created = []
+
+    def make(dry_run=False, shard_index=None, shard_count=None, **env):
+        settings = {
+            "ECOM_INRIVER_API_KEY": "test",
+            "GOOGLE_CLOUD_PROJECT": "test",
+            "EMBEDDING_BACKEND": "local",
+            "LOCAL_EMBEDDING_DIMENSION": "8",
+            "EMBEDDING_CACHE_PATH": "",
+            "PREPROCESS_WORKERS": "1",
+            "DOWNLOAD_MAX_CONNECTIONS": "4",
+            "EMBEDDING_MAX_CONCURRENCY": "2",
+            "FIRESTORE_WRITE_BATCH_SIZE": "1",
+        }
+        settings.update(env)
+        for key, value in settings.items():
+            monkeypatch.setenv(key, str(value))
+        processor = batch_processor.BatchProcessor(dry_run=dry_run, shard_index=shard_index, shard_count=shard_count)
+        created.append(processor)
+        return processor
+
+    yield make
+    for processor in created:
+        processor.pipeline.close()
+        processor.preprocessor.close()
+        processor.writer.close()
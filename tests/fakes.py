@@ -0,0 +1,318 @@
+"""
+In-memory stand-ins for the services BatchProcessor talks to: a Firestore client
+(documents, batches, projected queries, count() and transforms), an InRiver client
+serving Items from a dict, and an HTTP server for product images (ETag / 304).
+FirestoreClient and BatchedWriter run unchanged on top of FakeFirestore.
+"""
+import hashlib
+import io
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore
+from google.cloud.firestore_v1.transforms import Increment
+from google.cloud.firestore_v1.vector import Vector
+from PIL import Image
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+class FakeDocument:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self._db, f"{self.path}/{name}")
+
+    def get(self, field_paths=None):
+        return FakeSnapshot(self, self._db.read(self.path, field_paths))
+
+    def set(self, data, merge=False):
+        self._db.commit([(self, data, merge)])
+
+class FakeQuery:
+    def __init__(self, db, path, filters=(), fields=None, limit=None, order=None, start_after=None):
+        self._db = db
+        self._path = path
+        self._filters = list(filters)
+        self._fields = fields
+        self._limit = limit
+        self._order = order
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, fields=self._fields, limit=self._limit, order=self._order,
+                     start_after=self._start_after)
+        state.update(changes)
+        return FakeQuery(self._db, self._path, **state)
+
+    def where(self, filter):
+        return self._copy(filters=self._filters + [filter])
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def order_by(self, field):
+        return self._copy(order=field)
+
+    def start_after(self, values):
+        return self._copy(start_after=values.get("__name__"))
+
+    def _matches(self, data):
+        for f in self._filters:
+            value = data.get(f.field_path)
+            if f.op_string == "==" and not (f.field_path in data and value == f.value):
+                return False
+            if f.op_string == "in" and value not in f.value:
+                return False
+        return True
+
+    def stream(self):
+        docs = [(doc_id, data) for doc_id, data in self._db.children(self._path) if self._matches(data)]
+        if self._order and self._order != "__name__":
+            docs.sort(key=lambda pair: pair[1].get(self._order))
+        if self._start_after is not None:
+            docs = [(doc_id, data) for doc_id, data in docs if doc_id > self._start_after]
+        if self._limit:
+            docs = docs[:self._limit]
+        for doc_id, data in docs:
+            if self._fields is not None:
+                data = {key: data[key] for key in self._fields if key in data}
+            yield FakeSnapshot(FakeDocument(self._db, f"{self._path}/{doc_id}"), data)
+
+    def count(self):
+        query = self
+
+        class _Aggregation:
+            def get(self):
+                return [[type("Result", (), {"value": sum(1 for _ in query.stream())})()]]
+        return _Aggregation()
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, doc_id=None):
+        return FakeDocument(self._db, f"{self._path}/{doc_id or uuid.uuid4().hex[:20]}")
+
+class FakeBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append((ref, data, merge))
+
+    def delete(self, ref):
+        self._writes.append((ref, None, False))
+
+    def commit(self):
+        self._db.commit(self._writes)
+
+class FakeFirestore:
+    """
+    Stands in for google.cloud.firestore.Client. Documents live in a dict keyed by path.
+    Commits touching a document path in fail_paths raise (non-retryable), like a rejected batch;
+    while unavailable is above zero each commit uses one up and raises ServiceUnavailable.
+    """
+    def __init__(self):
+        self.docs = {}
+        self.fail_paths = set()
+        self.unavailable = 0
+        self.commits = 0
+        self._lock = threading.RLock()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def get_all(self, refs, field_paths=None):
+        return [ref.get(field_paths) for ref in refs]
+
+    def recursive_delete(self, ref):
+        with self._lock:
+            doomed = [path for path in self.docs if path == ref.path or path.startswith(ref.path + "/")]
+            for path in doomed:
+                del self.docs[path]
+        return len(doomed)
+
+    def read(self, path, fields=None):
+        with self._lock:
+            data = self.docs.get(path)
+        if data is None:
+            return None
+        return {key: data[key] for key in fields if key in data} if fields is not None else dict(data)
+
+    def children(self, path):
+        prefix = path + "/"
+        with self._lock:
+            return sorted((doc_path[len(prefix):], dict(data)) for doc_path, data in self.docs.items()
+                          if doc_path.startswith(prefix) and "/" not in doc_path[len(prefix):])
+
+    def commit(self, writes):
+        if any(ref.path in self.fail_paths for ref, _, _ in writes):
+            raise google_exceptions.InvalidArgument("rejected by the fake")
+        with self._lock:
+            if self.unavailable > 0:
+                self.unavailable -= 1
+                raise google_exceptions.ServiceUnavailable("unavailable in the fake")
+            for ref, data, merge in writes:
+                if data is None:
+                    self.docs.pop(ref.path, None)
+                    continue
+                current = dict(self.docs.get(ref.path) or {}) if merge else {}
+                for key, value in data.items():
+                    if isinstance(value, Increment):
+                        value = (current.get(key) or 0) + value.value
+                    elif value is firestore.SERVER_TIMESTAMP:
+                        value = time.time()
+                    elif isinstance(value, Vector):
+                        value = list(value)
+                    current[key] = value
+                self.docs[ref.path] = current
+            self.commits += 1
+
+    # Shortcuts for assertions
+    def products(self, collection="products"):
+        return dict(self.children(collection))
+
+    def errors(self):
+        return dict(self.children("processingErrors"))
+
+class FakeInRiver:
+    """
+    Stands in for InRiverClient: query_item_ids returns the sorted Item IDs and iter_items
+    yields the given Item records. IDs in drop are never yielded (a failed fetch), those
+    in drop_once only the first time they are asked for.
+    """
+    def __init__(self, items=None):
+        self.items = dict(items or {})
+        self.drop = set()
+        self.drop_once = set()
+        self.queries = []
+
+    def add_item(self, item_id, image_urls, item_code=None, name="Blazer"):
+        self.items[item_id] = {
+            "entity_id": item_id,
+            "item_fields": {"ItemCode": item_code or f"C-{item_id}"},
+            "product_fields": {"ProductNameCommercial": {"nl-NL": name}, "product_entity_id": 9000 + item_id},
+            "image_urls": list(image_urls),
+            "images_complete": True,
+        }
+
+    def query_item_ids(self, data_criteria=None, modified_since=None):
+        self.queries.append((data_criteria, modified_since))
+        return sorted(self.items)
+
+    def iter_items(self, item_ids, prefetch=32):
+        for item_id in item_ids:
+            if item_id in self.drop_once:
+                self.drop_once.discard(item_id)
+                continue
+            if item_id in self.items and item_id not in self.drop:
+                yield dict(self.items[item_id])
+
+    def reset_caches(self):
+        pass
+
+    def cache_stats(self):
+        return {}
+
+    def request_stats(self):
+        return {"requests_sent": 0, "retries": 0, "throttle_events": 0}
+
+def png_bytes(color, size=(64, 48)):
+    """
+    A small PNG with a coloured block, distinct per colour (also for the perceptual hash).
+    """
+    img = Image.new("RGB", size, (255, 255, 255))
+    img.paste(color, (0, 0, size[0] // 2, size[1] // 2))
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+class ImageHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = self.server.images.get(self.path)
+        with self.server.lock:
+            self.server.requests.append(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        validators = {}
+        if self.server.etags:
+            validators["ETag"] = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+        if self.path in self.server.last_modified:
+            validators["Last-Modified"] = self.server.last_modified[self.path]
+        if ((validators.get("ETag") and self.headers.get("If-None-Match") == validators["ETag"])
+                or (validators.get("Last-Modified") and self.headers.get("If-Modified-Since") == validators["Last-Modified"])):
+            self.send_response(304)
+            for name, value in validators.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", self.server.content_types.get(self.path, "image/png"))
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in validators.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+class ImageServer:
+    """
+    Serves images from a dict {path: bytes}; url(path) gives the address to put in an Item.
+    Responses carry an ETag (unless etags is False) and the Last-Modified set per path,
+    and answer a matching If-None-Match / If-Modified-Since with 304.
+    """
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+        self.server.images = {}
+        self.server.etags = True
+        self.server.last_modified = {}
+        self.server.content_types = {}
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def images(self):
+        return self.server.images
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_address[1]}{path}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
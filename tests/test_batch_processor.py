@@ -0,0 +1,312 @@
+"""
+BatchProcessor on in-memory fakes (see fakes.py): indexing, conditional downloads and
+hash skips, write failures, the retry queue, orphan GC and sharding.
+"""
+import pytest
+
+from fakes import png_bytes
+
+RED, GREEN, BLUE = (200, 20, 20), (20, 200, 20), (20, 20, 200)
+
+def _serve(image_server, inriver, item_id, colors):
+    urls = []
+    for idx, color in enumerate(colors):
+        path = f"/{item_id}_{idx}.png"
+        image_server.images[path] = png_bytes(color)
+        urls.append(image_server.url(path))
+    inriver.add_item(item_id, urls)
+
+def test_process_batch_indexes_every_image(make_processor, firestore_db, inriver, image_server):
+    _serve(image_server, inriver, 1, [RED, GREEN])
+    _serve(image_server, inriver, 2, [BLUE])
+    processor = make_processor()
+    processor.run_id = "test"
+
+    stats = processor.process_batch([1, 2])
+    processor.writer.flush()
+
+    assert stats["items_processed"] == 2 and stats["images_indexed"] == 3 and stats["failed"] == 0
+    products = firestore_db.products()
+    assert set(products) == {"item_1_0", "item_1_1", "item_2_0"}
+    doc = products["item_1_0"]
+    assert len(doc[processor.vector_field]) == 8
+    assert doc["embedding_model"] == processor.vision.model_key
+    assert doc["image_etag"] and doc["image_hash"]
+    ledger = dict(firestore_db.children("ingestionLedger/products/items"))
+    assert ledger["item_1"]["status"] == "ok" and ledger["item_1"]["indexed_count"] == 2
+
+def test_failed_commit_becomes_an_image_failure(make_processor, firestore_db, inriver, image_server):
+    _serve(image_server, inriver, 1, [RED, GREEN])
+    firestore_db.fail_paths.add("products/item_1_0")
+    processor = make_processor()
+    processor.run_id = "test"
+
+    stats = processor.process_batch([1])
+    processor.writer.flush()
+
+    assert stats["images_indexed"] == 1 and stats["failed"] == 1
+    assert set(firestore_db.products()) == {"item_1_1"}
+    record = firestore_db.errors()["item_1_0"]
+    assert record["resolved"] is False and record["image_idx"] == 0 and record["attempts"] == 1
+    ledger = dict(firestore_db.children("ingestionLedger/products/items"))
+    assert ledger["item_1"]["status"] == "partial"
+
+def test_retry_only_resolves_records_of_images_it_reached(make_processor, firestore_db, inriver, image_server):
+    _serve(image_server, inriver, 1, [RED, GREEN])
+    firestore_db.fail_paths.add("products/item_1_1")
+    processor = make_processor()
+    processor.run_id = "test"
+    processor.process_batch([1])
+    processor.writer.flush()
+    firestore_db.fail_paths.clear()
+
+    # InRiver drops the Item once: nothing was retried, so the record stays open and backs off
+    inriver.drop_once.add(1)
+    result = processor.retry_failed()
+    record = firestore_db.errors()["item_1_1"]
+    assert result["resolved"] == 0 and result["not_reached"] == 1
+    assert record["resolved"] is False and record["next_retry_at"] > 0
+
+    # The failed fetch left a record of its own; the next retry fetches the whole Item and closes it,
+    # while the backed-off image record waits for its next_retry_at
+    assert firestore_db.errors()["item_1"]["resolved"] is False
+    result = processor.retry_failed()
+    assert result["resolved"] == 1 and firestore_db.errors()["item_1"]["resolved"] is True
+    assert firestore_db.errors()["item_1_1"]["resolved"] is False
+    assert "item_1_1" in firestore_db.products()
+
+    firestore_db.docs["processingErrors/item_1_1"]["next_retry_at"] = 0
+    result = processor.retry_failed()
+    record = firestore_db.errors()["item_1_1"]
+    assert result["resolved"] == 1
+    assert record["resolved"] is True and record["resolved_by"] == result["run_id"]
+
+def test_unfetched_items_fail_and_are_no_incremental_baseline(make_processor, firestore_db, inriver, image_server):
+    _serve(image_server, inriver, 1, [RED])
+    _serve(image_server, inriver, 2, [GREEN, BLUE])
+    inriver.drop.add(2)
+    processor = make_processor()
+
+    stats = processor.run(total_limit=10, mode="full")
+
+    assert stats["total_failed"] == 1 and stats["total_unfetched"] == 1
+    record = firestore_db.errors()["item_2"]
+    assert record["resolved"] is False and record["image_idx"] is None
+    run = firestore_db.read(f"batchProgress/{stats['run_id']}")
+    assert run["status"] == "completed" and run["items_unfetched"] == 1
+    assert processor.db.get_last_completed_run() is None
+    assert processor.select_mode("auto") == ("full", None)
+
+    # The retry fetches the whole Item and closes the Item record
+    inriver.drop.clear()
+    result = processor.retry_failed()
+    assert result["resolved"] == 1 and result["images_indexed"] == 2
+    assert firestore_db.errors()["item_2"]["resolved"] is True
+    assert {"item_2_0", "item_2_1"} <= set(firestore_db.products())
+
+def test_unchanged_images_are_skipped_by_conditional_get_and_hash(make_processor, firestore_db, inriver, image_server):
+    _serve(image_server, inriver, 1, [RED, GREEN])
+    processor = make_processor()
+    processor.run_id = "test"
+    processor.process_batch([1])
+    processor.writer.flush()
+
+    # Same URL and ETag: HTTP 304, nothing is embedded
+    stats = processor.process_batch([1])
+    assert stats["not_modified"] == 2 and stats["images_indexed"] == 0
+
+    # Same bytes behind a new URL: downloaded, but the hash matches; only the URL is updated
+    image_server.images["/moved.png"] = image_server.images["/1_0.png"]
+    inriver.items[1]["image_urls"][0] = image_server.url("/moved.png")
+    stats = processor.process_batch([1])
+    processor.writer.flush()
+    assert stats["images_indexed"] == 0 and stats["metadata_updated"] == 1 and stats["not_modified"] == 1
+    assert firestore_db.products()["item_1_0"]["image_url"].endswith("/moved.png")
+
+def test_unchanged_images_are_embedded_again_for_another_backend(make_processor, firestore_db, inriver, image_server):
+    _serve(image_server, inriver, 1, [RED, GREEN])
+    first = make_processor()
+    first.run_id = "test"
+    first.process_batch([1])
+    first.writer.flush()
+
+    # Another model (here: dimension) must not be fooled by the stored ETag and hash
+    second = make_processor(LOCAL_EMBEDDING_DIMENSION="16")
+    second.run_id = "test"
+    stats = second.process_batch([1])
+    second.writer.flush()
+    assert stats["images_indexed"] == 2 and stats["not_modified"] == 0
+    doc = firestore_db.products()["item_1_0"]
+    assert len(doc[second.vector_field]) == 16 and doc["embedding_dim"] == 16
+
+    assert second.process_batch([1])["not_modified"] == 2
+
+def test_refuses_to_ingest_a_vector_field_search_does_not_query(make_processor, firestore_db, inriver, image_server):
+    _serve(image_server, inriver, 1, [RED])
+    processor = make_processor(LOCAL_EMBEDDING_DIMENSION="16")
+
+    with pytest.raises(RuntimeError, match="embedding_local_hash_8"):
+        processor.run(total_limit=10, mode="full")
+    with pytest.raises(RuntimeError):
+        processor.retry_failed()
+    assert firestore_db.products() == {}
+
+    # A rebuild writes into a collection search does not serve yet
+    processor.run(total_limit=10, mode="full", target_collection="products_green")
+    assert set(firestore_db.products("products_green")) == {"item_1_0"}
+
+def test_full_run_removes_items_outside_the_filter_with_their_error_records(make_processor, firestore_db, inriver,
+                                                                            image_server):
+    for item_id, color in zip(range(1, 6), [RED, GREEN, BLUE, RED, GREEN]):
+        _serve(image_server, inriver, item_id, [color])
+    _serve(image_server, inriver, 5, [GREEN, BLUE])
+    firestore_db.fail_paths.add("products/item_5_1")
+    processor = make_processor()
+    processor.run(total_limit=10, mode="full")
+    firestore_db.fail_paths.clear()
+    assert "item_5_0" in firestore_db.products() and firestore_db.errors()["item_5_1"]["resolved"] is False
+
+    # Item 5 leaves the filter: its document goes, and its failed image is not retried into the collection
+    del inriver.items[5]
+    stats = processor.run(total_limit=10, mode="full")
+    assert stats["total_orphans_deleted"] == 1
+    assert set(firestore_db.products()) == {"item_1_0", "item_2_0", "item_3_0", "item_4_0"}
+    record = firestore_db.errors()["item_5_1"]
+    assert record["resolved"] is True and record["resolution"] == "Item no longer matches the filter"
+    processor.retry_failed()
+    assert "item_5_1" not in firestore_db.products()
+    assert "item_5" not in dict(firestore_db.children("ingestionLedger/products/items"))
+
+def test_orphan_sweep_refuses_to_delete_a_large_part_of_the_collection(make_processor, firestore_db, inriver,
+                                                                       image_server):
+    for item_id, color in zip(range(1, 4), [RED, GREEN, BLUE]):
+        _serve(image_server, inriver, item_id, [color])
+    processor = make_processor()
+    processor.run(total_limit=10, mode="full")
+
+    # Two of three Items gone at once looks like a broken query, not like real deletions
+    del inriver.items[2], inriver.items[3]
+    stats = processor.run(total_limit=10, mode="full")
+    assert stats["total_orphans_deleted"] == 0
+    assert set(firestore_db.products()) == {"item_1_0", "item_2_0", "item_3_0"}
+
+def test_error_records_belong_to_their_products_collection(make_processor, firestore_db, inriver, image_server):
+    _serve(image_server, inriver, 1, [RED, GREEN])
+    firestore_db.fail_paths.add("products_green/item_1_1")
+    processor = make_processor()
+    processor.run(total_limit=10, mode="full", target_collection="products_green")
+    firestore_db.fail_paths.clear()
+    record = firestore_db.errors()["products_green_item_1_1"]
+    assert record["resolved"] is False and record["products_collection"] == "products_green"
+
+    # Indexing the image into the served collection does not repair the rebuild
+    processor.run(total_limit=10, mode="full")
+    assert "item_1_1" in firestore_db.products()
+    assert firestore_db.errors()["products_green_item_1_1"]["resolved"] is False
+    assert processor.retry_failed()["resolved"] == 0
+
+    result = processor.retry_failed(collection="products_green")
+    assert result["resolved"] == 1 and firestore_db.errors()["products_green_item_1_1"]["resolved"] is True
+    assert "item_1_1" in firestore_db.products("products_green")
+
+def test_near_duplicates_reuse_embeddings_only_when_they_are_current(make_processor, firestore_db, inriver,
+                                                                     image_server):
+    _serve(image_server, inriver, 1, [RED, GREEN])
+    _serve(image_server, inriver, 2, [RED])
+    processor = make_processor(PHASH_DEDUPE="true")
+    processor.run_id = "test"
+    processor.process_batch([1])
+    # Same picture on another Item: embedded earlier in this run, so its vector is reused
+    stats = processor.process_batch([2])
+    processor.writer.flush()
+    assert stats["deduplicated"] == 1
+    products = firestore_db.products()
+    assert products["item_2_0"]["duplicate_of"] == "item_1_0"
+    assert products["item_2_0"][processor.vector_field] == products["item_1_0"][processor.vector_field]
+
+    # An image still being embedded has no vector yet; its document holds the one of the image it replaces
+    firestore_db.docs["products/item_9_0"] = {processor.vector_field: [1.0] * 8, "image_url": "old"}
+    assert processor._embedding_of("item_9_0") is None
+    # An unchanged image's stored vector is read, and only that field
+    reads = []
+    get_all = firestore_db.get_all
+    firestore_db.get_all = lambda refs, field_paths=None: reads.append(field_paths) or get_all(refs, field_paths)
+    assert processor._embedding_of("item_9_0", stored=True) == [1.0] * 8
+    assert reads == [[processor.vector_field]]
+
+def test_near_duplicate_within_an_item_replaces_the_document_at_its_index(make_processor, firestore_db, inriver,
+                                                                          image_server):
+    _serve(image_server, inriver, 1, [RED, GREEN])
+    processor = make_processor(PHASH_DEDUPE="true")
+    processor.run_id = "test"
+    processor.process_batch([1])
+    processor.writer.flush()
+
+    # The second image becomes a copy of the first: its old document must not stay searchable
+    image_server.images["/copy.png"] = image_server.images["/1_0.png"]
+    inriver.items[1]["image_urls"][1] = image_server.url("/copy.png")
+    stats = processor.process_batch([1])
+    processor.writer.flush()
+    assert stats["deduplicated"] == 1 and stats["images_indexed"] == 0
+    assert set(firestore_db.products()) == {"item_1_0"}
+
+def test_last_modified_is_stored_and_sent_when_there_is_no_etag(make_processor, firestore_db, inriver, image_server):
+    image_server.server.etags = False
+    _serve(image_server, inriver, 1, [RED])
+    image_server.server.last_modified["/1_0.png"] = "Wed, 01 Oct 2025 08:00:00 GMT"
+    processor = make_processor()
+    processor.run_id = "test"
+    processor.process_batch([1])
+    processor.writer.flush()
+    doc = firestore_db.products()["item_1_0"]
+    assert doc["image_etag"] is None and doc["image_last_modified"] == "Wed, 01 Oct 2025 08:00:00 GMT"
+
+    assert processor.process_batch([1])["not_modified"] == 1
+
+def test_changed_metadata_is_written_without_a_new_embedding(make_processor, firestore_db, inriver, image_server):
+    _serve(image_server, inriver, 1, [RED, GREEN])
+    processor = make_processor()
+    processor.run_id = "test"
+    processor.process_batch([1])
+    processor.writer.flush()
+    before = firestore_db.products()
+
+    # Nothing changed: no document is written
+    stats = processor.process_batch([1])
+    processor.writer.flush()
+    assert stats["metadata_updated"] == 0 and firestore_db.products() == before
+
+    # A renamed product and a corrected ItemCode reach every image document; the vectors stay
+    inriver.items[1]["product_fields"]["ProductNameCommercial"] = {"nl-NL": "Colbert"}
+    inriver.items[1]["item_fields"]["ItemCode"] = "C-1-FIXED"
+    stats = processor.process_batch([1])
+    processor.writer.flush()
+    assert stats["metadata_updated"] == 2 and stats["images_indexed"] == 0
+    for doc_id, doc in firestore_db.products().items():
+        assert doc["name"] == {"nl-NL": "Colbert"} and doc["item_code"] == "C-1-FIXED"
+        assert doc[processor.vector_field] == before[doc_id][processor.vector_field]
+        assert doc["last_updated"] == before[doc_id]["last_updated"] and doc["metadata_updated_at"]
+
+def test_retry_backs_off_images_that_keep_failing(make_processor, firestore_db, inriver, image_server):
+    _serve(image_server, inriver, 1, [RED, GREEN])
+    _serve(image_server, inriver, 2, [BLUE])
+    firestore_db.fail_paths.update({"products/item_1_1", "products/item_2_0"})
+    processor = make_processor()
+    processor.run_id = "test"
+    processor.process_batch([1, 2])
+    processor.writer.flush()
+    firestore_db.fail_paths.discard("products/item_2_0")
+
+    # Only the failed images are processed again; item_1_0 is neither downloaded nor written
+    image_server.requests.clear()
+    result = processor.retry_failed()
+    assert result["resolved"] == 1 and result["still_failing"] == 1
+    assert sorted(image_server.requests) == ["/1_1.png", "/2_0.png"]
+    record = firestore_db.errors()["item_1_1"]
+    assert record["attempts"] == 2 and record["resolved"] is False
+    assert record["next_retry_at"] >= record["timestamp"] + 600 - 5
+
+    # Until next_retry_at has passed the record is not picked up
+    image_server.requests.clear()
+    result = processor.retry_failed()
+    assert result["still_failing"] == 0 and result["not_reached"] == 0 and image_server.requests == []
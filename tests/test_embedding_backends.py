@@ -0,0 +1,31 @@
+"""
+The EmbeddingBackend interface, the local backend and the versioned vector fields.
+"""
+import math
+
+import pytest
+
+from embedding_backends import EmbeddingBackend, LocalHashEmbeddingBackend, get_embedding_backend, vector_field_for
+
+def test_a_backend_without_embed_cannot_be_created():
+    class Incomplete(EmbeddingBackend):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+def test_local_backend_is_deterministic_per_image():
+    backend = LocalHashEmbeddingBackend(dimension=16)
+    first = backend.embed(b"image")
+    assert len(first) == 16 and math.isclose(sum(v * v for v in first), 1.0, rel_tol=1e-5)
+    assert backend.embed(b"image") == first
+    assert backend.embed(b"other") != first
+    assert backend.embed_batch([b"image", b"other"]) == [first, backend.embed(b"other")]
+    assert backend.get_embedding(b"") is None
+
+def test_each_model_and_dimension_has_its_own_vector_field():
+    assert vector_field_for(LocalHashEmbeddingBackend(dimension=8)) == "embedding_local_hash_8"
+    backend = get_embedding_backend({"EMBEDDING_BACKEND": "local", "LOCAL_EMBEDDING_DIMENSION": 16})
+    assert vector_field_for(backend) == "embedding_local_hash_16"
+    with pytest.raises(ValueError):
+        get_embedding_backend({"EMBEDDING_BACKEND": "unknown"})
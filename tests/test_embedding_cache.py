@@ -0,0 +1,49 @@
+"""
+EmbeddingCache (SQLite): keys, persistence, LRU eviction, and its use by BatchProcessor.
+"""
+from embedding_cache import EmbeddingCache, open_embedding_cache
+from fakes import png_bytes
+
+def test_vectors_are_keyed_by_hash_model_and_dimension(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    cache.put("abc", "model-a", 3, [0.5, -1.0, 2.0])
+    assert cache.get("abc", "model-a", 3) == [0.5, -1.0, 2.0]
+    assert cache.get("abc", "model-b", 3) is None
+    assert cache.get("abc", "model-a", 4) is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "entries": 1, "bytes": 12}
+    cache.close()
+
+    reopened = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    assert reopened.get("abc", "model-a", 3) == [0.5, -1.0, 2.0]
+    reopened.close()
+
+def test_least_recently_used_vectors_are_evicted(tmp_path):
+    # 4 bytes per float: room for two vectors of 8 dimensions
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), max_bytes=80)
+    cache.put("first", "m", 8, [1.0] * 8)
+    cache.put("second", "m", 8, [2.0] * 8)
+    assert cache.get("first", "m", 8)
+    cache.put("third", "m", 8, [3.0] * 8)
+    assert cache.get("second", "m", 8) is None
+    assert cache.get("first", "m", 8) and cache.get("third", "m", 8)
+    assert cache.stats()["bytes"] <= 80
+    cache.close()
+
+def test_cache_is_off_without_a_path():
+    assert open_embedding_cache({"EMBEDDING_CACHE_PATH": ""}) is None
+
+def test_rebuild_reuses_cached_embeddings(make_processor, firestore_db, inriver, image_server, tmp_path):
+    for item_id, color in ((1, (200, 20, 20)), (2, (20, 200, 20))):
+        image_server.images[f"/{item_id}.png"] = png_bytes(color)
+        inriver.add_item(item_id, [image_server.url(f"/{item_id}.png")])
+    processor = make_processor(EMBEDDING_CACHE_PATH=str(tmp_path / "embeddings.sqlite"))
+    processor.run(total_limit=10, mode="full")
+    assert processor.embedding_cache.stats()["entries"] == 2
+
+    calls = processor.embedder.stats()["calls"]
+    assert calls > 0
+    processor.run(total_limit=10, mode="full", target_collection="products_green")
+    assert processor.embedding_cache.stats()["hits"] == 2
+    assert processor.embedder.stats()["calls"] == calls
+    green = firestore_db.products("products_green")
+    assert green["item_1_0"][processor.vector_field] == firestore_db.products()["item_1_0"][processor.vector_field]
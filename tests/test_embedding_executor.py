@@ -0,0 +1,82 @@
+"""
+EmbeddingExecutor and the AIMD limiter: retries of throttled and transient errors,
+immediate failures, and concurrency under the limit.
+"""
+import threading
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+import embedding_executor
+from embedding_executor import EmbeddingExecutor
+from throttling import AdaptiveLimiter
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(embedding_executor, "backoff_delay", lambda attempt, base, cap: 0.0)
+
+class Flaky:
+    """
+    Raises the given errors in turn, then returns "ok".
+    """
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+def test_limiter_halves_on_throttle_and_grows_back():
+    limiter = AdaptiveLimiter(max_limit=8, initial=8, cooldown=60)
+    limiter.on_throttle()
+    limiter.on_throttle()
+    # Once per cooldown: the second throttle in a row does not halve again
+    assert limiter.stats() == {"limit": 4, "in_flight": 0, "throttle_events": 2}
+    for _ in range(40):
+        limiter.on_success()
+    assert limiter.stats()["limit"] == 8
+
+def test_throttled_and_transient_errors_are_retried():
+    executor = EmbeddingExecutor(max_concurrency=4, max_retries=3)
+    fn = Flaky(google_exceptions.ResourceExhausted("quota"), google_exceptions.DeadlineExceeded("slow"))
+    assert executor.call(fn) == "ok"
+    stats = executor.stats()
+    assert fn.calls == 3 and stats["retries"] == 2 and stats["errors"] == 2 and stats["calls"] == 1
+    # Only the quota error counts as throttling
+    assert stats["throttle_events"] == 1
+    executor.close()
+
+def test_other_errors_and_exhausted_retries_are_raised():
+    executor = EmbeddingExecutor(max_concurrency=2, max_retries=1)
+    invalid = Flaky(google_exceptions.InvalidArgument("bad image"))
+    with pytest.raises(google_exceptions.InvalidArgument):
+        executor.call(invalid)
+    assert invalid.calls == 1
+
+    unavailable = Flaky(*[google_exceptions.ServiceUnavailable("down")] * 3)
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        executor.call(unavailable)
+    assert unavailable.calls == 2
+    executor.close()
+
+def test_map_keeps_order_and_stays_within_the_limit():
+    executor = EmbeddingExecutor(max_concurrency=4)
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def embed(value):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return value * 2
+
+    assert executor.map(embed, list(range(20))) == [value * 2 for value in range(20)]
+    assert 1 < peak[0] <= 4
+    executor.close()
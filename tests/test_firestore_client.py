@@ -0,0 +1,79 @@
+"""
+FirestoreClient and BatchedWriter on FakeFirestore: buffered commits, retries, failure
+reports and the error-record queries.
+"""
+import threading
+
+import pytest
+
+import firestore_client
+from firestore_client import BatchedWriter, FirestoreClient
+
+@pytest.fixture
+def client(monkeypatch, firestore_db):
+    monkeypatch.setenv("GOOGLE_CLOUD_PROJECT", "test")
+    monkeypatch.setenv("ECOM_INRIVER_API_KEY", "test")
+    monkeypatch.setattr(firestore_client.firestore, "Client", lambda *args, **kwargs: firestore_db)
+    monkeypatch.setattr(firestore_client, "backoff_delay", lambda attempt: 0.0)
+    return FirestoreClient()
+
+def test_writes_are_committed_flush_size_at_a_time(client, firestore_db):
+    writer = BatchedWriter(client, flush_size=3)
+    for doc_id in range(7):
+        writer.upsert_product({"doc_id": f"item_{doc_id}_0", "embedding": [0.1, 0.2]})
+    # Two full batches went out on their own; the last write waits for flush()
+    assert writer.stats()["buffered"] == 1
+    report = writer.close()
+    assert report == {"written": 7, "commits": 3, "retries": 0, "failed": 0, "buffered": 0}
+    assert firestore_db.products()["item_0_0"]["embedding"] == [0.1, 0.2]
+
+def test_retryable_failures_are_retried(client, firestore_db):
+    firestore_db.unavailable = 2
+    writer = BatchedWriter(client, flush_size=10)
+    writer.upsert_product({"doc_id": "item_1_0", "name": "Blazer"})
+    writer.flush()
+    assert writer.stats()["retries"] == 2 and writer.stats()["written"] == 1
+    assert writer.take_failed_products() == []
+    writer.close()
+
+def test_failed_commits_are_reported_with_their_products(client, firestore_db):
+    firestore_db.fail_paths.add("products/item_2_0")
+    writer = BatchedWriter(client, flush_size=10)
+    writer.upsert_product({"doc_id": "item_1_0", "name": "Blazer"})
+    writer.upsert_product({"doc_id": "item_2_0", "name": "Broek"})
+    writer.update_error("item_3_0", {"resolved": True})
+    writer.flush()
+    # The batch is rejected as a whole: every write in it failed, product upserts are returned for follow-up
+    stats = writer.stats()
+    assert stats["failed"] == 3 and stats["written"] == 0
+    assert sorted(doc_id for doc_id, _ in writer.take_failed_products()) == ["item_1_0", "item_2_0"]
+    assert writer.take_failed_products() == []
+    assert any(failure.startswith("products/item_2_0") for failure in writer.failures)
+    writer.close()
+
+def test_writers_block_while_all_commit_slots_are_taken(client, firestore_db):
+    release = threading.Event()
+    commit = firestore_db.commit
+    firestore_db.commit = lambda writes: release.wait(2) and commit(writes)
+    writer = BatchedWriter(client, flush_size=1, max_in_flight=1)
+    writer.upsert_product({"doc_id": "item_1_0"})
+    second = threading.Thread(target=writer.upsert_product, args=({"doc_id": "item_2_0"},))
+    second.start()
+    second.join(0.1)
+    assert second.is_alive()
+    release.set()
+    second.join(2)
+    assert writer.close()["written"] == 2
+
+def test_unresolved_errors_can_be_limited_to_a_collection(client, firestore_db):
+    firestore_db.docs.update({
+        "processingErrors/item_1_0": {"doc_id": "item_1_0", "resolved": False},
+        "processingErrors/products_green_item_1_0": {"doc_id": "item_1_0", "resolved": False,
+                                                     "products_collection": "products_green"},
+        "processingErrors/item_2_0": {"doc_id": "item_2_0", "resolved": True},
+    })
+    assert {record_id for record_id, _ in client.get_unresolved_errors()} == {"item_1_0", "products_green_item_1_0"}
+    # Records from before products_collection was stored belong to the default collection
+    assert [record_id for record_id, _ in client.get_unresolved_errors(collection="products")] == ["item_1_0"]
+    green = client.get_unresolved_errors(fields=["doc_id"], collection="products_green")
+    assert green == [("products_green_item_1_0", {"doc_id": "item_1_0", "products_collection": "products_green"})]
@@ -0,0 +1,84 @@
+"""
+HedgedEmbeddingClient with fake backends: hedging after the delay, failover, deadlines
+and the bound on requests in flight.
+"""
+import threading
+import time
+
+import pytest
+
+from hedged_embedding import HedgedEmbeddingClient
+
+class FakeBackend:
+    def __init__(self, vector, gate=None, error=None):
+        self.vector = vector
+        self.gate = gate
+        self.error = error
+        self.calls = 0
+
+    def embed(self, image_bytes, contextual_text=None):
+        self.calls += 1
+        if self.gate is not None:
+            self.gate.wait(2)
+        if self.error:
+            raise self.error
+        return self.vector
+
+def _client(primary, secondary=None, **kwargs):
+    settings = dict(deadline=1.0, min_hedge_delay=0.05)
+    settings.update(kwargs)
+    return HedgedEmbeddingClient(primary, secondary=secondary, **settings)
+
+def test_fast_primary_is_not_hedged():
+    secondary = FakeBackend([2.0])
+    client = _client(FakeBackend([1.0]), secondary)
+    assert client.embed(b"image") == [1.0]
+    assert secondary.calls == 0 and client.stats()["hedges"] == 0
+    client.close()
+
+def test_slow_primary_is_hedged_to_the_secondary():
+    gate = threading.Event()
+    client = _client(FakeBackend([1.0], gate=gate), FakeBackend([2.0]))
+    assert client.embed(b"image") == [2.0]
+    stats = client.stats()
+    assert stats["hedges"] == 1 and stats["hedge_wins"] == 1
+    gate.set()
+    client.close()
+
+def test_failed_primary_hedges_right_away():
+    client = _client(FakeBackend(None, error=RuntimeError("unavailable")), FakeBackend([2.0]), min_hedge_delay=5)
+    assert client.embed(b"image") == [2.0]
+    client.close()
+
+def test_deadline_raises_timeout():
+    gate = threading.Event()
+    client = _client(FakeBackend([1.0], gate=gate), FakeBackend([2.0], gate=gate), deadline=0.2)
+    with pytest.raises(TimeoutError):
+        client.embed(b"image")
+    assert client.stats()["timeouts"] == 1
+    gate.set()
+    client.close()
+
+def test_no_hedge_while_the_pool_is_saturated():
+    primary_gate, secondary_gate = threading.Event(), threading.Event()
+    secondary = FakeBackend([2.0], gate=secondary_gate)
+    client = _client(FakeBackend([1.0], gate=primary_gate), secondary, deadline=0.3, max_in_flight=2)
+    # Both requests of the first call hang: the pool is full of abandoned requests
+    with pytest.raises(TimeoutError):
+        client.embed(b"image")
+    with pytest.raises(TimeoutError):
+        client.embed(b"image")
+    stats = client.stats()
+    assert secondary.calls == 1 and stats["hedges"] == 1 and stats["hedges_skipped"] == 1
+
+    # Once they ended, hedging works again
+    primary_gate.set()
+    secondary_gate.set()
+    deadline = time.monotonic() + 2
+    while client.stats()["in_flight"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert client.stats()["in_flight"] == 0
+    primary_gate.clear()
+    assert client.embed(b"image") == [2.0]
+    primary_gate.set()
+    client.close()
@@ -0,0 +1,63 @@
+"""
+ImageDownloader against the fake image server: conditional GETs (ETag / Last-Modified),
+skipped assets and the async variant.
+"""
+import asyncio
+
+import pytest
+
+from fakes import png_bytes
+from image_downloader import ImageDownloader
+
+@pytest.fixture
+def downloader():
+    downloader = ImageDownloader(max_connections=4, per_host_limit=2, max_bytes=10_000, timeout=5)
+    yield downloader
+    downloader.close()
+
+def test_etag_turns_a_repeat_download_into_a_304(downloader, image_server):
+    image_server.images["/a.png"] = png_bytes((200, 20, 20))
+    first = downloader.fetch(image_server.url("/a.png"))
+    assert first.content == image_server.images["/a.png"] and first.etag and not first.not_modified
+
+    again = downloader.fetch(image_server.url("/a.png"), etag=first.etag)
+    assert again.not_modified and again.content is None and again.etag == first.etag
+
+    # A changed asset has a new ETag: the body is transferred
+    image_server.images["/a.png"] = png_bytes((20, 200, 20))
+    changed = downloader.fetch(image_server.url("/a.png"), etag=first.etag)
+    assert changed.content == image_server.images["/a.png"] and changed.etag != first.etag
+
+def test_last_modified_is_used_without_an_etag(downloader, image_server):
+    image_server.server.etags = False
+    image_server.images["/b.png"] = png_bytes((20, 20, 200))
+    image_server.server.last_modified["/b.png"] = "Wed, 01 Oct 2025 08:00:00 GMT"
+    first = downloader.fetch(image_server.url("/b.png"))
+    assert first.etag is None and first.last_modified == "Wed, 01 Oct 2025 08:00:00 GMT"
+    assert downloader.fetch(image_server.url("/b.png"), last_modified=first.last_modified).not_modified
+
+def test_videos_oversized_and_missing_assets_have_no_content(downloader, image_server):
+    image_server.images["/clip.mp4"] = b"\x00" * 100
+    image_server.server.content_types["/clip.mp4"] = "video/mp4"
+    image_server.images["/huge.png"] = b"\x00" * 20_000
+    assert downloader.fetch(image_server.url("/clip.mp4")).content is None
+    assert downloader.fetch(image_server.url("/huge.png")).content is None
+    assert downloader.fetch(image_server.url("/missing.png")).content is None
+
+def test_reserve_gets_the_expected_size(downloader, image_server):
+    image_server.images["/c.png"] = png_bytes((200, 20, 20))
+    grants = []
+    result = downloader.fetch(image_server.url("/c.png"), reserve=lambda size: grants.append(size) or size)
+    assert grants == [len(image_server.images["/c.png"])] and result.reserved == grants[0]
+
+def test_async_fetch_sends_the_same_validators(downloader, image_server):
+    image_server.images["/d.png"] = png_bytes((200, 20, 20))
+
+    async def fetch_twice():
+        first = await downloader.afetch(image_server.url("/d.png"))
+        again = await downloader.afetch(image_server.url("/d.png"), etag=first.etag)
+        await downloader.aclose()
+        return first, again
+
+    first, again = asyncio.run(fetch_twice())
+    assert first.content == image_server.images["/d.png"] and again.not_modified
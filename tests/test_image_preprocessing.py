@@ -0,0 +1,41 @@
+"""
+preprocess_image() limits and the process pool's recovery from a dead worker.
+"""
+import io
+import os
+import signal
+
+from PIL import Image
+
+from fakes import png_bytes
+from image_preprocessing import ImagePreprocessor, preprocess_image
+
+def _encoded(size, format):
+    out = io.BytesIO()
+    Image.new("RGB", size, (120, 60, 30)).save(out, format=format)
+    return out.getvalue()
+
+def test_images_above_the_pixel_limit_are_rejected_before_decoding():
+    # A single-colour PNG compresses to a few KB whatever its size
+    bomb = _encoded((4000, 3000), "PNG")
+    assert preprocess_image(bomb, max_pixels=10_000_000) is None
+    prepared = preprocess_image(bomb, max_pixels=12_000_000)
+    assert prepared["original_size"] == (4000, 3000) and max(prepared["size"]) == 1024
+
+def test_large_jpegs_are_scaled_down_to_max_edge():
+    prepared = preprocess_image(_encoded((4096, 2048), "JPEG"), max_edge=512)
+    assert prepared["original_size"] == (4096, 2048) and prepared["size"] == (512, 256)
+
+def test_pool_is_restarted_when_a_worker_dies():
+    preprocessor = ImagePreprocessor(workers=1)
+    try:
+        assert preprocessor.process(png_bytes((200, 20, 20))) is not None
+        for process in list(preprocessor._pool._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+
+        prepared = preprocessor.process(png_bytes((20, 200, 20)))
+        assert prepared is not None and prepared["size"] == (64, 48)
+        assert preprocessor.restarts == 1
+    finally:
+        preprocessor.close()
@@ -0,0 +1,110 @@
+"""
+Pipeline stages, batching, backpressure and MemoryBudget, with plain functions as stages.
+"""
+import threading
+import time
+
+import pytest
+
+from ingestion_pipeline import MemoryBudget, Pipeline
+
+def test_memory_budget_blocks_until_released():
+    budget = MemoryBudget(100)
+    assert budget.acquire(80) == 80
+    acquired = threading.Event()
+
+    def second():
+        budget.acquire(50)
+        acquired.set()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not acquired.wait(0.1)
+    budget.release(80)
+    assert acquired.wait(1)
+    thread.join()
+    assert budget.stats() == {"limit": 100, "in_use": 50, "peak": 80, "waits": 1}
+
+def test_memory_budget_clamps_oversized_reservations():
+    budget = MemoryBudget(100)
+    assert budget.acquire(500) == 100
+    budget.release(100)
+    assert budget.stats()["in_use"] == 0
+
+def test_pipeline_runs_every_stage_and_reports_errors():
+    done, errors = [], []
+
+    def double(task):
+        return task * 2
+
+    def fail_on_six(task):
+        if task == 6:
+            raise ValueError("six")
+        return task
+
+    def drop_odd_results(task):
+        return None if task % 4 else task
+
+    pipeline = Pipeline([("double", double, 2), ("check", fail_on_six, 1), ("last", drop_odd_results, 2)],
+                        queue_size=2, on_error=lambda task, e: errors.append((task, str(e))), on_done=done.append)
+    for task in range(1, 6):
+        pipeline.submit(task)
+    pipeline.join()
+
+    assert sorted(done) == [2, 4, 6, 8, 10]
+    assert errors == [(6, "six")]
+    stats = pipeline.stats()
+    assert stats["double"]["processed"] == 5 and stats["check"]["errors"] == 1 and stats["last"]["processed"] == 4
+    pipeline.close()
+
+def test_batched_stage_gets_queued_tasks_together():
+    batches = []
+    release = threading.Event()
+
+    def slow_first(task):
+        if task == 0:
+            release.wait(1)
+        return task
+
+    def batch(tasks):
+        batches.append(list(tasks))
+        return [ValueError("bad") if task == 3 else task for task in tasks]
+
+    errors = []
+    pipeline = Pipeline([("first", slow_first, 1), ("batch", batch, 1, 4)], queue_size=8,
+                        on_error=lambda task, e: errors.append(task))
+    for task in range(6):
+        pipeline.submit(task)
+    time.sleep(0.05)
+    release.set()
+    pipeline.join()
+
+    assert sorted(t for b in batches for t in b) == list(range(6))
+    assert max(len(b) for b in batches) <= 4
+    assert errors == [3]
+    pipeline.close()
+
+def test_full_queue_applies_backpressure():
+    gate = threading.Event()
+    pipeline = Pipeline([("blocked", lambda task: gate.wait(1) and task, 1)], queue_size=1)
+    pipeline.submit(1)
+    pipeline.submit(2)
+    submitted = threading.Event()
+    thread = threading.Thread(target=lambda: (pipeline.submit(3), submitted.set()))
+    thread.start()
+    # One task is being worked on and one waits in the queue: the third submit blocks
+    assert not submitted.wait(0.1)
+    gate.set()
+    assert submitted.wait(1)
+    thread.join()
+    pipeline.join()
+    pipeline.close()
+
+@pytest.mark.parametrize("batch_size", [None, 3])
+def test_close_stops_workers(batch_size):
+    stage = ("stage", (lambda tasks: tasks) if batch_size else (lambda task: task), 3)
+    pipeline = Pipeline([stage + ((batch_size,) if batch_size else ())])
+    for task in range(10):
+        pipeline.submit(task)
+    pipeline.close()
+    assert all(not thread.is_alive() for thread in pipeline._threads)
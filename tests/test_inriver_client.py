@@ -0,0 +1,185 @@
+"""
+InRiverClient against a fake InRiver REST server (query, entities:fetchdata and the per-item endpoints).
+"""
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from inriver_client import InRiverClient
+
+API = "/api/v1.0.0"
+
+# Items 101-103: 101 and 102 share parent Product 900 and Resource 501
+ITEMS = {
+    101: {"fields": {"ItemCode": "A-101"}, "parent": 900, "resources": [501, 502]},
+    102: {"fields": {"ItemCode": "A-102"}, "parent": 900, "resources": [501]},
+    103: {"fields": {"ItemCode": "B-103"}, "parent": 901, "resources": []},
+}
+PRODUCTS = {900: {"ProductNameCommercial": {"nl-NL": "Blazer"}}, 901: {"ProductNameCommercial": {"nl-NL": "Broek"}}}
+MEDIA = {501: "https://cdn.example/501.jpg", 502: "https://cdn.example/502.jpg"}
+
+def _field_values(fields):
+    return [{"fieldTypeId": key, "value": value} for key, value in fields.items()]
+
+class FakeInRiver(BaseHTTPRequestHandler):
+    """
+    Serves the subset of the InRiver REST API the client uses; server.bulk_supported
+    switches entities:fetchdata off (HTTP 404) to exercise the per-item fallback.
+    """
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _record(self):
+        with self.server.lock:
+            self.server.requests.append((self.command, urlparse(self.path).path))
+
+    def do_POST(self):
+        self._record()
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = urlparse(self.path).path
+        if self.headers.get("X-inRiver-APIKey") != "secret":
+            return self._send(401, {"error": "unauthorized"})
+        if path == f"{API}/query":
+            self.server.queries.append(body)
+            return self._send(200, {"entityIds": sorted(ITEMS, reverse=True), "count": len(ITEMS)})
+        if path == f"{API}/entities:fetchdata":
+            if not self.server.bulk_supported:
+                return self._send(404, {"error": "not found"})
+            return self._send(200, [b for b in (self._bundle(eid, body) for eid in body["entityIds"]) if b])
+        self._send(404, {"error": "not found"})
+
+    def _bundle(self, entity_id, body):
+        if body["objects"] == "MediaDetails":
+            return {"entityId": entity_id, "mediaDetails": [{"url": MEDIA[entity_id]}]} if entity_id in MEDIA else None
+        if entity_id in PRODUCTS:
+            return {"entityId": entity_id, "fieldValues": _field_values(PRODUCTS[entity_id])}
+        item = ITEMS.get(entity_id)
+        if not item:
+            return None
+        return {
+            "entityId": entity_id,
+            "fieldValues": _field_values(item["fields"]),
+            "inbound": [{"linkTypeId": "ProductItem", "sourceEntityId": item["parent"]}],
+            "outbound": [{"linkTypeId": "ItemResource", "targetEntityId": rid, "linkIndex": index}
+                         for rid, index in zip(item["resources"], item.get("link_indexes", range(len(item["resources"]))))],
+        }
+
+    def do_GET(self):
+        self._record()
+        url = urlparse(self.path)
+        match = re.match(rf"^{API}/entities/(\d+)/(summary/fields|links|mediadetails)$", url.path)
+        if not match:
+            return self._send(404, {"error": "not found"})
+        entity_id, resource = int(match.group(1)), match.group(2)
+        if resource == "summary/fields":
+            fields = PRODUCTS.get(entity_id) or (ITEMS[entity_id]["fields"] if entity_id in ITEMS else None)
+            return self._send(200, _field_values(fields)) if fields is not None else self._send(404)
+        if resource == "mediadetails":
+            return self._send(200, [{"url": MEDIA[entity_id]}]) if entity_id in MEDIA else self._send(404)
+        item = ITEMS.get(entity_id)
+        if not item:
+            return self._send(404)
+        if parse_qs(url.query).get("linkDirection") == ["inbound"]:
+            return self._send(200, [{"linkTypeId": "ProductItem", "sourceEntityId": item["parent"]}])
+        return self._send(200, [{"linkTypeId": "ItemResource", "targetEntityId": rid} for rid in item["resources"]])
+
+@pytest.fixture
+def inriver_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeInRiver)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.queries = []
+    server.bulk_supported = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _client(server, **kwargs):
+    return InRiverClient(f"http://127.0.0.1:{server.server_address[1]}", "secret", max_concurrency=4, **kwargs)
+
+def _by_id(records):
+    return {record["entity_id"]: record for record in records}
+
+def test_query_item_ids_returns_sorted_ids_and_sends_criteria(inriver_server):
+    client = _client(inriver_server)
+    criteria = [{"fieldTypeId": "ItemBusinessFormula", "value": "C", "operator": "Equal"}]
+
+    assert client.query_item_ids(criteria, modified_since=0) == [101, 102, 103]
+
+    query = inriver_server.queries[0]
+    assert query["dataCriteria"] == criteria
+    assert {"type": "LastModified", "value": "1970-01-01T00:00:00Z", "operator": "GreaterThan"} in query["systemCriteria"]
+
+def test_bulk_fetch_resolves_parents_and_resources(inriver_server):
+    client = _client(inriver_server)
+
+    items = _by_id(client.get_items([101, 102, 103, 104]))
+
+    assert set(items) == {101, 102, 103}
+    assert items[101]["item_fields"] == {"ItemCode": "A-101"}
+    assert items[101]["product_fields"] == {"ProductNameCommercial": {"nl-NL": "Blazer"}, "product_entity_id": 900}
+    assert items[101]["image_urls"] == [MEDIA[501], MEDIA[502]]
+    assert items[102]["image_urls"] == [MEDIA[501]]
+    assert items[103]["image_urls"] == [] and items[103]["images_complete"]
+    # Items, parents and Resources: three fetchdata round trips, no per-entity GETs
+    assert [method for method, _ in inriver_server.requests] == ["POST"] * 3
+    assert client.fetch_mode == "bulk"
+
+def test_bulk_fetch_reuses_memoized_parents_and_resources(inriver_server):
+    client = _client(inriver_server)
+    client.get_items([101])
+    inriver_server.requests.clear()
+
+    items = _by_id(client.get_items([102]))
+
+    assert items[102]["product_fields"]["product_entity_id"] == 900
+    assert len(inriver_server.requests) == 1
+    assert client.cache_stats()["parent_products"]["hits"] == 1
+
+def test_falls_back_to_per_item_fetching_when_bulk_returns_404(inriver_server):
+    inriver_server.bulk_supported = False
+    client = _client(inriver_server)
+
+    items = _by_id(client.get_items([101, 102, 103, 104]))
+
+    assert client.fetch_mode == "per_item"
+    assert set(items) == {101, 102, 103}
+    assert items[101]["image_urls"] == [MEDIA[501], MEDIA[502]]
+    assert items[102]["product_fields"]["product_entity_id"] == 900
+    assert all(item["images_complete"] for item in items.values())
+    # Later batches go straight to the per-item endpoints
+    inriver_server.requests.clear()
+    client.get_items([103])
+    assert all(method == "GET" for method, _ in inriver_server.requests)
+
+@pytest.mark.parametrize("bulk_supported", [True, False])
+def test_images_keep_inriver_link_order_in_both_fetch_modes(inriver_server, monkeypatch, bulk_supported):
+    # Document IDs derive from the image index: a linkIndex that disagrees with the link order must not reorder them
+    monkeypatch.setitem(ITEMS, 101, dict(ITEMS[101], link_indexes=[1, 0]))
+    inriver_server.bulk_supported = bulk_supported
+    client = _client(inriver_server)
+
+    items = _by_id(client.get_items([101]))
+
+    assert items[101]["image_urls"] == [MEDIA[501], MEDIA[502]]
+
+def test_iter_items_streams_every_item_once(inriver_server):
+    client = _client(inriver_server)
+
+    streamed = [record["entity_id"] for record in client.iter_items([101, 102, 103], prefetch=1)]
+
+    assert sorted(streamed) == [101, 102, 103]
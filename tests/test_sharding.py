@@ -0,0 +1,61 @@
+"""
+Sharded ingestion: the deterministic split of Item IDs, per-shard runs, the combined
+run of a run group and shard-local garbage collection.
+"""
+from batch_processor import shard_of
+from fakes import png_bytes
+
+ITEM_IDS = list(range(1, 13))
+
+def _serve_items(image_server, inriver, item_ids):
+    for item_id in item_ids:
+        image_server.images[f"/{item_id}.png"] = png_bytes((item_id * 20, 20, 200 - item_id * 10))
+        inriver.add_item(item_id, [image_server.url(f"/{item_id}.png")])
+
+def _run_shards(make_processor, run_group, count=2):
+    results = []
+    for index in range(count):
+        processor = make_processor(shard_index=index, shard_count=count, RUN_GROUP=run_group)
+        results.append(processor.run(total_limit=100, mode="full"))
+    return processor, results
+
+def test_every_item_belongs_to_exactly_one_shard():
+    for count in (1, 2, 3, 8):
+        shards = [shard_of(item_id, count) for item_id in range(1000)]
+        assert all(0 <= shard < count for shard in shards)
+        assert shards == [shard_of(item_id, count) for item_id in range(1000)]
+    assert len({shard_of(item_id, 2) for item_id in ITEM_IDS}) == 2
+
+def test_shards_split_the_items_and_combine_into_one_run(make_processor, firestore_db, inriver, image_server):
+    _serve_items(image_server, inriver, ITEM_IDS)
+    processor, results = _run_shards(make_processor, "nightly")
+
+    assert [r["total_items_processed"] for r in results] == [
+        sum(1 for item_id in ITEM_IDS if shard_of(item_id, 2) == index) for index in range(2)]
+    assert set(firestore_db.products()) == {f"item_{item_id}_0" for item_id in ITEM_IDS}
+    for index in range(2):
+        shard_run = firestore_db.read(f"batchProgress/nightly_shard_{index}_of_2")
+        assert shard_run["status"] == "completed" and shard_run["run_group"] == "nightly"
+
+    # The group is recorded as one completed run covering the filter; that is the incremental baseline
+    group = firestore_db.read("batchProgress/nightly")
+    assert group["status"] == "completed" and group["covers_filter"] and group["shards"] == 2
+    assert group["totals"]["total_images_indexed"] == len(ITEM_IDS)
+    assert processor.db.get_last_completed_run()["run_id"] == "nightly"
+
+    # A retried task of a completed shard does not process its Items again
+    again = make_processor(shard_index=0, shard_count=2, RUN_GROUP="nightly").run(total_limit=100, mode="full")
+    assert again["shards_completed"] == 2 and again["total_images_indexed"] == len(ITEM_IDS)
+
+def test_a_shard_only_removes_orphans_of_its_own_items(make_processor, firestore_db, inriver, image_server):
+    _serve_items(image_server, inriver, ITEM_IDS)
+    _run_shards(make_processor, "first")
+    gone = ITEM_IDS[0]
+    del inriver.items[gone]
+    owner = shard_of(gone, 2)
+
+    make_processor(shard_index=1 - owner, shard_count=2, RUN_GROUP="second").run(total_limit=100, mode="full")
+    assert f"item_{gone}_0" in firestore_db.products()
+    make_processor(shard_index=owner, shard_count=2, RUN_GROUP="second").run(total_limit=100, mode="full")
+    assert f"item_{gone}_0" not in firestore_db.products()
+    assert len(firestore_db.products()) == len(ITEM_IDS) - 1
@@ -1,23 +1,58 @@
+import time
 import google.cloud.firestore as firestore
 from google.cloud.firestore_v1.vector import Vector
 from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
 from typing import List, Dict, Any
-from vision_client import VisionEmbeddingGenerator
+from embedding_backends import get_embedding_backend
+from hedged_embedding import HedgedEmbeddingClient
 from firestore_client import FirestoreClient
 from app_config import get_config
 
 # Persistent clients initialized once at module level to save latency
 _VISION_CLIENT = None
 _DB_CLIENT = None
+# Active search config (vector field), re-read at most every SEARCH_CONFIG_TTL seconds
+_SEARCH_CONFIG = {"value": None, "loaded_at": 0.0}
 
 def _get_clients():
     global _VISION_CLIENT, _DB_CLIENT
     if _VISION_CLIENT is None:
-        _VISION_CLIENT = VisionEmbeddingGenerator()
+        config = get_config()
+        deadline = config.get("SEARCH_EMBEDDING_DEADLINE", 10.0)
+        # A request nobody waits for anymore ends at the deadline instead of holding a thread
+        primary = get_embedding_backend(config, request_timeout=deadline)
+        # Optional second Vertex region for hedged requests; without it the hedge goes to the same backend
+        hedge_location = config.get("VERTEX_HEDGE_LOCATION")
+        secondary = None
+        if primary.name == "vertex" and hedge_location and hedge_location != primary.location:
+            secondary = get_embedding_backend(config, location=hedge_location, request_timeout=deadline)
+        _VISION_CLIENT = HedgedEmbeddingClient(
+            primary,
+            secondary=secondary,
+            deadline=deadline,
+            hedge_percentile=config.get("SEARCH_HEDGE_PERCENTILE", 95),
+            min_hedge_delay=config.get("SEARCH_HEDGE_MIN_DELAY", 0.5),
+            max_in_flight=config.get("SEARCH_MAX_IN_FLIGHT", 16)
+        )
     if _DB_CLIENT is None:
         _DB_CLIENT = FirestoreClient()
     return _VISION_CLIENT, _DB_CLIENT
 
+def _get_search_config(db_client: FirestoreClient) -> Dict[str, Any]:
+    """
+    Returns the active search config (vector field, products collection), cached so a
+    cutover is picked up within the TTL.
+    """
+    ttl = get_config().get("SEARCH_CONFIG_TTL", 60)
+    if _SEARCH_CONFIG["value"] is None or time.monotonic() - _SEARCH_CONFIG["loaded_at"] > ttl:
+        try:
+            _SEARCH_CONFIG["value"] = db_client.get_search_config()
+        except Exception:
+            # Keep serving with the last known config (or the defaults) when the read fails
+            _SEARCH_CONFIG["value"] = _SEARCH_CONFIG["value"] or {}
+        _SEARCH_CONFIG["loaded_at"] = time.monotonic()
+    return _SEARCH_CONFIG["value"]
+
 def search_similar_products(image_bytes: bytes, query: str = None, limit: int = 5, auto_crop: bool = True) -> tuple[List[Dict[str, Any]], bool]:
     """
     Takes image bytes, generates an embedding (optionally guided by a query), 
@@ -37,46 +72,43 @@ def search_similar_products(image_bytes: bytes, query: str = None, limit: int =
     config = get_config()
     vision, db_client = _get_clients()
     
-    from vertexai.vision_models import Image
     import logging
     logger = logging.getLogger("search_tools")
     
     logger.info(f"Generating embedding for {len(image_bytes)} bytes (Query context: '{query}')...")
     
     try:
-        image = Image(image_bytes)
-    except Exception as e:
-        logger.error(f"Failed to create Image object: {e}")
-        raise ValueError(f"Could not create Vertex AI Image from bytes: {e}")
-    
-    try:
-        # Pass the user query to contextual_text to help the model focus on the right object
-        embeddings = vision.model.get_embeddings(
-            image=image,
-            contextual_text=query,
-            dimension=1408
-        )
+        # Pass the user query to contextual_text to help the model focus on the right object.
+        # Deadline-bound and hedged: a slow Vertex response is raced by a duplicate request.
+        query_vector = vision.embed(image_bytes, contextual_text=query)
+    except TimeoutError as e:
+        logger.error(f"Vertex AI Embedding timeout: {e} (stats: {vision.stats()})")
+        raise
+    except ValueError as e:
+        logger.warning(f"No embeddings returned from Vertex AI: {e}")
+        return [], was_cropped
     except Exception as e:
         logger.error(f"Vertex AI Embedding Error: {str(e)}")
         raise
     
-    if not embeddings or not embeddings.image_embedding:
-        logger.warning("No embeddings returned from Vertex AI")
-        return []
-    
-    query_vector = embeddings.image_embedding
     logger.info(f"✓ Generated embedding vector with {len(query_vector)} dimensions")
 
     # 2. Perform Vector Search in Firestore
-    collection_name = config.get("FIRESTORE_PRODUCTS_COLLECTION", "products")
+    search_config = _get_search_config(db_client)
+    # Blue/green rebuilds flip the active collection in the search config
+    collection_name = search_config.get("products_collection") or config.get("FIRESTORE_PRODUCTS_COLLECTION", "products")
     logger.info(f"Querying Firestore collection: {collection_name}")
     collection = db_client.db.collection(collection_name)
+    vector_field = search_config.get("embedding_field", "embedding")
+    if search_config.get("embedding_dim") and search_config["embedding_dim"] != len(query_vector):
+        logger.warning(f"Query embedding has {len(query_vector)} dimensions but '{vector_field}' "
+                       f"holds {search_config['embedding_dim']} ({search_config.get('embedding_model')}); check EMBEDDING_BACKEND")
     
     threshold = 0.6 # Similarity > 40% (Distance < 0.6) - Increased to 0.6 to support very noisy screenshots or distant matches
     
     try:
         vector_query = collection.find_nearest(
-            vector_field="embedding",
+            vector_field=vector_field,
             query_vector=Vector(query_vector),
             distance_measure=DistanceMeasure.COSINE,
             limit=limit,
@@ -99,8 +131,8 @@ def search_similar_products(image_bytes: bytes, query: str = None, limit: int =
         data["doc_id"] = doc.id
         # distance is already in data because of distance_result_field="vector_distance"
         
-        if "embedding" in data:
-            del data["embedding"]
+        for field in [f for f in data if f.startswith("embedding") and f not in ("embedding_model", "embedding_dim")]:
+            del data[field]
         results.append(data)
     
     logger.info(f"✓ Found {len(results)} relevant results from Firestore")
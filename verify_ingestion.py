@@ -1,7 +1,6 @@
 import os
 import sys
 import pathlib
-from google.cloud import firestore
 
 # Add root to sys.path
 ROOT = str(pathlib.Path(__file__).resolve().parent)
@@ -9,6 +8,7 @@ if ROOT not in sys.path:
     sys.path.append(ROOT)
 
 from inriver_client import InRiverClient
+from firestore_client import FirestoreClient
 from app_config import get_config
 
 def verify():
@@ -39,48 +39,40 @@ def verify():
         print(f"Error querying InRiver: {e}")
         return
 
-    # 2. Query Firestore for ingested unique item_ids
+    # 2. Read the ingestion ledger (maintained by the batch job) with count() aggregations
     print("\n--- Firestore Verification ---")
-    db = firestore.Client(project=config["GOOGLE_CLOUD_PROJECT"], database=config.get("FIRESTORE_DATABASE", "product"))
-    products_col = config.get("FIRESTORE_PRODUCTS_COLLECTION", "products")
-    errors_col = config.get("FIRESTORE_ERRORS_COLLECTION", "processingErrors")
-    
-    # We use a set to collect unique item_ids from Firestore
-    ingested_item_ids = set()
-    docs = db.collection(products_col).select(["item_id"]).stream()
-    for doc in docs:
-        item_id = doc.get("item_id")
-        if item_id:
-            ingested_item_ids.add(int(item_id))
-    
-    print(f"✓ Found {len(ingested_item_ids)} unique Items in Firestore.")
-    
-    # 3. Check for Errors
-    error_item_ids = set()
-    error_docs = db.collection(errors_col).select(["item_id"]).stream()
-    for doc in error_docs:
-        item_id = doc.get("item_id")
-        if item_id:
-            error_item_ids.add(int(item_id))
-    
-    print(f"✓ Found {len(error_item_ids)} unique Items with recorded errors.")
+    db = FirestoreClient()
+    products_col = db.use_active_collection()
+    counts = db.ledger_counts()
+    image_docs = db.count_products()
+    print(f"✓ Ledger for '{products_col}': {counts['items']} Items, {image_docs} image documents.")
+
+    last_run = db.get_last_completed_run(collection=products_col)
+    running = db.get_resumable_run()
+    if last_run:
+        totals = last_run.get("totals") or {}
+        print(f"✓ Last completed run: {last_run.get('run_id')} ({last_run.get('mode')}), "
+              f"{totals.get('total_images_indexed', 0)} indexed, {totals.get('total_failed', 0)} failed.")
+    if running:
+        print(f"! Unfinished run: {running.get('run_id')} at position {running.get('position', 0)}/{running.get('manifest_size', '?')}")
 
-    # 4. Comparison
-    missing_ids = inriver_ids - ingested_item_ids
-    true_missing = missing_ids - error_item_ids
+    # 3. Comparison
+    not_processed = max(0, len(inriver_ids) - counts["items"])
     
     print("\n" + "="*40)
     print("INGESTION STATUS REPORT")
     print("="*40)
     print(f"Total Target Items (InRiver): {len(inriver_ids)}")
-    print(f"Successfully Ingested:       {len(ingested_item_ids)}")
-    print(f"Failed (Recorded Errors):    {len(error_item_ids)}")
-    print(f"Not Processed Yet:           {len(true_missing)}")
+    print(f"Successfully Ingested:       {counts['ok']}")
+    print(f"Partially Ingested:          {counts['partial']}")
+    print(f"Failed (Recorded Errors):    {counts['failed']}")
+    print(f"Without Images:              {counts['no_images']}")
+    print(f"Not Processed Yet:           {not_processed}")
     print("="*40)
     
-    if true_missing:
+    if not_processed:
         print(f"\nTip: Run 'python3 batch_processor_cli.py --limit {len(inriver_ids)}' to process the remaining items.")
-    elif len(ingested_item_ids) >= len(inriver_ids):
+    elif counts["ok"] + counts["no_images"] >= len(inriver_ids):
         print("\nSUCCESS: All matching items are in Firestore!")
     else:
         print("\nSome items are missing or failed. Check the errors collection for details.")
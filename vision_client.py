@@ -1,45 +1,55 @@
-import os
-import vertexai
-from vertexai.vision_models import MultiModalEmbeddingModel, Image
+import base64
 from typing import List, Optional
+from google.cloud import aiplatform
+from google.protobuf import json_format, struct_pb2
 from app_config import get_config
-from image_utils import download_image
-import io
+from embedding_backends import EmbeddingBackend
 
-class VisionEmbeddingGenerator:
-    def __init__(self):
+class VisionEmbeddingGenerator(EmbeddingBackend):
+    """
+    Vertex AI Multimodal Embeddings backend (one image per request).
+    """
+    name = "vertex"
+    model_name = "multimodalembedding@001"
+    model_version = "001"
+    dimension = 1408
+
+    def __init__(self, location: Optional[str] = None, request_timeout: Optional[float] = None):
+        """
+        location overrides VERTEX_LOCATION, e.g. for a failover region. request_timeout
+        (seconds, default VERTEX_REQUEST_TIMEOUT) bounds every request: a call that Vertex
+        does not answer in time fails with DeadlineExceeded instead of holding its thread.
+        """
         config = get_config()
         self.project_id = config.get("GOOGLE_CLOUD_PROJECT")
-        self.location = config.get("VERTEX_LOCATION", "europe-west1")
-        
+        self.location = location or config.get("VERTEX_LOCATION", "europe-west1")
+        self.request_timeout = request_timeout or config.get("VERTEX_REQUEST_TIMEOUT", 30.0)
+
         if not self.project_id:
             raise ValueError("GOOGLE_CLOUD_PROJECT is required for VisionEmbeddingGenerator")
 
-        vertexai.init(project=self.project_id, location=self.location)
-        # Using multimodalembedding model which supports 1024 dimensions
-        self.model = MultiModalEmbeddingModel.from_pretrained("multimodalembedding@001")
+        # The prediction client takes a timeout per call (the vertexai model wrapper does not),
+        # and is bound to its region by its endpoint, without process-wide vertexai.init() defaults
+        self.client = aiplatform.gapic.PredictionServiceClient(
+            client_options={"api_endpoint": f"{self.location}-aiplatform.googleapis.com"})
+        self.endpoint = (f"projects/{self.project_id}/locations/{self.location}"
+                         f"/publishers/google/models/{self.model_name}")
 
-    def get_embedding(self, image_bytes: bytes) -> Optional[List[float]]:
+    def embed(self, image_bytes: bytes, contextual_text: Optional[str] = None) -> List[float]:
         """
-        Generates 1408-dimensional embedding for the given image bytes.
+        Generates the image embedding and raises on API errors, so callers can
+        decide which failures to retry.
         """
-        try:
-            if not image_bytes:
-                return None
-
-            # Create Vertex AI Image object from bytes
-            image = Image(image_bytes)
-
-            # Generate embedding with dimension=1408
-            embeddings = self.model.get_embeddings(
-                image=image,
-                dimension=1408
-            )
-            
-            if embeddings and embeddings.image_embedding:
-                return embeddings.image_embedding
-            return None
-
-        except Exception as e:
-            print(f"Error generating embedding: {e}")
-            return None
+        instance = {"image": {"bytesBase64Encoded": base64.b64encode(image_bytes).decode("ascii")}}
+        if contextual_text:
+            instance["text"] = contextual_text
+        response = self.client.predict(
+            endpoint=self.endpoint,
+            instances=[json_format.ParseDict(instance, struct_pb2.Value())],
+            parameters=json_format.ParseDict({"dimension": self.dimension}, struct_pb2.Value()),
+            timeout=self.request_timeout
+        )
+        embedding = response.predictions[0].get("imageEmbedding") if response.predictions else None
+        if not embedding:
+            raise ValueError("No image embedding returned by Vertex AI")
+        return list(embedding)